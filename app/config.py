@@ -1,3 +1,7 @@
+import os
+from pathlib import Path
+from typing import Optional
+
 import yaml
 
 with open('config.yml', 'r') as config_file:
@@ -12,3 +16,35 @@ try:
     XSLT_FLAG = CFG['xslt']
 except KeyError:
     XSLT_FLAG = False
+
+try:
+    WARM_UP_FLAG = CFG['warm_up']
+except KeyError:
+    WARM_UP_FLAG = True
+
+try:
+    MAX_BATCH_SIZE = CFG['max_batch_size']
+except KeyError:
+    MAX_BATCH_SIZE = 500
+
+# Token to be sent in the X-Admin-Token header to the admin endpoints
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# ID of the start of the service, shared by its workers, set by entrypoint.sh
+START_ID = os.environ.get('START_ID')
+
+
+def read_db_version() -> Optional[str]:
+    """
+    Read the version hash of the deployed data
+    :return: The hash, or None if the deployment did not provide one
+    """
+    try:
+        db_version_file = Path(__file__).parent / "../.db-version"
+        with db_version_file.open('r') as version:
+            return version.read().strip("\n")
+    except FileNotFoundError:
+        return None
+
+
+DB_VERSION = read_db_version()
@@ -1,7 +1,11 @@
-from typing import List
+import functools
+import hmac
+import os
+from email.utils import formatdate
+from typing import AsyncIterator, Dict, Iterator, List, Literal, Optional
 
 import requests
-from fastapi import FastAPI
+from fastapi import Body, FastAPI, Header, Query
 from fastapi.openapi.utils import get_openapi
 from lxml import etree
 from snakesist.exist_client import ExistClient
@@ -9,12 +13,28 @@ from starlette.responses import Response, JSONResponse, PlainTextResponse, FileR
 from starlette.requests import Request
 from random import choice
 from string import ascii_letters
-from pathlib import Path
-from diskcache import Cache
+from urllib.parse import urlencode
 
 from service import Service, beacon_service, cmif_service, image_service, letter_index_service
+from service.aggregate_service import (
+    AGGREGATES, LETTER_FIELDS, AggregateQuery, Correspondence, correspondence_from_meta,
+    correspondences_from_letter_index, select
+)
+from service.cache_service import Entry, entity_dependency, item_dependency, open_response_cache
+from service.executor_service import open_blocking_executor
+from service.filter_service import FilterQuery, format_filter_query, parse_filter_query
+from service.helpers import FieldTree, format_fields, parse_fields
+from service.response_service import (
+    CACHE_CONTROL, JSON_MEDIA_TYPE, NDJSON_MEDIA_TYPE, XML_MEDIA_TYPE, EncodedResponse, encode_batch, encode_json,
+    encode_ndjson, encode_text, encode_xml, is_not_modified, make_etag, not_modified, send
+)
+from service.revalidation_service import RevalidatedEntry
+from service.warmup_service import WarmUp
 from models import EntityMeta
-from .config import CFG, ROOT_COLLECTION, XSLT_FLAG, ENTITY_NAMES, STAGE
+from .config import (
+    CFG, ROOT_COLLECTION, XSLT_FLAG, WARM_UP_FLAG, ENTITY_NAMES, STAGE, DB_VERSION, ADMIN_TOKEN, MAX_BATCH_SIZE,
+    START_ID
+)
 
 from starlette.middleware.cors import CORSMiddleware
 from PIL import Image
@@ -31,9 +51,244 @@ origins = [
 db = ExistClient(host="db", parser=etree.XMLParser(recover=True))
 # db = ExistClient(host="localhost", port=8071, parser=etree.XMLParser(recover=True))
 db.root_collection = ROOT_COLLECTION
-service = Service(db, CFG, watch_updates=True)
+# Responses are kept across restarts, in a namespace of the data version
+cache = open_response_cache(CFG, DB_VERSION, START_ID)
+service = Service(
+    db, CFG, watch_updates=True, version=DB_VERSION, update_listeners=[cache.invalidate_changes]
+)
+# Blocking calls of async endpoints run here, to keep the event loop responsive
+blocking = open_blocking_executor(CFG)
+
+
+def cmif_entry() -> Entry:
+    """
+    The CMIF document, read from the database or generated
+    """
+    def generate():
+        stored = db.xpath("//*:TEI[@type='cmif']")
+        if stored:
+            return encode_xml(str(stored.pop().node))
+        return encode_xml(cmif_service.generate_cmif(service))
+
+    return Entry("/cmif", generate, [entity_dependency(name) for name in ('letters', 'persons', 'places')])
+
+
+# The last good document is served while a new one is generated after changes
+cmif = RevalidatedEntry(cache, cmif_entry())
+service.add_update_listener(cmif.invalidate_changes)
+
+
+def collection_entry(
+        entity_name: str,
+        field_tree: Optional[FieldTree] = None,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        filter_query: Optional[FilterQuery] = None
+) -> Entry:
+    """
+    The collection of an entity, with the properties of a parsed fields
+    parameter, or a page of it, optionally filtered
+    """
+    parameters = []
+    if field_tree:
+        parameters.append(f"fields={format_fields(field_tree)}")
+    if filter_query is not None:
+        parameters.append(format_filter_query(filter_query))
+    if offset:
+        parameters.append(f"offset={offset}")
+    if limit is not None:
+        parameters.append(f"limit={limit}")
+    cache_key = f"/{entity_name}"
+    if parameters:
+        cache_key += "?" + "&".join(parameters)
+
+    def encode_collection():
+        if filter_query is not None:
+            matches = service.filter_entities(entity_name, filter_query, field_tree)
+            return encode_json(matches[offset:None if limit is None else offset + limit])
+        if offset or limit is not None:
+            return encode_json(list(service.iter_entities(entity_name, field_tree, offset, limit)))
+        return encode_json(service.get_entities(entity_name, fields=field_tree))
+
+    return Entry(cache_key, encode_collection, [entity_dependency(entity_name)])
+
+
+def count_entities(entity_name: str, filter_query: Optional[FilterQuery] = None) -> int:
+    """
+    Count the entities of an entity name, or those matching filter conditions
+    """
+    if filter_query is None:
+        return service.count_entities(entity_name)
+    return len(service.get_filter_index(entity_name).query(filter_query))
+
+
+def page_headers(request: Request, total: int, offset: int, limit: Optional[int]) -> Dict[str, str]:
+    """
+    Headers of a page of a collection: the total number of entities, and
+    links to the previous and next pages
+    """
+    headers = {"X-Total-Count": str(total)}
+    if limit is None:
+        return headers
+    links = []
+    if offset > 0:
+        previous_url = request.url.include_query_params(offset=max(offset - limit, 0), limit=limit)
+        links.append(f'<{previous_url}>; rel="prev"')
+    if offset + limit < total:
+        next_url = request.url.include_query_params(offset=offset + limit, limit=limit)
+        links.append(f'<{next_url}>; rel="next"')
+    if links:
+        headers["Link"] = ", ".join(links)
+    return headers
+
+
+def item_entry(entity_name: str, entity_id: str, output_format: str) -> Entry:
+    """
+    An item of an entity as JSON or XML, None if there is no such item
+    """
+    encode = encode_json if output_format == "json" else encode_xml
+
+    def encode_entity():
+        retrieved = service.get_entity(entity_name, entity_id, output_format=output_format)
+        return encode(retrieved) if retrieved else None
+
+    return Entry(
+        f"/{entity_name}/{entity_id}?format={output_format}",
+        encode_entity,
+        [item_dependency(entity_name, entity_id)]
+    )
+
+
+def batch_items(entity_name: str, entity_ids: List[str], output_format: str) -> Dict[str, Optional[EncodedResponse]]:
+    """
+    Items of an entity from their cache entries, by ID in the order
+    requested, None for the items not found
+    """
+    return {
+        entity_id: cache.get_or_set(*item_entry(entity_name, entity_id, output_format))
+        for entity_id in entity_ids
+    }
+
+
+def encoded_batch(entity_name: str, entity_ids: List[str], output_format: str, media_type: str) -> EncodedResponse:
+    """
+    Several items of an entity in one body, see encode_batch
+    """
+    return encode_batch(batch_items(entity_name, entity_ids, output_format), media_type)
+
 
-cache = Cache()
+async def stream_lines(lines: Iterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Send lines computed as they are consumed, e. g. entities extracted one
+    at a time, in chunks computed by the blocking executor
+    """
+    async for chunk in blocking.iterate(lines):
+        yield b"".join(chunk)
+
+
+def image_map_entry() -> Entry:
+    """
+    The facsimile images by letter and page
+    """
+    return Entry("/facsimiles", image_service.generate_image_map)
+
+
+def facsimiles_entry() -> Entry:
+    """
+    The facsimile images by letter and page, encoded
+    """
+    return Entry("/facsimiles/?format=json", lambda: encode_json(cache.get_or_set(*image_map_entry())))
+
+
+def beacon_entry(filter_type: str = '') -> Entry:
+    """
+    The BEACON file of the persons and organizations of a type
+    :param filter_type: beacon_service.FILTER_PERSON or FILTER_ORGANIZATION, all if omitted
+    """
+    def generate():
+        collection = service.get_entities('persons')
+        gnds = beacon_service.get_gnd_ids(collection, filter_type)
+        header = beacon_service.make_beacon_header(filter_type or 'all')
+        return encode_text(header + "\n".join(gnds))
+
+    return Entry(f"/beacon/{filter_type or 'all'}", generate, [entity_dependency('persons')])
+
+
+def letter_index_entry() -> Entry:
+    """
+    The letter index, read from a file of the deployment, which does not change
+    """
+    return Entry("/full-letter-index/", lambda: encode_json(letter_index_service.parse_gesamtdatenbank()))
+
+
+def letter_correspondences() -> List[Correspondence]:
+    """
+    The letters of the edition, reduced to the properties of the aggregates
+    """
+    return [correspondence_from_meta(meta) for meta in service.get_entities("letters", parse_fields(LETTER_FIELDS))]
+
+
+@functools.lru_cache(maxsize=1)
+def letter_index_correspondences() -> List[Correspondence]:
+    """
+    The letters of the full letter index, reduced to the properties of the
+    aggregates. The index is a file of the deployment, read once.
+    """
+    return correspondences_from_letter_index(letter_index_service.parse_gesamtdatenbank())
+
+
+# Letters of each source of the aggregates, and the dependencies of the aggregates
+AGGREGATE_SOURCES = {
+    "letters": (letter_correspondences, [entity_dependency("letters")]),
+    "full-letter-index": (letter_index_correspondences, []),
+}
+
+
+def aggregate_entry(source: str, aggregate: str, query: AggregateQuery = AggregateQuery()) -> Entry:
+    """
+    An aggregate of the letters of a source, see aggregate_service
+    """
+    correspondences, depends_on = AGGREGATE_SOURCES[source]
+    parameters = urlencode({name: value for name, value in query._asdict().items() if value is not None})
+    return Entry(
+        f"/aggregates/{source}/{aggregate}" + (f"?{parameters}" if parameters else ""),
+        lambda: encode_json(AGGREGATES[aggregate](select(correspondences(), query))),
+        depends_on
+    )
+
+
+def warm_up_entries() -> Iterator[Entry]:
+    """
+    List the responses to compute ahead of requests: the collections and
+    derived documents first, then every item in both formats, except those
+    of the entities extracted in the database
+    """
+    for entity_name in ENTITY_NAMES:
+        yield collection_entry(entity_name)
+    yield cmif.entry
+    yield letter_index_entry()
+    for source in AGGREGATE_SOURCES:
+        for aggregate in AGGREGATES:
+            yield aggregate_entry(source, aggregate)
+    yield image_map_entry()
+    yield facsimiles_entry()
+    for filter_type in ('', beacon_service.FILTER_PERSON, beacon_service.FILTER_ORGANIZATION):
+        yield beacon_entry(filter_type)
+    index = service.index
+    for entity_name in ENTITY_NAMES:
+        # Each item of an entity extracted in the database is one query,
+        # they are computed when requested
+        if entity_name in service.pushdown_queries:
+            continue
+        for entity_id in index[entity_name]:
+            yield item_entry(entity_name, entity_id, "json")
+            yield item_entry(entity_name, entity_id, "xml")
+
+
+warm_up = WarmUp(cache, warm_up_entries)
+if WARM_UP_FLAG:
+    # Registered after the cache, so that the evicted entries are computed
+    service.add_update_listener(warm_up.warm_up_changes)
 
 app = FastAPI()
 meta = {}
@@ -44,6 +299,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count", "Link"],
 )
 
 class XMLResponse(Response):
@@ -51,14 +307,13 @@ class XMLResponse(Response):
 
 @app.on_event('startup')
 async def on_startup():
-    try:
-        db_version_file = Path(__file__).parent / "../.db-version"
-        with db_version_file.open('r') as version:
-            db_version_hash = version.read().strip("\n")
-    except FileNotFoundError:
+    db_version_hash = DB_VERSION
+    if db_version_hash is None:
         db_version_hash = ''.join(choice(ascii_letters) for i in range(12))
 
     meta['version'] = db_version_hash
+    if WARM_UP_FLAG:
+        warm_up.start()
 
 
 @app.get(
@@ -70,25 +325,30 @@ async def on_startup():
         }
     },
 )
-async def cmif_api(refresh: bool = False):
+async def cmif_api(request: Request, refresh: bool = False):
     """
     Get correspondence metadata in CMI format
 
     The document is served from the cache, else from the database, else
-    generated from the letters and registers held by the service.
+    generated from the letters and registers held by the service. After
+    changes, and with `?refresh=true`, the cached document is served while a
+    new one is resolved in the background.
     """
-    cache_key = "/cmif"
     if refresh:
-        cache.pop(cache_key, None)
+        cmif.refresh()
+    generated = await blocking.run(cmif.get)
+    response = send(generated.value, request)
+    response.headers["Last-Modified"] = formatdate(generated.generated_at, usegmt=True)
+    return response
 
-    if cache_key not in cache:
-        stored = db.xpath("//*:TEI[@type='cmif']")
-        if stored:
-            cache[cache_key] = str(stored.pop().node)
-        else:
-            cache[cache_key] = cmif_service.generate_cmif(service)
 
-    return XMLResponse(content=cache[cache_key])
+@app.get("/cmif/status")
+def cmif_status() -> JSONResponse:
+    """
+    Get the time the served CMIF document was generated, whether it is
+    stale or being regenerated, and the error of the last failed attempt
+    """
+    return JSONResponse(cmif.status())
 
 
 @app.get(
@@ -99,11 +359,18 @@ async def cmif_api(refresh: bool = False):
         }
     },
 )
-async def search(q, entity, width=50):
+async def search(request: Request, q, entity, width=50):
     """
     Get full text search results
     """
-    return service.get_search_results(keyword=q, entity=entity, width=width)
+    results = await blocking.run(
+        lambda: encode_json(service.get_search_results(keyword=q, entity=entity, width=width))
+    )
+    return send(results, request)
+
+
+# Query parameters of the collection endpoints besides the filters
+COLLECTION_PARAMETERS = ("fields", "offset", "limit")
 
 
 def create_endpoints_for(entity_name):
@@ -112,17 +379,106 @@ def create_endpoints_for(entity_name):
     :param entity_name: Name of the entity as configured in the manifest
     """
 
-    @app.get(f"/{entity_name}", response_model=List[EntityMeta])
-    async def read_collection():
+    @app.get(
+        f"/{entity_name}",
+        response_model=List[EntityMeta],
+        responses={200: {"content": {NDJSON_MEDIA_TYPE: {}}}},
+    )
+    async def read_collection(
+            request: Request,
+            fields: Optional[str] = None,
+            offset: int = Query(0, ge=0),
+            limit: Optional[int] = Query(None, ge=1)
+    ):
         """
         Retrieve all entities of a specific type
+
+        To only get some of the properties, list them comma separated as
+        `fields`, with nested properties separated by dots, e. g.
+        `?fields=title,date,place.sent`
+
+        To page through the entities, skip `offset` of them and get at most
+        `limit`, e. g. `?offset=100&limit=50`. The total number is sent in
+        the `X-Total-Count` header, and the neighbouring pages are linked in
+        the `Link` header.
+
+        With `Accept: application/x-ndjson`, the entities are streamed as
+        newline delimited JSON, one per line, as they are extracted.
+
+        Entities can be filtered by the filters configured in the manifest,
+        e. g. `/letters?sender=P0001&date_from=1860&date_to=1865`, with
+        comma separated values matching any of them. Other parameters are
+        answered with 400 Bad Request.
         """
-        cache_key = f"/{entity_name}"
-        if cache_key not in cache:
-            cache[cache_key] = service.get_entities(entity_name)
+        field_tree = parse_fields(fields) if fields else None
+        try:
+            filter_query = parse_filter_query(
+                service.filters[entity_name], request.query_params.multi_items(), COLLECTION_PARAMETERS
+            )
+        except ValueError as error:
+            return JSONResponse(status_code=400, content={"message": str(error)})
+        if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+            try:
+                if filter_query is None:
+                    entities = await blocking.run(
+                        service.iter_entities, entity_name, field_tree or None, offset, limit
+                    )
+                else:
+                    matches = await blocking.run(
+                        service.filter_entities, entity_name, filter_query, field_tree or None
+                    )
+                    entities = matches[offset:None if limit is None else offset + limit]
+            except ValueError as error:
+                return JSONResponse(status_code=400, content={"message": str(error)})
+            total = await blocking.run(count_entities, entity_name, filter_query)
+            return StreamingResponse(
+                stream_lines(encode_ndjson(entities)),
+                media_type=NDJSON_MEDIA_TYPE,
+                headers={**page_headers(request, total, offset, limit), "Vary": "Accept"}
+            )
 
-        collection = cache[cache_key]
-        return collection
+        try:
+            collection = await blocking.run(
+                cache.get_or_set, *collection_entry(entity_name, field_tree or None, offset, limit, filter_query)
+            )
+        except ValueError as error:
+            return JSONResponse(status_code=400, content={"message": str(error)})
+        # The response model documents the response, the encoded body is sent as it is
+        response = send(collection, request, vary=["Accept"])
+        if offset or limit is not None or filter_query is not None:
+            total = await blocking.run(count_entities, entity_name, filter_query)
+            response.headers.update(page_headers(request, total, offset, limit))
+        return response
+
+    # Declared ahead of the transformation of an item, which takes any ID
+    @app.post(
+        f"/{entity_name}/batch",
+        responses={
+            200: {
+                "description": f"Get several items from {entity_name}",
+                "content": {"application/xml": {}, "application/json": {}},
+            }
+        },
+    )
+    async def read_entities(
+            request: Request,
+            entity_ids: List[str] = Body(..., min_length=1, max_length=MAX_BATCH_SIZE)
+    ):
+        """
+        Retrieve several entities by their IDs, sent as a JSON list, e. g.
+        `["P0001", "P0002"]`, in one response
+
+        As JSON, the entities are sent as an object by ID, along with the
+        IDs not found: `{"items": {"P0001": {...}}, "missing": ["P0002"]}`.
+        As XML, they are the children of a `batch` element, followed by the
+        IDs not found as `<missing><id>P0002</id></missing>`.
+        """
+        if request.headers.get("accept") == "application/json":
+            output_format, media_type = "json", JSON_MEDIA_TYPE
+        else:
+            output_format, media_type = "xml", XML_MEDIA_TYPE
+        batch = await blocking.run(encoded_batch, entity_name, entity_ids, output_format, media_type)
+        return send(batch, request, vary=["Accept"])
 
     @app.get(
         f"/{entity_name}/{{entity_id}}",
@@ -138,27 +494,18 @@ def create_endpoints_for(entity_name):
         Retrieve an entity by its ID
         """
         if request.headers["accept"] == "application/json":
-            cache_key = f"{entity_name}_{entity_id}_json"
-            if cache_key not in cache:
-                cache[cache_key] = service.get_entity(
-                    entity_name, entity_id, output_format="json"
-                )
-            retrieved_entity = cache[cache_key]
+            retrieved_entity = await blocking.run(cache.get_or_set, *item_entry(entity_name, entity_id, "json"))
             if retrieved_entity:
-                return JSONResponse(content=retrieved_entity)
+                return send(retrieved_entity, request, vary=["Accept"])
             else:
                 return JSONResponse(
                     status_code=404, content={"message": "Item not found"}
                 )
 
-        cache_key = f"{entity_name}_{entity_id}_xml"
-        if cache_key not in cache:
-            cache[cache_key] = service.get_entity(
-                entity_name, entity_id, output_format="xml"
-            )
-        retrieved_entity = cache[cache_key]
+        retrieved_entity = await blocking.run(cache.get_or_set, *item_entry(entity_name, entity_id, "xml"))
         if retrieved_entity:
-            return XMLResponse(content=retrieved_entity)
+            # JSON and XML are served under the same URL
+            return send(retrieved_entity, request, vary=["Accept"])
         else:
             return XMLResponse(
                 status_code=404, content="<message>Item not found</message>"
@@ -183,111 +530,221 @@ def create_endpoints_for(entity_name):
             """
             if xslt:
                 stylesheet = await request.body()
-                return service.xslt_transform_entity(entity_name, entity_id, stylesheet)
+                return await blocking.run(service.xslt_transform_entity, entity_name, entity_id, stylesheet)
             else:
                 return XMLResponse(
                     status_code=400, content="<message>Bad request</message>"
                 )
 
 
+def create_reference_endpoint_for(entity_name: str, target: str):
+    """
+    Generate the endpoint listing the entities referring to an item of
+    another entity, e. g. /persons/{id}/letters
+    :param entity_name: Name of the referring entity as configured in the manifest
+    :param target: Name of the entity referred to
+    """
+    roles = list(service.references[entity_name][target])
+
+    @app.get(
+        f"/{target}/{{entity_id}}/{entity_name}",
+        response_model=Dict[str, List[str]],
+        name=f"read_{target}_{entity_name}",
+        description=(
+            f"Retrieve the IDs of the {entity_name} referring to an item of {target}, "
+            f"sorted, by the role of the reference: {', '.join(roles)}"
+        ),
+    )
+    async def read_references(entity_id: str, request: Request):
+        references = await blocking.run(service.find_references, entity_name, target, entity_id)
+        if references is None:
+            return JSONResponse(status_code=404, content={"message": "Item not found"})
+        return send(encode_json(references), request)
+
+
 for entity in ENTITY_NAMES:
     create_endpoints_for(entity)
 
+for entity, references in service.references.items():
+    for referred in references:
+        create_reference_endpoint_for(entity, referred)
+
 @app.get(f"/facsimiles/")
-def get_facsimiles() -> JSONResponse:
-    cache_key = f"/facsimiles"
-    if cache_key not in cache:
-        cache[cache_key] = image_service.generate_image_map()
-    return JSONResponse(cache[cache_key])
+def get_facsimiles(request: Request) -> Response:
+    return send(cache.get_or_set(*facsimiles_entry()), request)
 
 @app.get(f"/facsimiles/{{letter_id}}/")
-def get_facsimile_for_letter(letter_id: str)  -> Response:
-    cache_key = f"/facsimiles"
-    if cache_key not in cache:
-        cache[cache_key] = image_service.generate_image_map()
-
-    facsimiles = cache[cache_key]
+def get_facsimile_for_letter(letter_id: str, request: Request)  -> Response:
+    facsimiles = cache.get_or_set(*image_map_entry())
     if letter_id not in facsimiles:
         return PlainTextResponse(f"No facsimiles found for letter {letter_id}", 400)
 
-    return JSONResponse(facsimiles[letter_id])
+    return send(encode_json(facsimiles[letter_id]), request)
 
-@app.get(f"/facsimiles/{{letter_id}}/{{page}}/{{rotation}}")
-async def get_facsimile_image(letter_id: str, page: int, rotation: int) -> Response:
-    cache_key = f"/facsimiles"
-    if cache_key not in cache:
-        cache[cache_key] = image_service.generate_image_map()
+def render_facsimile(path: str, rotation: int) -> BytesIO:
+    """
+    Rotate a facsimile image
+    :param path: Path of the image
+    :param rotation: Angle in degrees, counterclockwise
+    :return: The rotated image, encoded as WebP
+    """
+    img = Image.open(path, mode="r")
+    img = img.rotate(rotation, expand=True)
+
+    rotated_image = BytesIO()
+    img.save(rotated_image, "WEBP")
+    rotated_image.seek(0)
+    return rotated_image
 
-    facsimiles = cache[cache_key]
+@app.get(f"/facsimiles/{{letter_id}}/{{page}}/{{rotation}}")
+async def get_facsimile_image(letter_id: str, page: int, rotation: int, request: Request) -> Response:
+    facsimiles = await blocking.run(cache.get_or_set, *image_map_entry())
     if letter_id not in facsimiles:
         return PlainTextResponse(f"No facsimiles found for letter {letter_id}", 400)
 
     if page not in facsimiles[letter_id]:
         return PlainTextResponse(f"No facsimile with {page} found for letter {letter_id}", 400)
 
-    img = Image.open(f"./img/webp/{facsimiles[letter_id][page]['name']}", mode="r")
-    img = img.rotate(rotation, expand=True)
+    path = f"./img/webp/{facsimiles[letter_id][page]['name']}"
+    # The image is only rendered if the client has no current copy
+    stat = await blocking.run(os.stat, path)
+    etag = make_etag(path, stat.st_mtime_ns, stat.st_size, rotation)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
 
-    rotated_image = BytesIO()
-    img.save(rotated_image, "WEBP")
-    rotated_image.seek(0)
+    rotated_image = await blocking.run(render_facsimile, path, rotation)
+
+    return StreamingResponse(
+        rotated_image, media_type="image/webp", headers={"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    )
 
-    return StreamingResponse(rotated_image, media_type="image/webp")
+def beacon_response(request: Request, filter_type: str = '') -> Response:
+    """
+    Get the BEACON file of the persons and organizations of a type,
+    generated from the persons register
+    :param request: The request, for conditional requests
+    :param filter_type: beacon_service.FILTER_PERSON or FILTER_ORGANIZATION, all if omitted
+    """
+    return send(cache.get_or_set(*beacon_entry(filter_type)), request)
 
 @app.get(f"/beacon/all")
-def get_beacon() -> PlainTextResponse:
+def get_beacon(request: Request) -> PlainTextResponse:
     """
     Generate BEACON file for all persons and organizations identified with a GND number
     """
-    collection = service.get_entities('persons')
-    gnds = beacon_service.get_gnd_ids(collection)
-    header = beacon_service.make_beacon_header()
-    beacon = header + "\n".join(gnds)
-    return PlainTextResponse(beacon)
+    return beacon_response(request)
 
 @app.get(f"/beacon/persons")
-def get_beacon_person() -> PlainTextResponse:
+def get_beacon_person(request: Request) -> PlainTextResponse:
     """
     Generate BEACON file for all persons identified with a GND number, without organizations
     """
-    collection = service.get_entities('persons')
-    gnds = beacon_service.get_gnd_ids(collection, beacon_service.FILTER_PERSON)
-    header = beacon_service.make_beacon_header(beacon_service.FILTER_PERSON)
-    beacon = header + "\n".join(gnds)
-    return PlainTextResponse(beacon)
+    return beacon_response(request, beacon_service.FILTER_PERSON)
 
 @app.get(f"/beacon/organizations")
-def get_beacon_person() -> PlainTextResponse:
+def get_beacon_person(request: Request) -> PlainTextResponse:
     """
     Generate BEACON file for all organizations identified with a GND number, without actual persons
     """
-    collection = service.get_entities('persons')
-    gnds = beacon_service.get_gnd_ids(collection, beacon_service.FILTER_ORGANIZATION)
-    header = beacon_service.make_beacon_header(beacon_service.FILTER_ORGANIZATION)
-    beacon = header + "\n".join(gnds)
-    return PlainTextResponse(beacon)
+    return beacon_response(request, beacon_service.FILTER_ORGANIZATION)
 
 @app.get(f"/beacon/seeAlso/{{gnd}}")
-async def get_beacon_see_also(gnd: str):
+async def get_beacon_see_also(gnd: str, request: Request):
     """
     Get references in other data sources for a given GND number
     """
     headers =  {'Content-Type': 'application/json'}
     url = 'http://beacon.findbuch.de/seealso/pnd-aks?format=seealso&id=' + gnd
-    findbuch_response = requests.get(url, headers=headers)
+    findbuch_response = await blocking.run(requests.get, url, headers=headers)
     findbuch_response.encoding = 'UTF-8'
 
     transformed_data = beacon_service.map_seealso_data(findbuch_response.json())
-    return JSONResponse(transformed_data)
+    return send(encode_json(transformed_data), request)
 
 @app.get(f"/full-letter-index/")
-async def get_full_letter_index():
-    return letter_index_service.parse_gesamtdatenbank()
+async def get_full_letter_index(request: Request):
+    return send(await blocking.run(cache.get_or_set, *letter_index_entry()), request)
+
+@app.get("/aggregates/{source}/{aggregate}")
+async def get_aggregate(
+        source: Literal["letters", "full-letter-index"],
+        aggregate: Literal["network", "timeline", "places"],
+        request: Request,
+        year_from: Optional[str] = Query(None, pattern=r"^\d{4}$"),
+        year_to: Optional[str] = Query(None, pattern=r"^\d{4}$"),
+        person: Optional[str] = None
+):
+    """
+    Retrieve an aggregate of the letters of the edition or of the full
+    letter index, counted on the server:
+
+    - `network`: the letters sent and received by each person, and the
+      letters from each sender to each recipient
+    - `timeline`: the letters per year, and the undated ones
+    - `places`: the letters sent from and to each place
+
+    Persons and places are given by their keys for the edition, and by
+    their names for the full letter index. The letters can be limited to
+    the years from `year_from` to `year_to`, which leaves out the undated
+    ones, and to those sent or received by a `person`.
+    """
+    query = AggregateQuery(year_from, year_to, person or None)
+    return send(await blocking.run(cache.get_or_set, *aggregate_entry(source, aggregate, query)), request)
+
+
+def is_admin(token: Optional[str]) -> bool:
+    """
+    Check the token sent with a request to an admin endpoint. Without a
+    configured token, the admin endpoints are disabled.
+    """
+    return ADMIN_TOKEN is not None and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+@app.get("/admin/cache/stats")
+def get_cache_stats(x_admin_token: Optional[str] = Header(None)) -> JSONResponse:
+    """
+    Get hits and misses of the answering worker and the number of cached
+    responses by key prefix, the size of the cached responses on disk, the
+    hit rate of the responses the worker keeps in memory and the namespace
+    of the data version
+    """
+    if not is_admin(x_admin_token):
+        return JSONResponse(status_code=403, content={"message": "Forbidden"})
+    return JSONResponse({
+        "namespace": cache.namespace,
+        "size": cache.volume(),
+        "prefixes": cache.stats(),
+        "memory": cache.memory.stats(),
+    })
+
+
+@app.delete("/admin/cache")
+def purge_cache(prefix: str, x_admin_token: Optional[str] = Header(None)) -> JSONResponse:
+    """
+    Remove the cached responses whose keys start with a prefix, e. g.
+    `/letters/` for all letters, or `/` for everything
+    """
+    if not is_admin(x_admin_token):
+        return JSONResponse(status_code=403, content={"message": "Forbidden"})
+    return JSONResponse({"purged": len(cache.purge(prefix))})
+
+
+@app.get("/ready")
+def get_readiness() -> JSONResponse:
+    """
+    Get the progress of the cache warm-up. The status is 503 Service
+    Unavailable until the cache has been warmed up once after startup.
+    """
+    status = warm_up.status()
+    if WARM_UP_FLAG and not status['ready']:
+        return JSONResponse(status_code=503, content=status)
+    return JSONResponse(status)
+
 
 @app.get(f"/version/")
-def get_version_hash() -> JSONResponse:
+def get_version_hash(request: Request) -> JSONResponse:
     response = {"version": meta['version']}
-    return JSONResponse(response)
+    return send(encode_json(response), request)
 
 
 def custom_openapi():
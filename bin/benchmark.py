@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+Benchmark the Service against synthetic registers of growing size.
+
+No database is needed, the entities are generated in memory and handed to
+the Service through a stand-in for the eXist client.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from typing import List
+
+import xmltodict
+import yaml
+from delb import Document
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from snakesist.exist_client import NodeResource, QueryResultItem
+from starlette.responses import JSONResponse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The manifest is read relative to the working directory
+os.chdir(ROOT_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from models import EntityMeta  # noqa: E402
+from service import Service  # noqa: E402
+from service.filter_service import parse_filter_query  # noqa: E402
+from service.filters import Functions  # noqa: E402
+from service.helpers import normalize_whitespace  # noqa: E402
+from service.json_service import entity_to_dict  # noqa: E402
+from service.response_service import encode_json, send  # noqa: E402
+from fixtures.tei import letter_xml  # noqa: E402
+
+# Importing app.config would import the controller, which connects to the
+# database, so the manifest is read here directly
+with open('config.yml', 'r') as config_file:
+    CFG = yaml.load(config_file, Loader=yaml.FullLoader)
+
+PERSONS_XPATH = CFG['entities']['persons']['xpath']
+LETTERS_XPATH = CFG['entities']['letters']['xpath']
+
+
+class StaticClient:
+    """Answers XPath queries of the Service with prepared resources"""
+
+    root_collection = '/db'
+
+    def __init__(self, results):
+        self.results = results
+
+    def xpath(self, expression):
+        return self.results.get(expression, [])
+
+
+def make_person(number: int) -> NodeResource:
+    node = Document(
+        f'<person xmlns="http://www.tei-c.org/ns/1.0" xml:id="P{number:05d}">'
+        f'<persName type="reg"><surname>Person {number}</surname></persName>'
+        '</person>'
+    ).root
+    return NodeResource(None, QueryResultItem(str(number), '1', '/db/register.xml', node))
+
+
+def linear_lookup(service: Service, entity_name: str, entity_id: str):
+    """The lookup as it was done before the ID index was introduced"""
+    return next((
+        resource for resource in service.entities[entity_name]
+        if resource.node[service.id_attr] == entity_id
+    ), None)
+
+
+def benchmark_lookup(sizes, repeat):
+    print(f'{"persons":>8} {"linear (µs)":>12} {"indexed (µs)":>13}')
+    for size in sizes:
+        persons = [make_person(number) for number in range(size)]
+        service = Service(StaticClient({PERSONS_XPATH: persons}), CFG)
+        # The last entity is the worst case for a linear scan
+        entity_id = f'P{size - 1:05d}'
+        linear = timeit.timeit(
+            lambda: linear_lookup(service, 'persons', entity_id), number=repeat
+        )
+        indexed = timeit.timeit(
+            lambda: service.find_resource('persons', entity_id), number=repeat
+        )
+        print(f'{size:>8} {linear / repeat * 1e6:>12.2f} {indexed / repeat * 1e6:>13.2f}')
+
+
+def make_letter(number: int) -> NodeResource:
+    node = Document(letter_xml(
+        f'B{number:05d}', sender=f'P{number % 50}', date=f'18{60 + number % 30}-01-01'
+    )).root
+    return NodeResource(None, QueryResultItem(str(number), '1', f'/db/B{number:05d}.xml', node))
+
+
+def baseline_property_value(node, property_manifest):
+    """The extraction of a property value as it was done before extraction plans"""
+    output = None
+    if 'attrib' in property_manifest:
+        for val in property_manifest['attrib']:
+            try:
+                if "filter" in property_manifest:
+                    output = getattr(Functions, property_manifest["filter"])(node[val])
+                else:
+                    output = normalize_whitespace(node[val] if node[val] else '')
+                if output:
+                    return output
+            except KeyError:
+                continue
+    else:
+        if "filter" in property_manifest:
+            output = getattr(Functions, property_manifest["filter"])(node)
+        else:
+            output = normalize_whitespace(node.full_text)
+    return output
+
+
+def baseline_xpath_list(node, property_manifest):
+    if node:
+        return [
+            baseline_property_value(child_node, property_manifest)
+            for path in property_manifest["xpath"]
+            for child_node in ([node] if path == "." else node.xpath(path))
+        ]
+    return []
+
+
+def baseline_properties(property_manifest, parent_node):
+    """
+    The extraction of properties as it was done before extraction plans,
+    interpreting the manifest for every node and evaluating every XPath
+    expression with delb
+    """
+    return {
+        prop_name: baseline_property(prop_name, prop_items, parent_node)
+        for prop_name, prop_items in property_manifest.items()
+    }
+
+
+def baseline_property(prop_name, property_manifest, parent_node):
+    has_subprops = "properties" in property_manifest
+    has_xpath = "xpath" in property_manifest
+    has_multi = "multiple" in property_manifest
+    if has_subprops:
+        if has_multi and not has_xpath:
+            return [baseline_properties(props, parent_node) for props in property_manifest["properties"]]
+        elif has_multi and has_xpath:
+            return [
+                baseline_properties(property_manifest["properties"], node)
+                for path in property_manifest["xpath"]
+                for node in parent_node.xpath(path)
+            ]
+        elif not has_multi and not has_xpath:
+            return baseline_properties(property_manifest["properties"], parent_node)
+        else:
+            return [
+                baseline_properties(property_manifest["properties"], node)
+                for path in property_manifest["xpath"]
+                for node in parent_node.xpath(path)
+            ].pop()
+    assert has_xpath, f"XPath expression required for {prop_name}"
+    if has_multi:
+        return baseline_xpath_list(parent_node, property_manifest)
+    try:
+        return baseline_xpath_list(parent_node, property_manifest)[0]
+    except IndexError:
+        return None
+
+
+def benchmark_extract(count, repeat):
+    letters = [make_letter(number) for number in range(count)]
+    service = Service(StaticClient({LETTERS_XPATH: letters}), CFG)
+    manifest = CFG['entities']['letters']['properties']
+
+    def extract():
+        service.metas.clear()
+        return service.get_entities('letters')
+
+    def extract_baseline():
+        return [
+            EntityMeta(
+                id=str(resource.node[service.id_attr]),
+                entity='letters',
+                properties=baseline_properties(manifest, resource.node)
+            )
+            for resource in letters
+        ]
+
+    compiled = timeit.timeit(extract, number=repeat) / repeat
+    baseline = timeit.timeit(extract_baseline, number=repeat) / repeat
+    assert extract_baseline() == extract()
+
+    print(f'get_entities(\'letters\') for {count} letters')
+    print(f'  baseline process_properties: {baseline * 1000:>9.1f} ms')
+    print(f'  compiled plan:               {compiled * 1000:>9.1f} ms')
+
+
+def serialize_and_parse(node):
+    """The conversion as it was done before the tree was walked directly"""
+    output = node.css_select("teiHeader").first
+    if output is None:
+        output = node
+    return xmltodict.parse(str(output))
+
+
+def benchmark_json(count, repeat):
+    letters = [make_letter(number).node for number in range(count)]
+
+    def convert(converter):
+        return [converter(letter) for letter in letters]
+
+    serialized = timeit.timeit(lambda: convert(serialize_and_parse), number=repeat) / repeat
+    walked = timeit.timeit(lambda: convert(entity_to_dict), number=repeat) / repeat
+    assert convert(entity_to_dict) == convert(serialize_and_parse)
+
+    print(f'JSON representation of {count} letters')
+    print(f'  serialized and parsed:   {serialized * 1000:>9.1f} ms')
+    print(f'  tree walked:             {walked * 1000:>9.1f} ms')
+
+
+def benchmark_response(count, repeat):
+    service = Service(StaticClient({LETTERS_XPATH: [make_letter(number) for number in range(count)]}), CFG)
+    metas = service.get_entities('letters')
+    adapter = TypeAdapter(List[EntityMeta])
+    encoded = encode_json(metas)
+
+    def validate_and_encode():
+        """What FastAPI does with a cached list for the response model"""
+        return JSONResponse(jsonable_encoder(adapter.validate_python(metas))).body
+
+    assert validate_and_encode() == send(encoded).body
+    validated = timeit.timeit(validate_and_encode, number=repeat) / repeat
+    sent = timeit.timeit(lambda: send(encoded), number=repeat) / repeat
+
+    print(f'Response of /letters for {count} letters')
+    print(f'  validated and encoded:   {validated * 1000:>9.3f} ms')
+    print(f'  sent as encoded:         {sent * 1000:>9.3f} ms')
+
+
+def scan_letters(metas: List[EntityMeta], sender: str, date_from: str, date_to: str) -> List[EntityMeta]:
+    """The filter as the frontend applied it to the whole collection"""
+    return [
+        meta for meta in metas
+        if sender in meta.properties['sender']
+        and date_from <= (meta.properties['date'] or '')[:len(date_to)] <= date_to
+    ]
+
+
+def benchmark_filter(count, repeat):
+    service = Service(StaticClient({LETTERS_XPATH: [make_letter(number) for number in range(count)]}), CFG)
+    metas = service.get_entities('letters')
+    query = parse_filter_query(
+        service.filters['letters'], [('sender', 'P7'), ('date_from', '1862'), ('date_to', '1865')]
+    )
+    index = service.get_filter_index('letters')
+
+    assert index.query(query) == scan_letters(metas, 'P7', '1862', '1865')
+    scanned = timeit.timeit(lambda: scan_letters(metas, 'P7', '1862', '1865'), number=repeat) / repeat
+    indexed = timeit.timeit(lambda: index.query(query), number=repeat) / repeat
+
+    print(f'/letters?sender=P7&date_from=1862&date_to=1865 for {count} letters')
+    print(f'  scan of all letters:     {scanned * 1000:>9.3f} ms')
+    print(f'  filter index:            {indexed * 1000:>9.3f} ms')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    lookup = subparsers.add_parser('lookup', help='Look up entities by ID')
+    lookup.add_argument(
+        '--sizes', type=int, nargs='+', default=[100, 1000, 5000, 20000],
+        help='Register sizes to benchmark (default: 100 1000 5000 20000)'
+    )
+    lookup.add_argument(
+        '--repeat', type=int, default=100,
+        help='Lookups per register size (default: 100)'
+    )
+
+    extract = subparsers.add_parser('extract', help='Extract the properties of letters')
+    extract.add_argument(
+        '--count', type=int, default=500,
+        help='Number of letters (default: 500)'
+    )
+    extract.add_argument(
+        '--repeat', type=int, default=3,
+        help='Extractions per variant (default: 3)'
+    )
+
+    json = subparsers.add_parser('json', help='Convert letters to their JSON representation')
+    json.add_argument(
+        '--count', type=int, default=500,
+        help='Number of letters (default: 500)'
+    )
+    json.add_argument(
+        '--repeat', type=int, default=3,
+        help='Conversions per variant (default: 3)'
+    )
+
+    response = subparsers.add_parser('response', help='Send the cached response of the letters')
+    response.add_argument(
+        '--count', type=int, default=3000,
+        help='Number of letters (default: 3000)'
+    )
+    response.add_argument(
+        '--repeat', type=int, default=10,
+        help='Responses per variant (default: 10)'
+    )
+
+    filter_ = subparsers.add_parser('filter', help='Filter letters by sender and date')
+    filter_.add_argument(
+        '--count', type=int, default=3000,
+        help='Number of letters (default: 3000)'
+    )
+    filter_.add_argument(
+        '--repeat', type=int, default=100,
+        help='Queries per variant (default: 100)'
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.benchmark == 'lookup':
+        benchmark_lookup(args.sizes, args.repeat)
+    elif args.benchmark == 'extract':
+        benchmark_extract(args.count, args.repeat)
+    elif args.benchmark == 'json':
+        benchmark_json(args.count, args.repeat)
+    elif args.benchmark == 'response':
+        benchmark_response(args.count, args.repeat)
+    elif args.benchmark == 'filter':
+        benchmark_filter(args.count, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
 #!/bin/sh
 
+# Shared by the workers, so that only the first one empties an unversioned cache
+export START_ID="$(date +%s)-$$"
+
 poetry run uvicorn app:main --port ${PORT} --host 0.0.0.0 --workers 2
\ No newline at end of file
@@ -0,0 +1,63 @@
+"""
+Synthetic TEI documents modelled after those of the edition, for the tests
+and the benchmarks
+"""
+
+
+def letter_xml(
+        letter_id='B1',
+        sender='P1',
+        recipient='P2',
+        place_sent='L1',
+        place_received='L2',
+        date='1860-12-16',
+        mentioned_person='P3',
+        body_text='Lieber Freund, ich schreibe Ihnen aus Rom.',
+) -> str:
+    """A TEI letter modelled after the letters of the edition"""
+    return (
+        '<TEI xmlns="http://www.tei-c.org/ns/1.0" '
+        'xmlns:telota="http://www.telota.de" '
+        f'xml:id="{letter_id}" telota:doctype="letter_fgbe">'
+        '<teiHeader><fileDesc>'
+        '<titleStmt>'
+        f'<title>Gregorovius an Thile. Rom, {date}</title>'
+        '<respStmt><persName><surname>Steinsiek</surname><forename>Angela</forename></persName></respStmt>'
+        '</titleStmt>'
+        '<publicationStmt><availability status="free"/></publicationStmt>'
+        '<sourceDesc><msDesc><msIdentifier><repository>GSA Weimar</repository></msIdentifier></msDesc></sourceDesc>'
+        '</fileDesc>'
+        '<profileDesc><correspDesc>'
+        '<correspAction type="sent">'
+        f'<persName key="{sender}">Gregorovius, Ferdinand</persName>'
+        f'<placeName key="{place_sent}">Rom</placeName>'
+        f'<date when="{date}"/>'
+        '</correspAction>'
+        '<correspAction type="received">'
+        f'<persName key="{recipient}">Thile, Hermann von</persName>'
+        f'<placeName key="{place_received}">Berlin</placeName>'
+        '</correspAction>'
+        '</correspDesc></profileDesc>'
+        '</teiHeader>'
+        '<text><body>'
+        f'<p>{body_text} <hi rend="italic"><persName key="P4">Thile</persName></hi> und '
+        f'<persName key="{mentioned_person}">Gino</persName> '
+        'lassen grüßen aus <placeName key="L3">Florenz</placeName>.'
+        '<seg>Sie kennen <bibl corresp="W1">Wanderjahre</bibl>'
+        f'<note xml:id="{letter_id}_n1">Gemeint sind die <hi>Wanderjahre in Italien</hi>.</note></seg>'
+        '</p>'
+        '<p>Ihr ergebenster <orgName key="O1">Gesandtschaft</orgName></p>'
+        '</body></text>'
+        '</TEI>'
+    )
+
+
+def person_xml(person_id='P1', surname='Gregorovius', forename='Ferdinand', gnd='118541951') -> str:
+    """A person entry of the person register"""
+    return (
+        f'<person xmlns="http://www.tei-c.org/ns/1.0" xml:id="{person_id}">'
+        f'<idno type="uri">http://d-nb.info/gnd/{gnd}</idno>'
+        f'<persName type="reg"><surname>{surname}</surname> <forename>{forename}</forename></persName>'
+        '<birth>1821</birth><death>1891</death>'
+        '</person>'
+    )
@@ -0,0 +1,174 @@
+"""
+Aggregates of the correspondence for the network and timeline views: the
+number of letters between each sender and recipient, per year and per
+place.
+
+The aggregates are counted from the letters of the edition, by the keys of
+the persons and places, as well as from the full letter index of the
+Gesamtdatenbank, by the names of the persons and places. Both are reduced
+to a list of Correspondence records first, which are then counted alike.
+"""
+
+from collections import Counter
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from models import EntityMeta
+
+# Properties of the letters the aggregates are counted from
+LETTER_FIELDS = 'sender,recipient,place,date'
+
+
+class Correspondence(NamedTuple):
+    senders: Tuple[str, ...]
+    recipients: Tuple[str, ...]
+    place_sent: Optional[str]
+    place_received: Optional[str]
+    # Year the letter was written in, None if it is undated
+    year: Optional[str]
+
+
+class AggregateQuery(NamedTuple):
+    # First and last year of the letters to count, either may be None
+    year_from: Optional[str] = None
+    year_to: Optional[str] = None
+    # Only count the letters sent or received by this person
+    person: Optional[str] = None
+
+
+def _year(date: Optional[str]) -> Optional[str]:
+    if date and len(date) >= 4 and date[:4].isdigit() and date[:4] not in ('0000', '9999'):
+        return date[:4]
+    return None
+
+
+def _keys(value: Any) -> Tuple[str, ...]:
+    if isinstance(value, str):
+        value = [value]
+    return tuple(item for item in value or () if isinstance(item, str) and item)
+
+
+def correspondence_from_meta(meta: EntityMeta) -> Correspondence:
+    """
+    Reduce a letter of the edition to the properties that are counted
+    :param meta: Letter with at least the properties of LETTER_FIELDS
+    """
+    properties = meta.properties
+    place = properties.get('place') or {}
+    return Correspondence(
+        senders=_keys(properties.get('sender')),
+        recipients=_keys(properties.get('recipient')),
+        place_sent=place.get('sent') or None,
+        place_received=place.get('received') or None,
+        year=_year(properties.get('date')),
+    )
+
+
+def _display_name(person: Dict) -> str:
+    return person['gnd_name'] or person['name']
+
+
+def correspondences_from_letter_index(letter_index: Dict) -> List[Correspondence]:
+    """
+    Reduce the letters of the full letter index to the properties that are
+    counted. Persons are named like in the unique_senders and
+    unique_recipients lists of the index.
+    :param letter_index: Letter index as returned by letter_index_service.parse_gesamtdatenbank
+    """
+    return [
+        Correspondence(
+            senders=tuple(name for name in map(_display_name, letter['senders']) if name),
+            recipients=tuple(name for name in map(_display_name, letter['recipients']) if name),
+            place_sent=letter['placename_sent'] or None,
+            place_received=letter['placename_received'] or None,
+            year=_year(letter['date_index']),
+        )
+        for letter in letter_index['letters']
+    ]
+
+
+def select(correspondences: Iterable[Correspondence], query: AggregateQuery) -> List[Correspondence]:
+    """
+    Select the letters matching a query. Undated letters are left out if
+    a year is given.
+    :param correspondences: The letters
+    :param query: Years and person to select
+    """
+    selected = []
+    for letter in correspondences:
+        if query.year_from is not None and (letter.year is None or letter.year < query.year_from):
+            continue
+        if query.year_to is not None and (letter.year is None or letter.year > query.year_to):
+            continue
+        if query.person is not None and query.person not in letter.senders + letter.recipients:
+            continue
+        selected.append(letter)
+    return selected
+
+
+def _by_count(counter: Counter) -> Dict[str, int]:
+    return dict(sorted(counter.items(), key=lambda item: (-item[1], item[0])))
+
+
+def count_network(correspondences: List[Correspondence]) -> Dict:
+    """
+    Count the letters sent and received by each person, and those from each
+    sender to each recipient
+    :param correspondences: The letters to count
+    :return: The persons and the edges, by descending number of letters
+    """
+    sent = Counter()
+    received = Counter()
+    edges = Counter()
+    for letter in correspondences:
+        sent.update(set(letter.senders))
+        received.update(set(letter.recipients))
+        edges.update({(sender, recipient) for sender in letter.senders for recipient in letter.recipients})
+    persons = sent.keys() | received.keys()
+    return {
+        'total': len(correspondences),
+        'nodes': [
+            {'id': person, 'sent': sent[person], 'received': received[person]}
+            for person in sorted(persons, key=lambda person: (-sent[person] - received[person], person))
+        ],
+        'edges': [
+            {'source': source, 'target': target, 'count': count}
+            for (source, target), count in sorted(edges.items(), key=lambda item: (-item[1], item[0]))
+        ],
+    }
+
+
+def count_timeline(correspondences: List[Correspondence]) -> Dict:
+    """
+    Count the letters per year
+    :param correspondences: The letters to count
+    :return: The numbers by year in ascending order, and that of the
+             undated letters
+    """
+    years = Counter(letter.year for letter in correspondences if letter.year is not None)
+    return {
+        'total': len(correspondences),
+        'years': dict(sorted(years.items())),
+        'undated': sum(1 for letter in correspondences if letter.year is None),
+    }
+
+
+def count_places(correspondences: List[Correspondence]) -> Dict:
+    """
+    Count the letters sent from and to each place
+    :param correspondences: The letters to count
+    :return: The numbers by place, in descending order
+    """
+    return {
+        'total': len(correspondences),
+        'sent': _by_count(Counter(letter.place_sent for letter in correspondences if letter.place_sent)),
+        'received': _by_count(Counter(
+            letter.place_received for letter in correspondences if letter.place_received
+        )),
+    }
+
+
+AGGREGATES = {
+    'network': count_network,
+    'timeline': count_timeline,
+    'places': count_places,
+}
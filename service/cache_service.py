@@ -0,0 +1,654 @@
+"""
+Cache for the responses of the API.
+
+Cached responses are derived from entities, and they go stale when the
+UpdateWatcher pulls changes to those entities. Every entry is therefore
+stored with the dependencies it was computed from: the name of an entity
+for responses built from all of its items, such as the collection
+endpoints, or the name and ID of a single item for detail responses. When
+entities change, exactly the entries depending on them are evicted.
+
+The cache lives in a directory shared by all worker processes, bounded in
+size. The dependency records are kept apart from the entries, in a cache
+that never evicts, so that an entry cannot outlive the record listing it.
+Records keep the keys of entries evicted for size until they are
+invalidated, so a record is pruned to the entries still cached whenever it
+grew by RECORD_PRUNE_SIZE keys. Lookups of unknown items, which compute
+None, are not cached at all, so that requests for arbitrary IDs cannot
+fill either cache.
+In front of it, each process keeps the most recently used entries in
+memory, which are evicted on the same invalidations.
+
+A missing entry is computed once, however many requests ask for it at the
+same time: within a process the other requests wait for the result of the
+first one, and across processes for a lock held in the shared cache.
+
+The configured directory holds one cache per namespace, derived from the
+version hash of the deployed data and the manifest, so that the cache is
+kept across restarts: a restart on the same data reuses the cached
+responses, while a deployment of new data starts in a new namespace. The
+namespace in use is recorded in the directory, and the caches of the other
+namespaces are removed in the background. Data without version hash is
+cached in a namespace of its own, which is emptied once per start of the
+service, by the first of its workers.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Set
+
+from diskcache import Cache, Lock
+
+from .response_service import precompress
+
+logger = logging.getLogger(__name__)
+
+# Keys of the dependency records, which list the keys depending on something
+DEPENDENCY_PREFIX = 'dependency:'
+
+MISSING = object()
+
+DEFAULT_EVICTION_POLICY = 'least-recently-stored'
+DEFAULT_MEMORY_ENTRIES = 256
+# Key of the number of purges in the dependency records
+PURGES_KEY = 'meta:purges'
+# Key of the start of the service which last emptied the unversioned namespace
+START_KEY = 'meta:start'
+# Seconds between checks for purges by other processes
+PURGE_CHECK_INTERVAL = 1
+# Keys of the locks held while computing an entry, in the dependency records
+LOCK_PREFIX = 'lock:'
+# Seconds after which the lock of a process that died while computing is released
+LOCK_EXPIRE = 300
+
+# Number of keys added to a dependency record after which it is pruned
+RECORD_PRUNE_SIZE = 1000
+
+# Bump whenever the layout of the cached values changes
+CACHE_FORMAT = 4
+NAMESPACE_PREFIX = 'namespace-'
+# Namespace of data without version hash, which is emptied on every start
+UNVERSIONED_NAMESPACE = NAMESPACE_PREFIX + 'unversioned'
+# File in the cache directory naming the namespace in use
+CURRENT_NAMESPACE_FILE = 'current'
+
+
+def cache_namespace(manifest: Dict, version: Optional[str]) -> str:
+    """
+    Get the namespace of the cached responses of a data version
+    :param manifest: The parsed config.yml, which the responses depend on as well
+    :param version: Version hash of the deployed data
+    :return: Name of the namespace directory
+    """
+    if version is None:
+        return UNVERSIONED_NAMESPACE
+    digest = hashlib.blake2b(digest_size=8)
+    for part in (CACHE_FORMAT, version, manifest):
+        digest.update(repr(part).encode('utf-8'))
+    return NAMESPACE_PREFIX + digest.hexdigest()
+
+
+def switch_namespace(directory: str, namespace: str):
+    """
+    Record the namespace in use. The file is replaced at once, so that other
+    processes never read a partly written name.
+    :param directory: The configured cache directory
+    :param namespace: Name of the namespace directory
+    """
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as namespace_file:
+        namespace_file.write(namespace)
+    os.replace(namespace_file.name, os.path.join(directory, CURRENT_NAMESPACE_FILE))
+
+
+def reclaim_namespaces(directory: str, namespace: str) -> List[str]:
+    """
+    Remove the caches of other namespaces, unless another process switched
+    to a newer namespace in the meantime
+    :param directory: The configured cache directory
+    :param namespace: Name of the namespace directory in use
+    :return: The removed namespaces
+    """
+    try:
+        with open(os.path.join(directory, CURRENT_NAMESPACE_FILE)) as namespace_file:
+            current = namespace_file.read()
+    except FileNotFoundError:
+        return []
+    if current != namespace:
+        return []
+    removed = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.startswith(NAMESPACE_PREFIX) and name != namespace and os.path.isdir(path):
+            # Processes still using the cache keep the open files until they exit
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(name)
+    if removed:
+        logger.info('Removed the cached responses of %s other namespaces', len(removed))
+    return removed
+
+
+def open_response_cache(
+        manifest: Dict,
+        version: Optional[str] = None,
+        start_id: Optional[str] = None
+) -> 'ResponseCache':
+    """
+    Open the response cache configured in the manifest. Worker processes
+    configured with the same directory share their cache, as long as they
+    serve the same data version.
+    :param manifest: The parsed config.yml
+    :param version: Version hash of the deployed data. Without it, the
+                    cached responses are discarded by the first worker
+                    opening the cache after a start of the service.
+    :param start_id: ID of the start of the service, shared by all of its
+                     workers. Without it, every process counts as a start
+                     of its own.
+    :return: The response cache, in a temporary directory if none is configured
+    """
+    namespace = cache_namespace(manifest, version)
+    try:
+        directory = manifest['cache_dir']
+    except KeyError:
+        directory = None
+    settings = {'eviction_policy': DEFAULT_EVICTION_POLICY}
+    try:
+        settings['size_limit'] = manifest['cache_size_limit']
+    except KeyError:
+        pass
+    try:
+        settings['eviction_policy'] = manifest['cache_eviction_policy']
+    except KeyError:
+        pass
+    try:
+        memory_entries = manifest['cache_memory_entries']
+    except KeyError:
+        memory_entries = DEFAULT_MEMORY_ENTRIES
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        switch_namespace(directory, namespace)
+        reclaim = threading.Thread(target=reclaim_namespaces, args=(directory, namespace), name='cache-reclaim')
+        reclaim.daemon = True
+        reclaim.start()
+        directory = os.path.join(directory, namespace)
+    cache = Cache(directory, **settings)
+    records = Cache(os.path.join(cache.directory, 'dependencies'), eviction_policy='none')
+    response_cache = ResponseCache(cache, records, memory_entries, namespace)
+    if version is None:
+        # Nothing tells whether the responses of an earlier start are current
+        response_cache.purge_on_start(start_id or uuid.uuid4().hex)
+    return response_cache
+
+
+def is_entry_key(key: Any) -> bool:
+    """
+    Tell the keys of entries from those of the records kept along with them
+    """
+    return (
+        isinstance(key, str)
+        and not key.startswith((DEPENDENCY_PREFIX, LOCK_PREFIX))
+        and key not in (PURGES_KEY, START_KEY)
+    )
+
+
+def key_prefix(key: str) -> str:
+    """
+    Get the prefix statistics are grouped by, the first segment of the path
+    of a key like '/letters/B1?format=json'
+    :param key: Cache key
+    """
+    path = key.split('?', 1)[0]
+    return '/' + path.lstrip('/').split('/', 1)[0]
+
+
+def entity_dependency(entity_name: str) -> str:
+    """
+    Get the dependency on all items of an entity
+    :param entity_name: Name of the entity as configured in the manifest
+    """
+    return entity_name
+
+
+def item_dependency(entity_name: str, entity_id: str) -> str:
+    """
+    Get the dependency on a single item of an entity
+    :param entity_name: Name of the entity as configured in the manifest
+    :param entity_id: ID of the item
+    """
+    return f'{entity_name}/{entity_id}'
+
+
+def changed_dependencies(changed_ids: Dict[str, Set[str]]) -> List[str]:
+    """
+    Get the dependencies affected by changes to entities
+    :param changed_ids: IDs of the added, changed and removed items by
+                        entity name, as passed to update listeners of the Service
+    :return: Affected dependencies
+    """
+    dependencies = []
+    for entity_name, entity_ids in changed_ids.items():
+        dependencies.append(entity_dependency(entity_name))
+        dependencies.extend(item_dependency(entity_name, entity_id) for entity_id in sorted(entity_ids))
+    return dependencies
+
+
+class Entry(NamedTuple):
+    """
+    How to compute a cache entry, as passed to ResponseCache.get_or_set
+    """
+    key: str
+    compute: Callable[[], Any]
+    depends_on: Iterable[str] = ()
+
+
+class MemoryCache:
+    """
+    Bounded cache of the most recently used entries within a process, which
+    are served without disk access and unpickling. The cached values are
+    shared by all requests and must not be changed.
+    """
+
+    def __init__(self, max_entries: int):
+        """
+        :param max_entries: Number of entries to keep, 0 disables the cache
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Entries by key, along with their dependencies, least recently used first
+        self._entries = OrderedDict()
+        self._dependents: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        """
+        Get an entry and mark it as recently used
+        :param key: Cache key
+        :return: The value, or MISSING
+        """
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any, depends_on: Iterable[str]):
+        """
+        Store an entry, evicting the least recently used one if the cache is full
+        :param key: Cache key
+        :param value: Value to cache
+        :param depends_on: Dependencies of the value
+        """
+        if not self.max_entries:
+            return
+        depends_on = tuple(depends_on)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, depends_on)
+            for dependency in depends_on:
+                self._dependents.setdefault(dependency, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> bool:
+        try:
+            _, depends_on = self._entries.pop(key)
+        except KeyError:
+            return False
+        for dependency in depends_on:
+            keys = self._dependents[dependency]
+            keys.discard(key)
+            if not keys:
+                del self._dependents[dependency]
+        return True
+
+    def pop(self, key: str) -> bool:
+        """
+        Remove an entry
+        :param key: Cache key
+        :return: Whether the entry was cached
+        """
+        with self._lock:
+            return self._remove(key)
+
+    def invalidate(self, dependencies: Iterable[str]) -> Set[str]:
+        """
+        Evict the entries depending on any of the given dependencies
+        :param dependencies: Dependencies as returned by entity_dependency and item_dependency
+        :return: The evicted keys
+        """
+        with self._lock:
+            evicted = set()
+            for dependency in dependencies:
+                evicted.update(self._dependents.get(dependency, ()))
+            for key in evicted:
+                self._remove(key)
+            return evicted
+
+    def purge(self, prefix: str = ''):
+        """
+        Remove all entries whose keys start with a prefix
+        :param prefix: Key prefix, all entries are removed if omitted
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                self._remove(key)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the number of entries, the hits and misses and the hit rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class Flight:
+    """
+    Computation of a missing entry, which other threads can wait for
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = MISSING
+        self.error = None
+
+    def result(self) -> Any:
+        """
+        Wait for the computation to finish
+        :return: The computed value
+        :raises: The exception raised by the computation
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class ResponseCache:
+    """
+    Cache whose entries are evicted when the entities they depend on change
+    """
+
+    def __init__(
+            self,
+            cache: Cache,
+            records: Optional[Cache] = None,
+            memory_entries: int = 0,
+            namespace: Optional[str] = None
+    ):
+        """
+        :param cache: Cache the entries are stored in
+        :param records: Cache the dependency records are stored in, which
+                        must not evict them. If omitted, they are stored
+                        along with the entries, which is only safe if the
+                        cache is not bounded in size.
+        :param memory_entries: Number of entries to keep in memory as well
+        :param namespace: Namespace of the cache, see cache_namespace
+        """
+        self.cache = cache
+        self.namespace = namespace
+        self.records = cache if records is None else records
+        self.memory = MemoryCache(memory_entries)
+        self.hits = Counter()
+        self.memory_hits = Counter()
+        self.misses = Counter()
+        self._stats_lock = threading.Lock()
+        self._flights: Dict[str, Flight] = {}
+        self._flights_lock = threading.Lock()
+        self._purges = self.records.get(PURGES_KEY, 0)
+        self._purges_checked_at = time.monotonic()
+        # Invalidations are counted, so that a response computed while its
+        # dependencies were invalidated is not stored afterwards
+        self._invalidations = 0
+        self._invalidated_at: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        """
+        Check whether an entry is cached, without reading it or counting a hit
+        :param key: Cache key
+        """
+        return key in self.cache
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        Get a cached entry
+        :param key: Cache key
+        :param default: Value returned if the entry is not cached
+        """
+        value = self._lookup(key)
+        return default if value is MISSING else value
+
+    def _lookup(self, key: str) -> Any:
+        """
+        Look up an entry in memory, then on disk, and count the hit or miss
+        :return: The value, or MISSING
+        """
+        self._check_purges()
+        prefix = key_prefix(key)
+        value = self.memory.get(key)
+        if value is not MISSING:
+            with self._stats_lock:
+                self.hits[prefix] += 1
+                self.memory_hits[prefix] += 1
+            return value
+        entry = self.cache.get(key, MISSING)
+        with self._stats_lock:
+            (self.misses if entry is MISSING else self.hits)[prefix] += 1
+        if entry is MISSING:
+            return MISSING
+        depends_on, value = entry
+        self.memory.set(key, value, depends_on)
+        return value
+
+    def _check_purges(self):
+        """
+        Empty the memory if another process purged the cache since the last check
+        """
+        now = time.monotonic()
+        if now - self._purges_checked_at < PURGE_CHECK_INTERVAL:
+            return
+        self._purges_checked_at = now
+        purges = self.records.get(PURGES_KEY, 0)
+        if purges != self._purges:
+            self._purges = purges
+            self.memory.purge()
+
+    def set(self, key: str, value: Any, depends_on: Iterable[str] = ()):
+        """
+        Store an entry along with its dependencies
+        :param key: Cache key
+        :param value: Value to cache
+        :param depends_on: Dependencies as returned by entity_dependency and item_dependency
+        """
+        depends_on = tuple(depends_on)
+        # Cached responses are sent many times, so they are compressed once
+        precompress(value)
+        # The records are written first, so that no entry is without them
+        with self.records.transact():
+            for dependency in depends_on:
+                record_key = DEPENDENCY_PREFIX + dependency
+                keys = self.records.get(record_key, set())
+                if key not in keys:
+                    keys.add(key)
+                    if len(keys) % RECORD_PRUNE_SIZE == 0:
+                        keys = {listed for listed in keys if listed == key or listed in self.cache}
+                    self.records.set(record_key, keys)
+        # Entries are stored with their dependencies for the memory of other processes
+        self.cache.set(key, (depends_on, value))
+        self.memory.set(key, value, depends_on)
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        """
+        Remove an entry
+        :param key: Cache key
+        :param default: Value returned if the entry is not cached
+        :return: The removed value
+        """
+        self.memory.pop(key)
+        entry = self.cache.pop(key, MISSING)
+        return default if entry is MISSING else entry[1]
+
+    def get_or_set(self, key: str, compute: Callable[[], Any], depends_on: Iterable[str] = ()) -> Any:
+        """
+        Get a cached entry, or compute and store it if it is not cached. If
+        the entry is being computed already, by this or another process,
+        the result of that computation is awaited instead.
+        :param key: Cache key
+        :param compute: Function computing the value
+        :param depends_on: Dependencies of the value
+        :return: The cached or computed value
+        """
+        value = self._lookup(key)
+        if value is not MISSING:
+            return value
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self._flights[key] = Flight()
+        if not leading:
+            return flight.result()
+
+        try:
+            flight.value = self._compute(key, compute, list(depends_on))
+            return flight.value
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _compute(self, key: str, compute: Callable[[], Any], depends_on: List[str]) -> Any:
+        """
+        Compute and store an entry while holding its lock in the shared cache
+        """
+        with Lock(self.records, LOCK_PREFIX + key, expire=LOCK_EXPIRE):
+            # Another process may have stored the entry while this one waited
+            entry = self.cache.get(key, MISSING)
+            if entry is not MISSING:
+                entry_depends_on, value = entry
+                self.memory.set(key, value, entry_depends_on)
+                return value
+
+            started = self._invalidations
+            value = compute()
+            with self._lock:
+                stale = any(self._invalidated_at.get(dependency, -1) >= started for dependency in depends_on)
+            # Unknown items are not cached, so that any ID can be requested
+            if not stale and value is not None:
+                self.set(key, value, depends_on)
+            return value
+
+    def invalidate(self, dependencies: Iterable[str]) -> List[str]:
+        """
+        Evict the entries depending on any of the given dependencies
+        :param dependencies: Dependencies as returned by entity_dependency and item_dependency
+        :return: The evicted keys
+        """
+        dependencies = list(dependencies)
+        with self._lock:
+            for dependency in dependencies:
+                self._invalidated_at[dependency] = self._invalidations
+            self._invalidations += 1
+
+        # Entries in memory are evicted even if another process already
+        # removed their dependency records
+        evicted = self.memory.invalidate(dependencies)
+        listed = set()
+        with self.records.transact():
+            for dependency in dependencies:
+                listed.update(self.records.pop(DEPENDENCY_PREFIX + dependency, set()))
+        # Listed entries may have been purged or evicted for size already
+        with self.cache.transact():
+            evicted.update(key for key in listed if self.cache.delete(key))
+        if evicted:
+            logger.info('Evicted %s cached responses', len(evicted))
+        return sorted(evicted)
+
+    def invalidate_changes(self, changed_ids: Dict[str, Set[str]]) -> List[str]:
+        """
+        Evict the entries affected by changes to entities, to be registered
+        as update listener of the Service
+        :param changed_ids: IDs of the added, changed and removed items by entity name
+        :return: The evicted keys
+        """
+        return self.invalidate(changed_dependencies(changed_ids))
+
+    def purge(self, prefix: str) -> List[str]:
+        """
+        Remove all entries whose keys start with a prefix
+        :param prefix: Key prefix, e. g. '/letters/' for all letter items
+        :return: The removed keys
+        """
+        removed = [
+            key for key in self.cache.iterkeys()
+            if is_entry_key(key) and key.startswith(prefix)
+        ]
+        with self.cache.transact():
+            for key in removed:
+                self.cache.delete(key)
+        # Other processes empty their memory on the next lookup
+        self.records.incr(PURGES_KEY)
+        self.memory.purge(prefix)
+        logger.info('Purged %s cached responses with prefix %r', len(removed), prefix)
+        return sorted(removed)
+
+    def volume(self) -> int:
+        """
+        Get the size in bytes of the entries shared by all processes on disk
+        """
+        return self.cache.volume()
+
+    def purge_on_start(self, start_id: str) -> bool:
+        """
+        Remove all entries, unless another worker of the same start of the
+        service did so already
+        :param start_id: ID of the start, shared by its workers
+        :return: Whether the entries were removed
+        """
+        with Lock(self.records, LOCK_PREFIX + START_KEY, expire=LOCK_EXPIRE):
+            if self.records.get(START_KEY) == start_id:
+                return False
+            self.purge('')
+            self.records.set(START_KEY, start_id)
+            return True
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Get statistics by key prefix (see key_prefix): the hits, of which
+        from memory, and misses of this process, and the number of entries
+        shared by all processes
+        """
+        entries = Counter(key_prefix(key) for key in self.cache.iterkeys() if is_entry_key(key))
+        with self._stats_lock:
+            hits, memory_hits, misses = self.hits.copy(), self.memory_hits.copy(), self.misses.copy()
+        return {
+            prefix: {
+                'hits': hits[prefix],
+                'memory_hits': memory_hits[prefix],
+                'misses': misses[prefix],
+                'entries': entries[prefix],
+            }
+            for prefix in sorted(hits.keys() | misses.keys() | entries.keys())
+        }
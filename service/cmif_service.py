@@ -276,9 +276,12 @@ def generate_cmif(service) -> str:
     :param service: Service instance holding the queried entities
     :return: Serialized CMIF document
     """
-    persons = index_by_id(service.entities['persons'])
-    places = index_by_id(service.entities['places'])
-    letters = [resource.node for resource in service.entities['letters']]
+    # Letters and registers are taken from the same generation, so that
+    # updates arriving meanwhile cannot leave references unresolved
+    generation = service.generation
+    persons = index_by_id(service.get_resources('persons', generation))
+    places = index_by_id(service.get_resources('places', generation))
+    letters = [resource.node for resource in service.get_resources('letters', generation)]
 
     logger.info(
         'Generating CMIF document from %s letters, %s persons, %s places',
@@ -0,0 +1,74 @@
+"""
+Executor for the blocking work of async endpoints.
+
+Endpoints defined with `async def` run on the event loop of the worker, so
+any blocking call within them, be it a query to eXist, an extraction, a
+request to another service or the encoding of an image, stalls every other
+request of the worker until it returns. Such calls are run in a thread pool
+of bounded size instead, and awaited. Streamed responses pull their
+chunks through the same pool, since Starlette would otherwise iterate them
+in a pool of its own.
+"""
+
+import asyncio
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List
+
+DEFAULT_BLOCKING_WORKERS = 16
+# Number of items of a blocking iterable pulled by one call
+DEFAULT_CHUNK_SIZE = 100
+
+
+class BlockingExecutor:
+    """
+    Thread pool running blocking calls on behalf of coroutines
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_BLOCKING_WORKERS):
+        """
+        :param max_workers: Number of calls run at the same time, others wait for a thread
+        """
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='blocking')
+
+    async def run(self, function: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Run a blocking call in the thread pool and wait for its result
+        without blocking the event loop
+        :param function: Function to call
+        :param args: Positional arguments of the call
+        :param kwargs: Keyword arguments of the call
+        :return: The result of the call
+        :raises: The exception raised by the call
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    async def iterate(self, iterable: Iterable[Any], chunk_size: int = DEFAULT_CHUNK_SIZE) -> AsyncIterator[List[Any]]:
+        """
+        Iterate over an iterable whose items are computed as it advances,
+        such as a generator extracting entities, in the thread pool
+        :param iterable: Iterable to consume
+        :param chunk_size: Number of items pulled by one call in the thread pool
+        :return: The items, in lists of at most chunk_size
+        """
+        iterator = iter(iterable)
+        while True:
+            chunk = await self.run(list, itertools.islice(iterator, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def open_blocking_executor(manifest: Dict) -> BlockingExecutor:
+    """
+    Create the executor configured in the manifest
+    :param manifest: The parsed config.yml
+    """
+    try:
+        max_workers = manifest['blocking_workers']
+    except KeyError:
+        max_workers = DEFAULT_BLOCKING_WORKERS
+    return BlockingExecutor(max_workers)
@@ -0,0 +1,232 @@
+"""
+Secondary indexes for filtering entity collections by their properties.
+
+The filters of an entity are configured in the manifest, each on one of the
+extracted properties, given as a dotted path like in the fields parameter:
+
+    filters:
+      sender:
+        property: 'sender'
+      place_sent:
+        property: 'place.sent'
+      date:
+        property: 'date'
+        range: True
+
+A filter matches entities with any of the requested values, e. g.
+`?sender=P1,P2`, a range filter those with a value within the bounds given
+as `date_from` and `date_to`. Values are compared as strings, so that a
+bound like `1865` includes all dates of that year. Several filters match
+the entities matching all of them. Other query parameters than those of the
+filters and of the endpoint are rejected, so that a misspelled filter is
+not mistaken for no filter.
+
+A FilterIndex is built once from the EntityMeta list of a generation. It
+maps the values of each filter to the positions of the entities, and keeps
+the values of each range filter sorted, so that a query only touches the
+matching entities.
+"""
+
+import bisect
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from models import EntityMeta
+from .helpers import ExtractionPlan, parse_fields
+
+# Appended to an upper bound, so that it includes all values it is a prefix of
+RANGE_END = '\uffff'
+RANGE_FROM_SUFFIX = '_from'
+RANGE_TO_SUFFIX = '_to'
+
+
+class PropertyFilter:
+    """
+    A filter on an extracted property, as configured in the manifest
+    """
+
+    def __init__(self, name: str, manifest: Dict, plan: ExtractionPlan):
+        """
+        :param name: Name of the filter, as used in query parameters
+        :param manifest: Configuration of the filter
+        :param plan: Extraction plan of the entity
+        :raises ValueError: If the property is not in the manifest
+        """
+        self.name = name
+        self.property = manifest['property']
+        self.path = self.property.split('.')
+        try:
+            self.range = manifest['range']
+        except KeyError:
+            self.range = False
+        # Raises for properties missing from the property manifest
+        plan.project(parse_fields(self.property))
+
+    @property
+    def parameters(self) -> Tuple[str, ...]:
+        """Names of the query parameters of the filter"""
+        if self.range:
+            return self.name + RANGE_FROM_SUFFIX, self.name + RANGE_TO_SUFFIX
+        return (self.name,)
+
+    def values(self, properties: Dict) -> List[str]:
+        """
+        Get the values of the property
+        :param properties: Extracted properties of an entity
+        :return: The values, none if the property is empty
+        """
+        value = properties
+        for name in self.path:
+            if not isinstance(value, dict):
+                return []
+            value = value.get(name)
+        if isinstance(value, list):
+            return [item for item in value if isinstance(item, str) and item]
+        if isinstance(value, str) and value:
+            return [value]
+        return []
+
+
+def compile_filters(entity_manifest: Dict, plan: ExtractionPlan) -> Dict[str, PropertyFilter]:
+    """
+    Compile the filters configured for an entity
+    :param entity_manifest: Manifest of the entity
+    :param plan: Extraction plan of the entity
+    :return: Filters by name
+    :raises ValueError: If a filter refers to a property missing from the manifest
+    """
+    try:
+        filters = entity_manifest['filters']
+    except KeyError:
+        return {}
+    return {name: PropertyFilter(name, manifest, plan) for name, manifest in (filters or {}).items()}
+
+
+class FilterQuery(NamedTuple):
+    # Accepted values by filter name
+    values: Dict[str, Set[str]]
+    # Lower and upper bounds by range filter name, either may be None
+    ranges: Dict[str, Tuple[Optional[str], Optional[str]]]
+
+
+def parse_filter_query(
+        filters: Dict[str, PropertyFilter],
+        parameters: Iterable[Tuple[str, str]],
+        known: Iterable[str] = ()
+) -> Optional[FilterQuery]:
+    """
+    Read the filter conditions from query parameters
+    :param filters: Filters of the entity
+    :param parameters: Query parameters as name and value
+    :param known: Names of the other parameters of the endpoint, which are skipped
+    :return: The conditions, None if there are none
+    :raises ValueError: If a parameter is neither a filter nor a known parameter
+    """
+    parameters = list(parameters)
+    known = set(known)
+    accepted = {name for property_filter in filters.values() for name in property_filter.parameters}
+    unknown = {name for name, _ in parameters if name not in known and name not in accepted}
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+    values = {}
+    ranges = {}
+    for name, value in parameters:
+        value = value.strip()
+        if not value or name in known:
+            continue
+        property_filter = filters.get(name)
+        if property_filter is not None and not property_filter.range:
+            values.setdefault(name, set()).update(item.strip() for item in value.split(',') if item.strip())
+            continue
+        for suffix, bound in ((RANGE_FROM_SUFFIX, 0), (RANGE_TO_SUFFIX, 1)):
+            if not name.endswith(suffix):
+                continue
+            property_filter = filters.get(name[:-len(suffix)])
+            if property_filter is not None and property_filter.range:
+                bounds = list(ranges.get(property_filter.name, (None, None)))
+                bounds[bound] = value
+                ranges[property_filter.name] = tuple(bounds)
+    if not values and not ranges:
+        return None
+    return FilterQuery(values, ranges)
+
+
+def format_filter_query(query: FilterQuery) -> str:
+    """
+    Format filter conditions as query parameters in a canonical order, e. g.
+    for cache keys
+    :param query: Conditions as returned by parse_filter_query
+    """
+    parameters = [f"{name}={','.join(sorted(values))}" for name, values in query.values.items()]
+    for name, (lower, upper) in query.ranges.items():
+        if lower is not None:
+            parameters.append(f"{name}{RANGE_FROM_SUFFIX}={lower}")
+        if upper is not None:
+            parameters.append(f"{name}{RANGE_TO_SUFFIX}={upper}")
+    return '&'.join(sorted(parameters))
+
+
+def _in_range(value: str, lower: Optional[str], upper: Optional[str]) -> bool:
+    return (lower is None or value >= lower) and (upper is None or value <= upper + RANGE_END)
+
+
+class FilterIndex:
+    """
+    Indexes of the filter values of a list of entities
+    """
+
+    def __init__(self, filters: Dict[str, PropertyFilter], metas: List[EntityMeta]):
+        """
+        :param filters: Filters of the entity
+        :param metas: The entities to index
+        """
+        self.metas = metas
+        # Positions of the entities by value, by filter name
+        self.positions: Dict[str, Dict[str, List[int]]] = {}
+        # Values of each entity by position, and all values along with the
+        # positions in ascending order, by range filter name
+        self.range_values: Dict[str, List[List[str]]] = {}
+        self.sorted_values: Dict[str, List[Tuple[str, int]]] = {}
+        for name, property_filter in filters.items():
+            values = [property_filter.values(meta.properties) for meta in metas]
+            if property_filter.range:
+                self.range_values[name] = values
+                self.sorted_values[name] = sorted(
+                    (value, position) for position, entity_values in enumerate(values) for value in entity_values
+                )
+            else:
+                positions = {}
+                for position, entity_values in enumerate(values):
+                    for value in entity_values:
+                        positions.setdefault(value, []).append(position)
+                self.positions[name] = positions
+
+    def _range_positions(self, name: str, lower: Optional[str], upper: Optional[str]) -> Set[int]:
+        sorted_values = self.sorted_values[name]
+        start = 0 if lower is None else bisect.bisect_left(sorted_values, (lower,))
+        stop = len(sorted_values) if upper is None else bisect.bisect_left(sorted_values, (upper + RANGE_END,))
+        return {position for _, position in sorted_values[start:stop]}
+
+    def query(self, query: FilterQuery) -> List[EntityMeta]:
+        """
+        Find the entities matching all conditions of a query
+        :param query: Conditions as returned by parse_filter_query
+        :return: Matching entities, in the order of the indexed list
+        """
+        candidates = []
+        for name, accepted in query.values.items():
+            positions = self.positions[name]
+            candidates.append({position for value in accepted for position in positions.get(value, ())})
+        ranges = dict(query.ranges)
+        if not candidates:
+            # Without other conditions, the candidates are those of a range
+            name, (lower, upper) = ranges.popitem()
+            candidates.append(self._range_positions(name, lower, upper))
+        candidates.sort(key=len)
+        matches = candidates[0].intersection(*candidates[1:])
+        for name, (lower, upper) in ranges.items():
+            values = self.range_values[name]
+            matches = {
+                position for position in matches
+                if any(_in_range(value, lower, upper) for value in values[position])
+            }
+        return [self.metas[position] for position in sorted(matches)]
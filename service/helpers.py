@@ -1,10 +1,44 @@
-from types import NoneType
+import copy
+import re
+from typing import Callable, Dict, List, Optional, Tuple
 
 from delb import TagNode
-from typing import Dict
+from lxml import etree
+# delb has no public API to look up the node of an lxml element, see wrap_element
+from _delb.nodes import _wrapper_cache
 from snakesist.exist_client import NodeResource as Resource
 
 from models import EntityMeta
+from .filters import Functions
+
+STEP_PATTERN = re.compile(r'(?P<name>\*|[A-Za-z_][\w.-]*)(?P<predicates>(\[[^\[\]]*\])*)')
+PREDICATE_TOKEN = re.compile(
+    r'''\s*("[^"]*"|'[^']*'|@[A-Za-z_][\w.-]*|\d+|!=|<=|>=|[=<>()]|and\b|or\b|not\b)\s*'''
+)
+
+Step = Tuple[str, str]
+# Requested properties, e. g. {'title': None, 'place': {'sent': None}}
+FieldTree = Dict[str, Optional['FieldTree']]
+
+
+def wrap_element(element: etree._Element) -> TagNode:
+    """
+    Get the delb node of an lxml element. delb keeps exactly one node per
+    element in an internal cache, but has no public API to look it up, so
+    that cache is used, as snakesist does with its query results. delb is
+    pinned to 0.4 in pyproject.toml for this reason.
+    :param element: Element of a tree held by delb or queried with lxml
+    :return: The node delb uses for the element
+    """
+    return _wrapper_cache(element)
+
+
+def unwrap_node(node: TagNode) -> etree._Element:
+    """
+    Get the lxml element of a delb node, to query it with lxml directly
+    :param node: delb node
+    """
+    return node._etree_obj
 
 
 def normalize_whitespace(value: str) -> str:
@@ -16,142 +50,406 @@ def normalize_whitespace(value: str) -> str:
     return ' '.join(value.split())
 
 
-def apply_filter(value: TagNode, filter_name: str) -> str:
+def resolve_filter(filter_name: str) -> Callable:
     """
-    Apply a filter that makes changes to an XML node and outputs a value.
-    :param value: XML node to be processed
+    Look up a filter that makes changes to an XML node and outputs a value.
     :param filter_name: Name of the filter function defined in filters.py
-    :return: Processed output
+    :return: Filter function
     """
-    from .filters import Functions as f
     try:
-        filter_func = getattr(f, filter_name)
+        return getattr(Functions, filter_name)
     except AttributeError:
-        print(f"Filter is undefined: {filter_name}")
-    return filter_func(value)
+        raise ValueError(f"Filter is undefined: {filter_name}") from None
 
 
-def process_property_value(node: TagNode, property_manifest: Dict) -> str:
+def is_simple_predicate(predicate: str) -> bool:
     """
-    Extract a property value from an XML node
-    :param node: XML node as `delb.TagNode`
-    :param property_manifest: Manifest snippet of the property
-    :return:
+    Check whether a predicate only tests attributes and positions, so that
+    it contains no element names that would need a namespace
+    :param predicate: Predicate without the enclosing brackets
+    :return: True if the predicate can be passed to lxml unchanged
     """
-    output = None
-    if 'attrib' in property_manifest:
-        for val in property_manifest['attrib']:
-            try:
-                if "filter" in property_manifest:
-                    output = apply_filter(node[val], property_manifest["filter"])
-                else:
-                    output = normalize_whitespace(node[val] if node[val] else '')
-                # Output can return empty strings. We don't want those. Get the first attribute match.
-                if output:
-                    return output
-            except KeyError:
-                continue
-    else:
-        if "filter" in property_manifest:
-            output = apply_filter(node, property_manifest["filter"])
-        else:
-            output = normalize_whitespace(node.full_text)
-    return output
+    position = 0
+    while position < len(predicate):
+        match = PREDICATE_TOKEN.match(predicate, position)
+        if match is None:
+            return False
+        position = match.end()
+    return True
+
+
+def split_location_path(expression: str) -> Optional[List[Step]]:
+    """
+    Split a relative XPath expression like './/correspAction[@type="sent"]/persName'
+    into its location steps, each as a pair of axis ('child' or 'descendant')
+    and node test with predicates
+    :param expression: XPath expression from the manifest
+    :return: List of steps, or None if the expression uses more than
+             unprefixed names, '*', '/', '//' and attribute or position predicates
+    """
+    if not expression.startswith('./'):
+        return None
+
+    segments = []
+    current = ''
+    depth = 0
+    quote = None
+    for char in expression[1:]:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        elif char == '/' and depth == 0:
+            segments.append(current)
+            current = ''
+            continue
+        current += char
+    segments.append(current)
+
+    steps = []
+    axis = 'child'
+    for segment in segments[1:]:
+        if not segment:
+            if axis == 'descendant':
+                return None
+            axis = 'descendant'
+            continue
+        match = STEP_PATTERN.fullmatch(segment)
+        if match is None:
+            return None
+        predicates = re.findall(r'\[([^\[\]]*)\]', match['predicates'])
+        if not all(is_simple_predicate(predicate) for predicate in predicates):
+            return None
+        steps.append((axis, segment))
+        axis = 'child'
+
+    if axis == 'descendant' or not steps:
+        return None
+    return steps
 
 
-def process_xpath_list(node, property_manifest: Dict):
+class CompiledPath:
     """
-    Return a list of values as a result of running a list of XPath
-    expressions against an input node
-    :param node: Input node
-    :param property_manifest: Manifest snippet of the property
-    :return: List of values
+    An XPath expression of the manifest, prepared for repeated evaluation.
+
+    Expressions within the supported subset (see split_location_path) are
+    evaluated step by step with precompiled lxml expressions. The result is
+    the same as delb's own evaluation, including its order: a '//' step yields
+    its matches grouped by parent, the parents in document order, which is
+    not always the document order of the matches themselves. The results of
+    each step are kept in a memo that is shared by all paths evaluated on the
+    same node, so that common steps like './/correspAction[@type="sent"]'
+    are only evaluated once. Other expressions are passed on to delb.
     """
-    def complement_xpath(current_node, path):
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.steps = None if expression == '.' else split_location_path(expression)
+        if self.steps is not None:
+            self.steps = tuple(self.steps)
+        self._xpaths = {}
+
+    def _xpath(self, step: Step, namespace: Optional[str]) -> etree.XPath:
+        try:
+            return self._xpaths[step, namespace]
+        except KeyError:
+            pass
+        axis, node_test = step
+        match = STEP_PATTERN.fullmatch(node_test)
+        name, predicates = match['name'], match['predicates']
+        if name == '*':
+            test = '*'
+        elif namespace is None:
+            # Without a default namespace, delb matches names in any namespace
+            test = f'*[local-name()="{name}"]'
+        else:
+            test = f'd:{name}'
+        prefix = './' if axis == 'child' else './/'
+        xpath = etree.XPath(f'{prefix}{test}{predicates}', namespaces={'d': namespace} if namespace else None)
+        self._xpaths[step, namespace] = xpath
+        return xpath
+
+    def _evaluate_step(self, contexts: List, step: Step, namespace: Optional[str], memo: Dict) -> List:
+        xpath = self._xpath(step, namespace)
+        results = []
+        seen = set()
+        for context in contexts:
+            matches = xpath(context)
+            if step[0] == 'descendant' and len(matches) > 1:
+                order = memo.get(('order', context))
+                if order is None:
+                    order = {element: position for position, element in enumerate(context.iter())}
+                    memo[('order', context)] = order
+                matches = sorted(matches, key=lambda element: order[element.getparent()])
+            for match in matches:
+                if match not in seen:
+                    seen.add(match)
+                    results.append(match)
+        return results
+
+    def select(self, node: TagNode, memo: Dict) -> List:
         """
-        Return current node if XPath value is "."
-        else process XPath normally
+        Evaluate the expression against a node
+        :param node: Context node
+        :param memo: Step results of other paths evaluated against the same node
+        :return: Matching nodes
         """
-        if path == ".":
-            return [current_node]
+        if self.expression == '.':
+            return [node]
+        if self.steps is None:
+            return list(node.xpath(self.expression))
+
+        element = unwrap_node(node)
+        namespace = element.nsmap.get(None)
+        contexts = [element]
+        for length in range(1, len(self.steps) + 1):
+            key = (element, self.steps[:length])
+            results = memo.get(key)
+            if results is None:
+                results = self._evaluate_step(contexts, self.steps[length - 1], namespace, memo)
+                memo[key] = results
+            contexts = results
+            if not contexts:
+                break
+        return [wrap_element(result) for result in contexts]
+
+
+class ValueExtractor:
+    """
+    Extracts a property value from a selected node, either from one of a list
+    of attributes or from the text content, optionally through a filter
+    """
+
+    def __init__(self, property_manifest: Dict):
+        self.attribs = property_manifest.get('attrib')
+        self.filter_name = property_manifest.get('filter')
+        self.filter = resolve_filter(self.filter_name) if self.filter_name is not None else None
+
+    def extract(self, node: TagNode) -> str:
+        output = None
+        if self.attribs is not None:
+            for val in self.attribs:
+                try:
+                    if self.filter is not None:
+                        output = self.filter(node[val])
+                    else:
+                        output = normalize_whitespace(node[val] if node[val] else '')
+                    # Output can return empty strings. We don't want those. Get the first attribute match.
+                    if output:
+                        return output
+                except KeyError:
+                    continue
+        elif self.filter is not None:
+            output = self.filter(node)
         else:
-            return current_node.xpath(path)
+            output = normalize_whitespace(node.full_text)
+        return output
 
-    if node:
+
+class PropertyPlan:
+    """
+    Extraction of a single property, compiled from its manifest snippet
+    """
+
+    def __init__(self, prop_name: str, property_manifest: Dict):
+        has_subprops = "properties" in property_manifest
+        has_xpath = "xpath" in property_manifest
+        self.multiple = "multiple" in property_manifest
+        self.paths = [CompiledPath(path) for path in property_manifest.get("xpath", [])]
+        self.subplans = None
+        self.extractor = None
+
+        if has_subprops:
+            if self.multiple and not has_xpath:
+                self.subplans = [
+                    ExtractionPlan(props) for props in property_manifest["properties"]
+                ]
+                self.mode = 'objects'
+            elif has_xpath:
+                self.subplans = ExtractionPlan(property_manifest["properties"])
+                self.mode = 'nodes_objects' if self.multiple else 'node_object'
+            else:
+                self.subplans = ExtractionPlan(property_manifest["properties"])
+                self.mode = 'object'
+        else:
+            assert has_xpath, f"XPath expression required for {prop_name}"
+            self.extractor = ValueExtractor(property_manifest)
+            self.mode = 'values' if self.multiple else 'value'
+
+    def select(self, parent_node, memo: Dict) -> List:
         return [
-            process_property_value(child_node, property_manifest)
-            for path in property_manifest["xpath"]
-            for child_node in complement_xpath(node, path)
+            node
+            for path in self.paths
+            for node in path.select(parent_node, memo)
         ]
-    return []
 
+    def extract(self, parent_node, memo: Dict):
+        """
+        Process node into dictionary according to the property manifest
+        :param parent_node: Node to be processed
+        :param memo: Step results shared by the paths evaluated on the same node
+        :return: Extracted values
+        """
+        mode = self.mode
+        if mode == 'value' or mode == 'values':
+            # Nodes without any children yield no values, whatever the XPath
+            if parent_node is None or parent_node.first_child is None:
+                values = []
+            else:
+                values = [self.extractor.extract(node) for node in self.select(parent_node, memo)]
+            if mode == 'values':
+                return values
+            return values[0] if values else None
+        if mode == 'object':
+            return self.subplans.extract(parent_node, memo)
+        if mode == 'objects':
+            return [plan.extract(parent_node, memo) for plan in self.subplans]
+        objects = [self.subplans.extract(node, memo) for node in self.select(parent_node, memo)]
+        if mode == 'nodes_objects':
+            return objects
+        return objects.pop()
 
-def process_properties(property_manifest: Dict, parent_node) -> Dict:
-    return {
-        prop_name: process_property(prop_name, prop_items, parent_node)
-        for prop_name, prop_items in property_manifest.items()
-    }
 
+class ExtractionPlan:
+    """
+    The property manifest of an entity, compiled once into property plans
+    with precompiled XPath expressions and resolved filters
+    """
+
+    def __init__(self, property_manifest: Dict):
+        self.properties = [
+            (prop_name, PropertyPlan(prop_name, prop_items))
+            for prop_name, prop_items in property_manifest.items()
+        ]
+
+    def project(self, fields: FieldTree) -> 'ExtractionPlan':
+        """
+        Get a plan that only extracts some of the properties
+        :param fields: Requested properties as returned by parse_fields
+        :return: Extraction plan for the requested properties
+        """
+        available = dict(self.properties)
+        unknown = set(fields) - set(available)
+        if unknown:
+            raise ValueError(f"Unknown properties: {', '.join(sorted(unknown))}")
+
+        projected = copy.copy(self)
+        projected.properties = []
+        for prop_name, plan in self.properties:
+            if prop_name not in fields:
+                continue
+            subfields = fields[prop_name]
+            if subfields is not None:
+                if not isinstance(plan.subplans, ExtractionPlan):
+                    raise ValueError(f"Property {prop_name} has no nested properties to select")
+                plan = copy.copy(plan)
+                plan.subplans = plan.subplans.project(subfields)
+            projected.properties.append((prop_name, plan))
+        return projected
+
+    def extract(self, node, memo: Optional[Dict] = None) -> Dict:
+        """
+        Extract the properties from a node
+        :param node: Node to be processed
+        :param memo: Step results shared by the paths evaluated on the same
+                     node, a new one is used if omitted
+        :return: Extracted properties
+        """
+        if memo is None:
+            memo = {}
+        return {
+            prop_name: plan.extract(node, memo)
+            for prop_name, plan in self.properties
+        }
 
-def process_property(prop_name: str, property_manifest: Dict, parent_node):
+
+def parse_fields(fields: str) -> FieldTree:
+    """
+    Parse a comma separated list of property names, nested properties
+    separated by dots, like 'title,date,place.sent'
+    :param fields: List of property names
+    :return: Tree of requested properties, where None selects the whole property
+    """
+    tree = {}
+    for field in fields.split(','):
+        field = field.strip()
+        if not field:
+            continue
+        *parents, name = field.split('.')
+        branch = tree
+        for parent in parents:
+            if parent in branch and branch[parent] is None:
+                break
+            branch = branch.setdefault(parent, {})
+        else:
+            branch[name] = None
+    return tree
+
+
+def format_fields(fields: FieldTree) -> str:
+    """
+    Format a tree of requested properties in a canonical way, so that
+    equivalent requests can share a cache entry
+    :param fields: Requested properties as returned by parse_fields
+    :return: Sorted comma separated list of property names
     """
-    Process node into dictionary according to property manifest
-    :param prop_name: Name of the property
-    :param property_manifest: Manifest snippet of the property
+    names = []
+    for name, subfields in sorted(fields.items()):
+        if subfields is None:
+            names.append(name)
+        else:
+            names.extend(f'{name}.{subname}' for subname in format_fields(subfields).split(','))
+    return ','.join(names)
+
+
+def project_properties(properties: Dict, fields: FieldTree) -> Dict:
+    """
+    Select some of the already extracted properties of an entity
+    :param properties: Extracted properties
+    :param fields: Requested properties as returned by parse_fields
+    :return: Requested properties
+    """
+    projected = {}
+    for name, subfields in fields.items():
+        if name not in properties:
+            continue
+        value = properties[name]
+        if subfields is not None and isinstance(value, dict):
+            value = project_properties(value, subfields)
+        projected[name] = value
+    return projected
+
+
+def process_properties(property_manifest: Dict, parent_node) -> Dict:
+    """
+    Extract properties from a node according to a property manifest
+    :param property_manifest: Manifest snippet of the properties
     :param parent_node: Node to be processed
-    :return: Extracted values as dictionary
-    """
-    has_subprops = "properties" in property_manifest
-    has_xpath = "xpath" in property_manifest
-    has_multi = "multiple" in property_manifest
-    if has_subprops:
-        if has_multi and not has_xpath:
-            return [
-                process_properties(props, parent_node)
-                for props in property_manifest["properties"]
-            ]
-        elif has_multi and has_xpath:
-            return [
-                process_properties(property_manifest["properties"], node)
-                for path in property_manifest["xpath"]
-                for node in parent_node.xpath(path)
-            ]
-        elif not has_multi and not has_xpath:
-            return process_properties(property_manifest["properties"], parent_node)
-        elif not has_multi and has_xpath:
-            return [
-                process_properties(property_manifest["properties"], node)
-                for path in property_manifest["xpath"]
-                for node in parent_node.xpath(path)
-            ].pop()
-    elif not has_subprops:
-        assert has_xpath, f"XPath expression required for {prop_name}"
-        if has_multi:
-            return [
-                node
-                for node in process_xpath_list(parent_node, property_manifest)
-            ]
-        try:
-            return process_xpath_list(parent_node, property_manifest)[0]
-        except IndexError:
-            return None
+    :return: Extracted properties
+    """
+    return ExtractionPlan(property_manifest).extract(parent_node)
 
 
 def xml_to_entitymeta(
-        property_manifest: Dict,
+        plan: ExtractionPlan,
         entity_name: str,
         db_resource: Resource,
         id_attrib: str
 ) -> EntityMeta:
     """
     Transform eXist resource into EntityMeta model
-    :param property_manifest: Manifest snippet of the property
+    :param plan: Extraction plan compiled from the property manifest of the entity
     :param entity_name: Name of the entity as configured in the manifest
     :param db_resource: Resource queried from the database
     :param id_attrib: Name of the XML attribute containing the entity ID
     :return:
     """
-    properties = process_properties(property_manifest["properties"], db_resource.node)
+    properties = plan.extract(db_resource.node)
     try:
         node_id = db_resource.node[id_attrib]
     except (KeyError, TypeError):
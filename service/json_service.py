@@ -0,0 +1,218 @@
+"""
+Conversion of entity nodes into the JSON structure served by the API.
+
+The JSON representation of an entity has always been what xmltodict makes
+of the serialized node. Serializing the node with delb and parsing the
+markup again is slow though, so the structure is built here by walking the
+tree that is already held in memory. The result is the same as that of
+``xmltodict.parse(str(node))``, namespace declarations included.
+"""
+
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from delb import TagNode
+from lxml import etree
+
+from .helpers import unwrap_node, wrap_element
+
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+
+Declaration = Tuple[Optional[str], str]
+Item = Union[None, str, Dict]
+
+
+def _split_name(name: str) -> Tuple[Optional[str], str]:
+    if name[0] == '{':
+        namespace, local_name = name[1:].split('}', 1)
+        return namespace, local_name
+    return None, name
+
+
+def _qualify(local_name: str, prefix: Optional[str]) -> str:
+    return local_name if prefix is None else f'{prefix}:{local_name}'
+
+
+def _attribute_prefix(nsmap: Dict, namespace: str) -> Optional[str]:
+    for prefix, candidate in nsmap.items():
+        if prefix is not None and candidate == namespace:
+            return prefix
+    return None
+
+
+def _walk(root) -> Iterator[Tuple[str, object, List[Declaration]]]:
+    """
+    Walk the elements of a tree, yielding ('start', element, declarations)
+    and ('end', element, []) with the namespaces declared on each element
+    """
+    declarations = []
+    for event, value in etree.iterwalk(root, events=('start', 'end', 'start-ns')):
+        if event == 'start-ns':
+            prefix, namespace = value
+            declarations.append((prefix or None, namespace))
+        elif event == 'start':
+            yield event, value, declarations
+            declarations = []
+        else:
+            yield event, value, []
+
+
+def _used_namespaces(element) -> Iterator[Declaration]:
+    namespace, _ = _split_name(element.tag)
+    if namespace is not None:
+        yield element.prefix, namespace
+    for name in element.attrib:
+        namespace, _ = _split_name(name)
+        if namespace is not None and namespace != XML_NAMESPACE:
+            yield _attribute_prefix(element.nsmap, namespace), namespace
+
+
+def _root_declarations(root) -> List[Declaration]:
+    """
+    Get the namespace declarations of a subtree's root when it is serialized
+    on its own: its own declarations, followed by those of the namespaces
+    that are used within the subtree but declared outside of it, in the
+    order they are first used
+    """
+    result = []
+    scope, scopes = {}, []
+    for event, element, declarations in _walk(root):
+        if event == 'end':
+            scope = scopes.pop()
+            continue
+        scopes.append(scope)
+        if element is root:
+            result.extend(declarations)
+        if declarations:
+            scope = {**scope, **dict(declarations)}
+        for prefix, namespace in _used_namespaces(element):
+            if prefix not in scope:
+                result.append((prefix, namespace))
+                # Declared on the root, so the namespace is in scope for
+                # the rest of the subtree
+                for outer in scopes:
+                    outer[prefix] = namespace
+                scope[prefix] = namespace
+    return result
+
+
+def _push(item: Optional[Dict], key: str, value: Item) -> Dict:
+    if item is None:
+        return {key: value}
+    try:
+        existing = item[key]
+    except KeyError:
+        item[key] = value
+    else:
+        if isinstance(existing, list):
+            existing.append(value)
+        else:
+            item[key] = [existing, value]
+    return item
+
+
+def _declare(declarations: List[Declaration], scope: Dict, prefixes: Dict):
+    declared = set()
+    for prefix, namespace in declarations:
+        scope[prefix] = namespace
+        # Namespaces bound to a redeclared prefix are out of scope
+        for shadowed in [n for n, p in prefixes.items() if p == prefix]:
+            del prefixes[shadowed]
+        # Looking up a namespace finds its first declaration on an element
+        if namespace not in declared:
+            prefixes[namespace] = prefix
+            declared.add(namespace)
+
+
+def _start_item(element, declarations: List[Declaration], scope: Dict, prefixes: Dict) -> Tuple[str, Item]:
+    """
+    Get the name of an element and its item with the declarations and
+    attributes, ``scope`` maps the prefixes that are declared in the
+    serialization to their namespaces and ``prefixes`` the other way around
+    """
+    item = None
+    for prefix, namespace in declarations:
+        item = _push(item, '@xmlns' if prefix is None else f'@xmlns:{prefix}', namespace)
+
+    namespace, local_name = _split_name(element.tag)
+    if namespace is None:
+        name = local_name
+    elif scope.get(element.prefix) == namespace:
+        name = _qualify(local_name, element.prefix)
+    else:
+        name = _qualify(local_name, prefixes.get(namespace, element.prefix))
+
+    for key, value in element.attrib.items():
+        namespace, local_name = _split_name(key)
+        if namespace is None:
+            item = _push(item, f'@{local_name}', value)
+        elif namespace == XML_NAMESPACE:
+            item = _push(item, f'@xml:{local_name}', value)
+        else:
+            prefix = _attribute_prefix(element.nsmap, namespace)
+            if scope.get(prefix) != namespace:
+                prefix = _attribute_prefix(scope, namespace) or prefix
+            item = _push(item, f'@{_qualify(local_name, prefix)}', value)
+    return name, item
+
+
+def _text(element) -> Optional[str]:
+    # Comments and processing instructions are skipped, the text following
+    # them is not
+    data = [element.text] if element.text else []
+    data.extend(child.tail for child in element if child.tail)
+    return ''.join(data).strip() or None
+
+
+def node_to_dict(node: TagNode) -> Dict:
+    """
+    Convert a node into the structure that xmltodict parses from its
+    serialization, without serializing it
+    :param node: Node as held by the Service, its text must not have been
+                 altered through delb after it was parsed
+    :return: Dictionary with the node's name as the only key
+    """
+    root = unwrap_node(node)
+    stack = []
+    for event, element, declarations in _walk(root):
+        if event == 'start':
+            if element is root:
+                declarations = _root_declarations(root)
+                scope, prefixes = {}, {}
+            else:
+                _, _, scope, prefixes = stack[-1]
+                # Declarations of namespaces that are already declared are
+                # dropped from the serialization
+                declarations = [
+                    declaration for declaration in declarations
+                    if declaration[1] not in prefixes
+                ]
+            if declarations:
+                scope, prefixes = dict(scope), dict(prefixes)
+                _declare(declarations, scope, prefixes)
+            name, item = _start_item(element, declarations, scope, prefixes)
+            stack.append((name, item, scope, prefixes))
+            continue
+
+        name, item, _, _ = stack.pop()
+        text = _text(element)
+        if item is None:
+            item = text
+        elif text is not None:
+            _push(item, '#text', text)
+        if not stack:
+            return {name: item}
+        parent_name, parent_item, scope, prefixes = stack[-1]
+        stack[-1] = (parent_name, _push(parent_item, name, item), scope, prefixes)
+
+
+def entity_to_dict(node: TagNode) -> Dict:
+    """
+    Convert an entity for its JSON representation, that is its teiHeader
+    if it has one, else the whole entity
+    :param node: Node of the entity
+    :return: Dictionary with the converted node's name as the only key
+    """
+    header = next(unwrap_node(node).iter('{*}teiHeader'), None)
+    if header is None:
+        return node_to_dict(node)
+    return node_to_dict(wrap_element(header))
@@ -1,107 +1,837 @@
+import logging
 import threading
 import time
 import html
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
 from xml.dom import minidom
 
-import xmltodict
 from lxml import etree
 from requests.exceptions import HTTPError
-from snakesist.exist_client import ExistClient
+from snakesist.exist_client import (
+    XML_NAMESPACE as SNAKESIST_NAMESPACE, ExistClient, NodeResource as Resource, QueryResultItem
+)
 
 from models import EntityMeta
-from .helpers import xml_to_entitymeta
+from .filter_service import FilterIndex, FilterQuery, compile_filters
+from .helpers import ExtractionPlan, FieldTree, project_properties, wrap_element, xml_to_entitymeta
+from .json_service import entity_to_dict
+from .pushdown_service import LazyResource, PushdownQuery, UnsupportedExpression
+from .reference_service import ReferenceIndex, compile_references, reference_fields
+from .snapshot_service import load_snapshot, save_snapshot
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOAD_WORKERS = 4
+DEFAULT_WATCH_INTERVAL = 2
+DEFAULT_WATCH_MAX_INTERVAL = 60
+
+
+class Generation:
+    """
+    The entities held by the Service at one point in time
+
+    A generation is not changed once the Service has published it. Changes
+    pulled from the database go into a new generation which replaces the
+    current one as a whole, so a reader holding on to a generation sees the
+    same resources and index throughout, while updates are applied.
+    """
+
+    def __init__(
+            self,
+            number: int,
+            created: str,
+            entities: Dict[str, Sequence[Resource]],
+            index: Dict[str, Dict[str, Resource]],
+            metas: Optional[Dict[str, List[EntityMeta]]] = None,
+            filter_indexes: Optional[Dict[str, FilterIndex]] = None,
+            reference_indexes: Optional[Dict[str, ReferenceIndex]] = None,
+            nodes: Optional[Dict[str, Sequence[Resource]]] = None
+    ):
+        """
+        :param number: Running number of the generation, starting at 0
+        :param created: ISO timestamp of the time the resources were loaded
+        :param entities: Resources by entity name
+        :param index: Resources by entity ID, by entity name
+        :param metas: EntityMeta lists by entity name that are at hand already
+        :param filter_indexes: Filter indexes of the EntityMeta lists by
+                               entity name that are at hand already
+        :param reference_indexes: Reference indexes by name of the referring
+                                  entity that are at hand already
+        :param nodes: Resources with their nodes by name of the entities
+                      extracted in the database that are at hand already
+        """
+        self.number = number
+        self.created = created
+        self.entities = {name: tuple(resources) for name, resources in entities.items()}
+        self.index = index
+        # EntityMeta lists are extracted on demand. Extracting them twice
+        # yields equal lists, so readers may fill this in concurrently.
+        self.metas = dict(metas or {})
+        # Built on demand from the EntityMeta lists, the same way
+        self.filter_indexes = dict(filter_indexes or {})
+        self.reference_indexes = dict(reference_indexes or {})
+        # Entities extracted in the database are held as LazyResources,
+        # their nodes are loaded on demand the same way
+        self.nodes = dict(nodes or {})
+
+
+class Changes(NamedTuple):
+    # IDs of the documents modified since the last check
+    modified: Set[str]
+    # IDs of all documents in the collection, None if no document has been
+    # removed, in which case they are not queried
+    existing: Optional[Set[str]]
+    # Resources within the modified documents by entity name
+    resources: Dict[str, List[Resource]]
 
 
 class UpdateWatcher:
     """
     Watcher for changes in the database
+
+    The watcher polls for documents modified since its last check. Each
+    check is a single query, which also yields the entity nodes within the
+    modified documents, so documents that were added or changed are pulled
+    in one round trip. The check also counts the documents of the
+    collection: only if fewer are left than the watcher knows of, the IDs of
+    all documents are queried, and the documents that disappeared are
+    dropped. While nothing changes, the time between checks grows from the
+    minimum to the maximum interval.
     """
 
-    def __init__(self, db: ExistClient, entities: Dict):
-        self.last_checked = datetime.now().isoformat(timespec="seconds")
-        self.entities = entities
+    def __init__(
+            self,
+            db: ExistClient,
+            service: 'Service',
+            last_checked: Optional[str] = None,
+            min_interval: float = DEFAULT_WATCH_INTERVAL,
+            max_interval: float = DEFAULT_WATCH_MAX_INTERVAL
+    ):
+        """
+        :param db: Database client
+        :param service: Service whose entities are kept up to date
+        :param last_checked: ISO timestamp to look for changes from,
+                             the current time if omitted
+        :param min_interval: Seconds between checks after a change
+        :param max_interval: Seconds between checks after a long time without changes
+        """
+        self.last_checked = last_checked or datetime.now().isoformat(timespec="seconds")
+        self.service = service
         self.db = db
-    
-    def _reset_timestamp(self):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.interval = min_interval
+        # IDs of the documents of the collection, queried on the first check
+        self.documents: Optional[Set[str]] = None
+        self._stopped = threading.Event()
+
+    def _changes_query(self, since: str) -> str:
         """
-        Reset the timestamp of the last check to the current time
+        Build the query for the documents modified since a point in time
+        and the entity nodes within them
+        :param since: ISO timestamp
+        :return: XQuery expression
         """
-        self.last_checked = datetime.now().isoformat(timespec="seconds")
+        collection = f"collection('{self.db.root_collection}')"
+        results = [
+            f"for $node in $modified{entity['xpath']} "
+            f"return <snakesist:result xmlns:snakesist='{SNAKESIST_NAMESPACE}' entity='{name}' "
+            f"nodeid='{{util:node-id($node)}}' "
+            f"absid='{{util:absolute-resource-id($node)}}' "
+            f"path='{{util:collection-name($node) || '/' || util:document-name($node)}}'>"
+            f"{{$node}}</snakesist:result>"
+            for name, entity in self.service.manifest_entities.items()
+        ]
+        return (
+            f"let $modified := xmldb:find-last-modified-since({collection}, xs:dateTime('{since}')) "
+            f"return (<snakesist:modified xmlns:snakesist='{SNAKESIST_NAMESPACE}'>"
+            f"{{string-join(for $document in $modified return string(util:absolute-resource-id($document)), ' ')}}"
+            f"</snakesist:modified>, "
+            f"<snakesist:count xmlns:snakesist='{SNAKESIST_NAMESPACE}'>{{count({collection})}}</snakesist:count>, "
+            f"{', '.join(results)})"
+        )
 
-    def _updated_resources(self) -> List:
+    def _documents_query(self) -> str:
         """
-        Get a list of resources updated since the last check
+        Build the query for the IDs of all documents in the collection
+        :return: XQuery expression
         """
-        updated_resources = self.db.retrieve_resources(
-            f"""xmldb:find-last-modified-since(
-            collection('{self.db.root_collection}'), 
-            xs:dateTime('{self.last_checked}'))"""
+        collection = f"collection('{self.db.root_collection}')"
+        return (
+            f"<snakesist:existing xmlns:snakesist='{SNAKESIST_NAMESPACE}'>"
+            f"{{string-join(for $document in {collection} return string(util:absolute-resource-id($document)), ' ')}}"
+            f"</snakesist:existing>"
         )
-        self._reset_timestamp()
-        return [res.abs_resource_id for res in updated_resources]
- 
+
+    def fetch_changes(self) -> Changes:
+        """
+        Query the changes since the last check and move the timestamp of
+        the last check forward
+        :return: The changes
+        """
+        # Taken before querying, so that changes made while the query runs
+        # are picked up by the next check
+        checked = datetime.now().isoformat(timespec="seconds")
+        response = self.db.query(self._changes_query(self.last_checked))
+        self.last_checked = checked
+
+        modified = set((response.find(f'.//{{{SNAKESIST_NAMESPACE}}}modified').text or '').split())
+        count = int(response.find(f'.//{{{SNAKESIST_NAMESPACE}}}count').text)
+        resources = {}
+        for item in response.iter(f'{{{SNAKESIST_NAMESPACE}}}result'):
+            resources.setdefault(item.attrib['entity'], []).append(Resource(
+                self.db,
+                QueryResultItem(
+                    item.attrib['absid'], item.attrib['nodeid'], item.attrib['path'], wrap_element(item[0])
+                )
+            ))
+
+        # Added documents are among the modified ones, so the count only
+        # differs from the known documents if some have been removed
+        existing = None
+        if self.documents is not None and len(self.documents | modified) == count:
+            self.documents |= modified
+        else:
+            response = self.db.query(self._documents_query())
+            existing = set((response.find(f'.//{{{SNAKESIST_NAMESPACE}}}existing').text or '').split())
+            self.documents = existing
+        return Changes(modified=modified, existing=existing, resources=resources)
+
+    @staticmethod
+    def apply_changes(resources: Sequence[Resource], changes: Changes, entity_name: str) -> Optional[List[Resource]]:
+        """
+        Apply changes to the resources of an entity. Resources of modified
+        documents take the place of the ones they replace, those of new
+        documents are appended.
+        :param resources: Current resources of the entity
+        :param changes: Changes as returned by fetch_changes
+        :param entity_name: Name of the entity as configured in the manifest
+        :return: The new list of resources, or None if it is unchanged
+        """
+        replaced = {
+            resource.abs_resource_id for resource in resources
+            if resource.abs_resource_id in changes.modified
+            or changes.existing is not None and resource.abs_resource_id not in changes.existing
+        }
+        fetched = {}
+        for resource in changes.resources.get(entity_name, []):
+            fetched.setdefault(resource.abs_resource_id, []).append(resource)
+        if not replaced and not fetched:
+            return None
+
+        result = []
+        for resource in resources:
+            if resource.abs_resource_id not in replaced:
+                result.append(resource)
+            elif resource.abs_resource_id in fetched:
+                result.extend(fetched.pop(resource.abs_resource_id))
+        for added in fetched.values():
+            result.extend(added)
+        return result
+
+    def check_for_updates(self) -> Optional[Generation]:
+        """
+        Pull the changes since the last check into a new generation of the
+        Service's entities. The resources of the current generation are left
+        untouched.
+        :return: The new generation, or None if nothing has changed
+        """
+        changes = self.fetch_changes()
+        updated = {}
+        for name, resources in self.service.generation.entities.items():
+            result = self.apply_changes(resources, changes, name)
+            if result is not None:
+                updated[name] = result
+        if not updated:
+            return None
+        return self.service.update_entities(updated)
+
     def update_resources(self):
         """
-        Check and update resources if necessary
-        """
-        while True:
-            updated = self._updated_resources()
-            if updated:
-                [
-                    resource.update_pull() 
-                    for name, resource_list in self.entities.items()
-                    for resource in resource_list
-                    if resource.abs_resource_id in updated
-                ]
-            time.sleep(2)
-    
+        Check and update resources until the watcher is stopped
+        """
+        while not self._stopped.is_set():
+            try:
+                changed = self.check_for_updates() is not None
+            except Exception:
+                logger.exception('Checking the database for changes failed')
+                changed = False
+            if changed:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+            self._stopped.wait(self.interval)
+
     def watch_resources(self):
         """
         Start watcher in a new thread
         """
-        thread = threading.Thread(target=self.update_resources)
+        self._stopped.clear()
+        thread = threading.Thread(target=self.update_resources, name='update-watcher')
         thread.daemon = True
         thread.start()
 
+    def stop(self):
+        """
+        Stop the watcher after the check that is currently running
+        """
+        self._stopped.set()
+
 
 class Service:
     """
     Service for querying the database
     """
 
-    def __init__(self, db: ExistClient, manifest: Dict, watch_updates: bool = False):
+    def __init__(
+            self,
+            db: ExistClient,
+            manifest: Dict,
+            watch_updates: bool = False,
+            version: Optional[str] = None,
+            update_listeners: Iterable[Callable[[Dict[str, Set[str]]], None]] = ()
+    ):
+        """
+        :param db: Database client
+        :param manifest: The parsed config.yml
+        :param watch_updates: Whether to pull changes from the database
+        :param version: Version hash of the deployed data. If given and a
+                        snapshot directory is configured, the entities are
+                        restored from a snapshot of that version if there is
+                        one, else a snapshot is written after loading them.
+        :param update_listeners: Functions to be called with the changed
+                                 IDs whenever changes have been pulled, see
+                                 add_update_listener
+        """
         self.manifest = manifest
         self.manifest_entities = manifest['entities']
         self.db = db
-        self.entities = {
-            name: self.db.xpath(manifest["xpath"])
-            for name, manifest in self.manifest_entities.items()
-        }
         try:
             self.id_attr = self.manifest['default_id_attribute']
         except KeyError:
             self.id_attr = '{http://www.w3.org/XML/1998/namespace}id'
+        self.plans = {
+            name: ExtractionPlan(entity_manifest.get('properties', {}))
+            for name, entity_manifest in self.manifest_entities.items()
+        }
+        self.filters = {
+            name: compile_filters(entity_manifest, self.plans[name])
+            for name, entity_manifest in self.manifest_entities.items()
+        }
+        self.references = {}
+        for name, entity_manifest in self.manifest_entities.items():
+            references = compile_references(entity_manifest, self.plans[name])
+            unknown = set(references) - set(self.manifest_entities)
+            if unknown:
+                raise ValueError(f"Unknown entities referred to by {name}: {', '.join(sorted(unknown))}")
+            if references:
+                self.references[name] = references
+        try:
+            pushdown = self.manifest['pushdown']
+        except KeyError:
+            pushdown = False
+        # In pushdown mode the properties are extracted by the database,
+        # except for entities whose XPath expressions cannot be translated
+        self.pushdown_queries = {}
+        if pushdown:
+            for name, entity_manifest in self.manifest_entities.items():
+                try:
+                    self.pushdown_queries[name] = PushdownQuery(
+                        entity_manifest['xpath'], self.plans[name], self.id_attr
+                    )
+                except UnsupportedExpression as error:
+                    logger.warning('Extracting the properties of %s in Python: %s', name, error)
+        try:
+            load_workers = self.manifest['load_workers']
+        except KeyError:
+            load_workers = DEFAULT_LOAD_WORKERS
+        try:
+            snapshot_dir = self.manifest['snapshot_dir']
+        except KeyError:
+            snapshot_dir = None
+
+        self.load_times = {}
+        # Only the UpdateWatcher replaces generations, but the lock keeps
+        # concurrent updates from dropping each other's changes
+        self._update_lock = threading.Lock()
+        self.update_listeners = list(update_listeners)
+        snapshot = None
+        # The resources of entities extracted in the database are stored
+        # without their nodes, so a snapshot is only used in the same mode
+        snapshot_manifest = {'entities': self.manifest_entities, 'pushdown': sorted(self.pushdown_queries)}
+        if snapshot_dir and version:
+            snapshot = load_snapshot(snapshot_dir, version, snapshot_manifest, self.db)
+
+        if snapshot is not None:
+            loaded_at = snapshot.created
+            entities = snapshot.entities
+            metas = snapshot.metas
+        else:
+            loaded_at = datetime.now().isoformat(timespec="seconds")
+            entities, metas = self.load_entities(load_workers)
+
+        self.generation = Generation(
+            0,
+            loaded_at,
+            entities,
+            {name: self.index_resources(resources) for name, resources in entities.items()},
+            metas
+        )
+
+        if snapshot is None and snapshot_dir and version:
+            for name in self.manifest_entities:
+                self.get_entities(name)
+            save_snapshot(
+                snapshot_dir, version, snapshot_manifest, loaded_at,
+                self.generation.entities, self.generation.metas
+            )
+
+        self.watcher = None
         if watch_updates:
-            UpdateWatcher(self.db, self.entities)
+            try:
+                min_interval = self.manifest['watch_interval']
+            except KeyError:
+                min_interval = DEFAULT_WATCH_INTERVAL
+            try:
+                max_interval = self.manifest['watch_max_interval']
+            except KeyError:
+                max_interval = DEFAULT_WATCH_MAX_INTERVAL
+            # Changes made after the snapshot was taken are pulled on the first check
+            self.watcher = UpdateWatcher(
+                self.db, self, last_checked=loaded_at, min_interval=min_interval, max_interval=max_interval
+            )
+            self.watcher.watch_resources()
+
+    @property
+    def entities(self) -> Dict[str, Sequence[Resource]]:
+        """Resources by entity name, of the current generation"""
+        return self.generation.entities
+
+    @property
+    def index(self) -> Dict[str, Dict[str, Resource]]:
+        """Resources by entity ID by entity name, of the current generation"""
+        return self.generation.index
+
+    @property
+    def metas(self) -> Dict[str, List[EntityMeta]]:
+        """EntityMeta lists extracted so far, of the current generation"""
+        return self.generation.metas
+
+    def load_entity(self, entity_name: str) -> List[Resource]:
+        """
+        Query the resources of an entity from the database
+        :param entity_name: Name of the entity as configured in the manifest
+        :return: List of resources
+        """
+        started = time.perf_counter()
+        resources = self.db.xpath(self.manifest_entities[entity_name]["xpath"])
+        self.load_times[entity_name] = time.perf_counter() - started
+        logger.info(
+            'Loaded %s %s in %.2fs',
+            len(resources), entity_name, self.load_times[entity_name]
+        )
+        return resources
+
+    def load_entities(self, max_workers: int) -> Tuple[Dict[str, List[Resource]], Dict[str, List[EntityMeta]]]:
+        """
+        Query the resources of all configured entities concurrently, so that
+        loading takes as long as the slowest query rather than all of them.
+        The entities extracted in the database are only located, along with
+        the extraction of their properties, see query_entities.
+        :param max_workers: Maximum number of concurrent database queries
+        :return: Mapping of entity name to its list of resources, and to the
+                 EntityMeta list of the entities extracted in the database
+        """
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='load') as executor:
+            futures = {
+                name: executor.submit(self.query_entities if name in self.pushdown_queries else self.load_entity, name)
+                for name in self.manifest_entities
+            }
+            entities = {}
+            metas = {}
+            for name, future in futures.items():
+                if name in self.pushdown_queries:
+                    metas[name], entities[name] = future.result()
+                else:
+                    entities[name] = future.result()
+        logger.info('Loaded all entities in %.2fs', time.perf_counter() - started)
+        return entities, metas
+
+    def query_entities(self, entity_name: str) -> Tuple[List[EntityMeta], List[LazyResource]]:
+        """
+        Let the database extract the properties of an entity and locate its
+        nodes, see pushdown_service
+        :param entity_name: Name of an entity with a pushdown query
+        :return: List of entities, each modelled according to the EntityMeta
+                 model, and their resources without nodes
+        """
+        query = self.pushdown_queries[entity_name]
+        started = time.perf_counter()
+        response = self.db.query(query.query)
+        metas = query.decode(entity_name, response)
+        logger.info(
+            'Extracted %s %s in the database in %.2fs',
+            len(metas), entity_name, time.perf_counter() - started
+        )
+        return metas, query.locate(self.db, response)
+
+    def query_entity_metas(self, entity_name: str) -> List[EntityMeta]:
+        """
+        Let the database extract the properties of an entity, see pushdown_service
+        :param entity_name: Name of an entity with a pushdown query
+        :return: List of entities, each modelled according to the EntityMeta model
+        """
+        return self.query_entities(entity_name)[0]
+
+    def index_resources(self, resources: List[Resource]) -> Dict[str, Resource]:
+        """
+        Map the IDs of a list of resources to the resources
+        :param resources: Resources as queried from the database
+        :return: Mapping of entity ID to resource. Resources without an ID are
+                 left out, and for duplicate IDs the first resource wins.
+        """
+        index = {}
+        for resource in resources:
+            if isinstance(resource, LazyResource):
+                if resource.entity_id is None:
+                    continue
+                entity_id = resource.entity_id
+            else:
+                try:
+                    entity_id = str(resource.node[self.id_attr])
+                except (KeyError, TypeError):
+                    continue
+            index.setdefault(entity_id, resource)
+        return index
+
+    def update_entities(self, changes: Dict[str, Sequence[Resource]]) -> Generation:
+        """
+        Publish a new generation in which the resources of some entities
+        are replaced, the current generation is left as it is
+        :param changes: The complete new list of resources by entity name
+        :return: The new generation
+        """
+        with self._update_lock:
+            current = self.generation
+            index = {
+                **current.index,
+                **{name: self.index_resources(resources) for name, resources in changes.items()}
+            }
+            changed_ids = {
+                name: {
+                    entity_id for entity_id in current.index[name].keys() | index[name].keys()
+                    if current.index[name].get(entity_id) is not index[name].get(entity_id)
+                }
+                for name in changes
+            }
+            generation = Generation(
+                current.number + 1,
+                datetime.now().isoformat(timespec="seconds"),
+                {**current.entities, **changes},
+                index,
+                {name: metas for name, metas in current.metas.items() if name not in changes},
+                {name: filter_index for name, filter_index in current.filter_indexes.items() if name not in changes},
+                {
+                    name: self.update_reference_index(name, reference_index, changed_ids[name], index[name])
+                    if name in changes else reference_index
+                    for name, reference_index in current.reference_indexes.items()
+                },
+                {name: nodes for name, nodes in current.nodes.items() if name not in changes}
+            )
+            self.generation = generation
+        logger.info(
+            'Published generation %s with changes to %s',
+            generation.number, ', '.join(sorted(changes))
+        )
+
+        for listener in self.update_listeners:
+            try:
+                listener(changed_ids)
+            except Exception:
+                logger.exception('Update listener %r failed', listener)
+        return generation
+
+    def add_update_listener(self, listener: Callable[[Dict[str, Set[str]]], None]):
+        """
+        Register a function to be called whenever a new generation has been
+        published, with the IDs of the added, changed and removed entities
+        by entity name
+        :param listener: Function taking the changed IDs
+        """
+        self.update_listeners.append(listener)
 
-    def get_entities(self, entity_name: str) -> List[EntityMeta]:
+    def find_resource(
+            self,
+            entity_name: str,
+            entity_id: str,
+            generation: Optional[Generation] = None
+    ) -> Optional[Resource]:
+        """
+        Look up the resource of an entity by its ID
+        :param entity_name: Name of the entity as configured in the manifest
+        :param entity_id: ID of the entity
+        :param generation: Generation to look in, the current one if omitted
+        :return: The resource if found, else None. For entities extracted in
+                 the database, it is a LazyResource, see pull_resource.
+        """
+        generation = generation or self.generation
+        return generation.index[entity_name].get(entity_id)
+
+    def pull_resource(self, entity_name: str, entity_id: str) -> Optional[Resource]:
+        """
+        Look up the resource of an entity by its ID along with its node,
+        which is queried from the database for entities extracted there
+        :param entity_name: Name of the entity as configured in the manifest
+        :param entity_id: ID of the entity
+        :return: The resource if found, else None
+        """
+        resource = self.find_resource(entity_name, entity_id)
+        if isinstance(resource, LazyResource):
+            return resource.pull()
+        return resource
+
+    def get_resources(self, entity_name: str, generation: Optional[Generation] = None) -> Sequence[Resource]:
+        """
+        Get the resources of an entity along with their nodes. Those of an
+        entity extracted in the database are loaded once per generation.
+        :param entity_name: Name of the entity as configured in the manifest
+        :param generation: Generation to look in, the current one if omitted
+        :return: The resources, in the order of get_entities
+        """
+        generation = generation or self.generation
+        if entity_name not in self.pushdown_queries:
+            return generation.entities[entity_name]
+        try:
+            return generation.nodes[entity_name]
+        except KeyError:
+            pass
+        resources = tuple(self.load_entity(entity_name))
+        generation.nodes[entity_name] = resources
+        return resources
+
+    def get_entities(self, entity_name: str, fields: Optional[FieldTree] = None) -> List[EntityMeta]:
         """
         Query a list of entities by entity name
         :param entity_name: Name of the entity as configured in the manifest
+        :param fields: Properties to include as returned by helpers.parse_fields,
+                       all properties if omitted. Only the requested properties
+                       are extracted, unless all of them are at hand already.
+        :return: List of entities, each modelled according to the EntityMeta model
+        """
+        generation = self.generation
+        if fields is not None:
+            return self.get_projected_entities(entity_name, fields, generation)
+        return self._metas(entity_name, generation)
+
+    def _metas(self, entity_name: str, generation: Generation) -> List[EntityMeta]:
+        """
+        Get the EntityMeta list of an entity in a generation, extracting it
+        if it is not at hand
+        """
+        try:
+            return generation.metas[entity_name]
+        except KeyError:
+            pass
+        if entity_name in self.pushdown_queries:
+            metas = self.query_entity_metas(entity_name)
+        else:
+            metas = [
+                xml_to_entitymeta(
+                    self.plans[entity_name],
+                    entity_name,
+                    resource,
+                    self.id_attr
+                )
+                for resource in generation.entities[entity_name]
+            ]
+        generation.metas[entity_name] = metas
+        return metas
+
+    def get_projected_entities(
+            self,
+            entity_name: str,
+            fields: FieldTree,
+            generation: Optional[Generation] = None
+    ) -> List[EntityMeta]:
+        """
+        Query a list of entities with only some of their properties
+        :param entity_name: Name of the entity as configured in the manifest
+        :param fields: Properties to include as returned by helpers.parse_fields
+        :param generation: Generation to query, the current one if omitted
         :return: List of entities, each modelled according to the EntityMeta model
+        :raises ValueError: If a requested property is not in the manifest
         """
+        generation = generation or self.generation
+        plan = self.plans[entity_name].project(fields)
+        metas = generation.metas.get(entity_name)
+        if metas is None and entity_name in self.pushdown_queries:
+            # The database returns all properties at once, to be projected here
+            metas = self.query_entity_metas(entity_name)
+            generation.metas[entity_name] = metas
+        if metas is not None:
+            return [
+                EntityMeta(
+                    id=meta.id,
+                    entity=meta.entity,
+                    properties=project_properties(meta.properties, fields)
+                )
+                for meta in metas
+            ]
         return [
-            xml_to_entitymeta(
-                self.manifest_entities[entity_name],
-                entity_name,
-                resource,
-                self.id_attr
+            xml_to_entitymeta(plan, entity_name, resource, self.id_attr)
+            for resource in generation.entities[entity_name]
+        ]
+
+    def iter_entities(
+            self,
+            entity_name: str,
+            fields: Optional[FieldTree] = None,
+            offset: int = 0,
+            limit: Optional[int] = None
+    ) -> Iterator[EntityMeta]:
+        """
+        Iterate over some of the entities of an entity name, which are
+        extracted one at a time as the iterator advances, unless they are at
+        hand already
+        :param entity_name: Name of the entity as configured in the manifest
+        :param fields: Properties to include as returned by helpers.parse_fields,
+                       all properties if omitted
+        :param offset: Number of entities to skip
+        :param limit: Maximal number of entities, all remaining ones if omitted
+        :return: Iterator over the entities, in the order of get_entities
+        :raises ValueError: If a requested property is not in the manifest
+        """
+        generation = self.generation
+        plan = self.plans[entity_name]
+        if fields is not None:
+            plan = plan.project(fields)
+        stop = None if limit is None else offset + limit
+        metas = generation.metas.get(entity_name)
+        if metas is None and entity_name in self.pushdown_queries:
+            metas = self.get_entities(entity_name)
+        if metas is not None:
+            selected = itertools.islice(metas, offset, stop)
+            if fields is None:
+                return selected
+            return (
+                EntityMeta(id=meta.id, entity=meta.entity, properties=project_properties(meta.properties, fields))
+                for meta in selected
             )
-            for resource in self.entities[entity_name]
+        return (
+            xml_to_entitymeta(plan, entity_name, resource, self.id_attr)
+            for resource in itertools.islice(generation.entities[entity_name], offset, stop)
+        )
+
+    def get_filter_index(self, entity_name: str) -> FilterIndex:
+        """
+        Get the index of the filters of an entity, which is built once per
+        generation, from its EntityMeta list
+        :param entity_name: Name of the entity as configured in the manifest
+        """
+        generation = self.generation
+        try:
+            return generation.filter_indexes[entity_name]
+        except KeyError:
+            pass
+        index = FilterIndex(self.filters[entity_name], self._metas(entity_name, generation))
+        generation.filter_indexes[entity_name] = index
+        return index
+
+    def get_reference_index(self, entity_name: str) -> ReferenceIndex:
+        """
+        Get the index of the references of an entity, which is built once
+        from its EntityMeta list and then kept up to date with its changes
+        :param entity_name: Name of an entity with references in the manifest
+        """
+        generation = self.generation
+        try:
+            return generation.reference_indexes[entity_name]
+        except KeyError:
+            pass
+        index = ReferenceIndex.build(self.references[entity_name], self._metas(entity_name, generation))
+        generation.reference_indexes[entity_name] = index
+        return index
+
+    def update_reference_index(
+            self,
+            entity_name: str,
+            reference_index: ReferenceIndex,
+            changed_ids: Set[str],
+            index: Dict[str, Resource]
+    ) -> ReferenceIndex:
+        """
+        Derive the index of the references of an entity after some of its
+        entities have changed, extracting only the properties holding the
+        references of the changed entities
+        :param entity_name: Name of an entity with references in the manifest
+        :param reference_index: The index before the changes
+        :param changed_ids: IDs of the added, changed and removed entities
+        :param index: Resources by entity ID after the changes
+        :return: The new index
+        """
+        plan = self.plans[entity_name].project(reference_fields(self.references[entity_name]))
+        return reference_index.updated({
+            entity_id: xml_to_entitymeta(plan, entity_name, index[entity_id], self.id_attr)
+            if entity_id in index else None
+            for entity_id in changed_ids
+        })
+
+    def find_references(self, entity_name: str, target: str, key: str) -> Optional[Dict[str, List[str]]]:
+        """
+        Find the entities referring to an entity, e. g. the letters sent by,
+        sent to and mentioning a person
+        :param entity_name: Name of the referring entity, as configured in the manifest
+        :param target: Name of the entity referred to
+        :param key: ID of the entity referred to
+        :return: Sorted IDs of the referring entities by role, None if
+                 there is neither such an entity nor a reference to it
+        """
+        reference_index = self.get_reference_index(entity_name)
+        if (target, key) not in reference_index and self.find_resource(target, key) is None:
+            return None
+        return reference_index.lookup(target, key)
+
+    def filter_entities(
+            self,
+            entity_name: str,
+            query: FilterQuery,
+            fields: Optional[FieldTree] = None
+    ) -> List[EntityMeta]:
+        """
+        Query the entities matching filter conditions
+        :param entity_name: Name of the entity as configured in the manifest
+        :param query: Conditions as returned by filter_service.parse_filter_query
+        :param fields: Properties to include as returned by helpers.parse_fields,
+                       all properties if omitted
+        :return: Matching entities, in the order of get_entities
+        :raises ValueError: If a requested property is not in the manifest
+        """
+        if fields is not None:
+            # Raises for unknown properties before querying
+            self.plans[entity_name].project(fields)
+        metas = self.get_filter_index(entity_name).query(query)
+        if fields is None:
+            return metas
+        return [
+            EntityMeta(id=meta.id, entity=meta.entity, properties=project_properties(meta.properties, fields))
+            for meta in metas
         ]
 
+    def count_entities(self, entity_name: str) -> int:
+        """
+        Count the entities of an entity name
+        :param entity_name: Name of the entity as configured in the manifest
+        """
+        generation = self.generation
+        metas = generation.metas.get(entity_name)
+        if metas is not None:
+            return len(metas)
+        return len(generation.entities[entity_name])
+
     def get_entity(self, entity_name: str, entity_id: str, output_format: str) -> str:
         """
         Query a an entity by its entity name and ID
@@ -110,24 +840,18 @@ class Service:
         :param output_format: Output format, "xml" or "json"
         :return: Entity in specified format if found, else None
         """
-        resource = next((
-            resource for resource in self.entities[entity_name]
-            if resource.node[self.id_attr] == entity_id
-        ), None)
+        resource = self.pull_resource(entity_name, entity_id)
         if resource:
             if output_format == "xml":
                 return str(resource.node)
             elif output_format == "json":
-                output = resource.node.css_select("teiHeader").first
-                if output is None:
-                    output = resource.node
-                return xmltodict.parse(str(output))
+                return entity_to_dict(resource.node)
             else:
                 raise ValueError(
                     f"Invalid format: {output_format}."
                     f"Only 'xml' and 'json' are supported."
                 )
-        return str(resource)
+        return None
 
     def get_search_results(self, entity: str, keyword: str, width: int) -> Dict:
         """
@@ -245,10 +969,7 @@ class Service:
         :param stylesheet: XSLT Stylesheet as received via the POST request body
         :return:
         """
-        entity = next((
-            resource for resource in self.entities[entity_name]
-            if resource.node[self.id_attr] == entity_id
-        ), None)
+        entity = self.pull_resource(entity_name, entity_id)
         stylesheet = self.sanitize_stylesheet(stylesheet.decode())
         try:
             xslt_root = etree.XML(stylesheet)
@@ -0,0 +1,312 @@
+"""
+Extraction of entity properties within eXist-db.
+
+By default the EntityMeta lists are extracted in Python from the entity
+nodes loaded at startup. In pushdown mode, the extraction plan of an entity
+is translated into a single XQuery instead, which evaluates the XPath
+expressions of the manifest in the database and returns only the selected
+values, in a compact XML structure:
+
+    <e id="..." absid="..." nodeid="..." path="...">  one per entity node
+      <p>                  one per property, in the order of the manifest
+        <v>...</v>         one per value
+        <o><p>...</p></o>  one per object of nested properties
+      </p>
+    </e>
+
+Values are shipped as the strings Python would start from, the text content
+of a node or the values of its attributes, and are finished in Python: the
+whitespace normalization of the database differs from the one of Python,
+and only some filters can be evaluated in the database (see XQUERY_FILTERS).
+For other filters the selected node itself is shipped. Node tests and '//'
+steps are translated such that the values come in the order of delb's own
+evaluation, so the results are the same as those of Python extraction.
+
+The entity nodes themselves are not loaded at startup then. The query
+locates each of them like ExistClient.xpath does, so that the Service can
+hold a LazyResource in its place and query the node when it is needed.
+"""
+
+import itertools
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from lxml import etree
+from snakesist.exist_client import ExistClient, NodeResource as Resource, QueryResultItem
+
+from models import EntityMeta
+from .helpers import (
+    STEP_PATTERN, ExtractionPlan, PropertyPlan, Step, ValueExtractor, normalize_whitespace, wrap_element
+)
+
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+
+# Filters of filters.Functions which can be evaluated in the database, as
+# XQuery expressions taking the variable of the selected node
+XQUERY_FILTERS = {
+    'get_substring_100': 'substring(string({node}), 1, 100)',
+    'get_node_name': 'local-name({node})',
+}
+
+DISTINCT_FUNCTION = '''declare function local:distinct($nodes as node()*) as node()* {
+  for $node at $position in $nodes
+  where empty(subsequence($nodes, 1, $position - 1)[. is $node])
+  return $node
+};
+'''
+
+
+class UnsupportedExpression(ValueError):
+    """
+    Raised for manifest XPath expressions that cannot be translated
+    """
+
+
+def _string_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _attribute_selector(node: str, namespace_var: str, name: str) -> str:
+    """
+    Select an attribute the way delb looks it up: a name in the default
+    namespace of the node is looked up without namespace
+    :param node: Variable of the node
+    :param namespace_var: Variable holding the default namespace of the node
+    :param name: Attribute name, namespaced ones in Clark notation
+    """
+    if not name.startswith('{'):
+        return f'{node}/@{name}'
+    namespace, local_name = name[1:].split('}', 1)
+    if namespace == XML_NAMESPACE:
+        return f'{node}/@xml:{local_name}'
+    namespace = _string_literal(namespace)
+    return (
+        f"{node}/@*[local-name() = {_string_literal(local_name)}]"
+        f"[namespace-uri() = (if ({namespace_var} = {namespace}) then '' else {namespace})]"
+    )
+
+
+def _sequence(expressions: Iterable[str]) -> str:
+    return '(' + ', '.join(expressions) + ')'
+
+
+class LazyResource(Resource):
+    """
+    Resource of an entity extracted in the database, located by the IDs of
+    its document and node, without the node itself
+    """
+
+    def __init__(self, exist_client: ExistClient, query_result: QueryResultItem, entity_id: Optional[str]):
+        """
+        :param exist_client: Database client the node is queried from
+        :param query_result: The IDs and path of the resource, without node
+        :param entity_id: ID of the entity, None if it has none
+        """
+        super().__init__(exist_client, query_result)
+        self.entity_id = entity_id
+
+    def pull(self) -> Optional[Resource]:
+        """
+        Query the node of the resource
+        :return: The resource with its node, None if it is gone from the database
+        """
+        response = self._exist_client.query(
+            f"util:node-by-id(util:get-resource-by-absolute-id({int(self.abs_resource_id)}), "
+            f"{_string_literal(self.node_id)})"
+        )
+        if not len(response):
+            return None
+        return Resource(
+            self._exist_client,
+            QueryResultItem(self.abs_resource_id, self.node_id, self.document_path, wrap_element(response[0]))
+        )
+
+
+class PushdownQuery:
+    """
+    The extraction plan of an entity, translated into an XQuery
+    """
+
+    def __init__(self, entity_xpath: str, plan: ExtractionPlan, id_attrib: str):
+        """
+        :param entity_xpath: XPath expression selecting the entity nodes
+        :param plan: Extraction plan compiled from the property manifest of the entity
+        :param id_attrib: Name of the XML attribute containing the entity ID
+        :raises UnsupportedExpression: If a property XPath cannot be translated
+        """
+        self.plan = plan
+        self._variables = itertools.count()
+        self._uses_distinct = False
+        node, namespace_var = self._new_context()
+        body = (
+            f'for {node} in {entity_xpath}\n'
+            f"let {namespace_var} := string(namespace-uri-for-prefix('', {node}))\n"
+            f"return <e absid='{{util:absolute-resource-id({node})}}' nodeid='{{util:node-id({node})}}' "
+            f"path='{{util:collection-name({node}) || '/' || util:document-name({node})}}'>"
+            f'{{for $id in {_attribute_selector(node, namespace_var, id_attrib)} '
+            f'return attribute id {{string($id)}}}}{self._plan(plan, node, namespace_var)}</e>'
+        )
+        self.query = (DISTINCT_FUNCTION if self._uses_distinct else '') + body
+
+    def _new_context(self):
+        number = next(self._variables)
+        return f'$n{number}', f'$ns{number}'
+
+    def _plan(self, plan: ExtractionPlan, node: str, namespace_var: str) -> str:
+        return ''.join(
+            f'<p>{self._property(property_plan, node, namespace_var)}</p>'
+            for _, property_plan in plan.properties
+        )
+
+    def _property(self, plan: PropertyPlan, node: str, namespace_var: str) -> str:
+        """
+        Translate a property plan into the content of its <p> element
+        """
+        if plan.mode == 'object':
+            return self._plan(plan.subplans, node, namespace_var)
+        if plan.mode == 'objects':
+            return ''.join(f'<o>{self._plan(subplan, node, namespace_var)}</o>' for subplan in plan.subplans)
+        selected, selected_namespace = self._new_context()
+        loop = (
+            f'for {selected} in {self._select(plan, node, namespace_var)} '
+            f"let {selected_namespace} := string(namespace-uri-for-prefix('', {selected})) "
+        )
+        if plan.mode in ('value', 'values'):
+            # Nodes without any children yield no values, whatever the XPath
+            return (
+                f'{{if (exists({node}/(*|text()))) then ({loop}'
+                f'return <v>{{{self._value(plan.extractor, selected, selected_namespace)}}}</v>) else ()}}'
+            )
+        return f'{{{loop}return <o>{self._plan(plan.subplans, selected, selected_namespace)}</o>}}'
+
+    def _value(self, extractor: ValueExtractor, node: str, namespace_var: str) -> str:
+        if extractor.attribs is not None:
+            # One marker per attribute, <m/> for a missing one
+            return _sequence(
+                f'(for $a in {_attribute_selector(node, namespace_var, attrib)} '
+                f'return <a>{{string($a)}}</a>, <m/>)[1]'
+                for attrib in extractor.attribs
+            )
+        if extractor.filter is not None:
+            try:
+                return XQUERY_FILTERS[extractor.filter_name].format(node=node)
+            except KeyError:
+                return node
+        return f'string({node})'
+
+    def _select(self, plan: PropertyPlan, node: str, namespace_var: str) -> str:
+        return _sequence(self._path(path.expression, path.steps, node, namespace_var) for path in plan.paths)
+
+    def _path(self, expression: str, steps: Optional[Sequence[Step]], node: str, namespace_var: str) -> str:
+        if expression == '.':
+            return node
+        if steps is None:
+            raise UnsupportedExpression(f'Cannot translate XPath expression: {expression}')
+        selection = None
+        for axis, node_test in steps:
+            match = STEP_PATTERN.fullmatch(node_test)
+            name, predicates = match['name'], match['predicates']
+            if name == '*':
+                test = '*'
+            else:
+                # Without a default namespace, delb matches names in any namespace
+                test = (
+                    f'*[local-name() = {_string_literal(name)}]'
+                    f"[{namespace_var} = '' or namespace-uri() = {namespace_var}]"
+                )
+            context = node if selection is None else f'$x{next(self._variables)}'
+            if axis == 'child':
+                step = f'{context}/{test}{predicates}'
+            else:
+                # Matches grouped by parent, the parents in document order
+                parent = f'$x{next(self._variables)}'
+                step = f'(for {parent} in {context}/descendant-or-self::* return {parent}/{test}{predicates})'
+            if selection is None:
+                selection = step
+            elif axis == 'child':
+                selection = f'(for {context} in {selection} return {step})'
+            else:
+                # Descendants of several contexts may overlap
+                self._uses_distinct = True
+                selection = f'local:distinct(for {context} in {selection} return {step})'
+        return selection
+
+    def decode(self, entity_name: str, response: etree._Element) -> List[EntityMeta]:
+        """
+        Build the EntityMeta list from the response of the database
+        :param entity_name: Name of the entity as configured in the manifest
+        :param response: Result of the query, as returned by ExistClient.query
+        """
+        return [
+            EntityMeta(
+                # As in xml_to_entitymeta, an entity without ID has the ID 'None'
+                id=str(element.get('id')),
+                entity=entity_name,
+                properties=_decode_plan(self.plan, element)
+            )
+            for element in response
+            if element.tag == 'e'
+        ]
+
+    @staticmethod
+    def locate(db: ExistClient, response: etree._Element) -> List[LazyResource]:
+        """
+        Build the resources of the entities from the response of the
+        database, in the order of decode
+        :param db: Database client the nodes are queried from
+        :param response: Result of the query, as returned by ExistClient.query
+        """
+        return [
+            LazyResource(
+                db,
+                QueryResultItem(element.get('absid'), element.get('nodeid'), element.get('path'), None),
+                element.get('id')
+            )
+            for element in response
+            if element.tag == 'e'
+        ]
+
+
+def _decode_plan(plan: ExtractionPlan, element: etree._Element) -> Dict:
+    return {
+        prop_name: _decode_property(property_plan, child)
+        for (prop_name, property_plan), child in zip(plan.properties, element)
+    }
+
+
+def _decode_property(plan: PropertyPlan, element: etree._Element):
+    mode = plan.mode
+    if mode == 'value' or mode == 'values':
+        values = [_decode_value(plan.extractor, value) for value in element]
+        if mode == 'values':
+            return values
+        return values[0] if values else None
+    if mode == 'object':
+        return _decode_plan(plan.subplans, element)
+    if mode == 'objects':
+        return [_decode_plan(subplan, child) for subplan, child in zip(plan.subplans, element)]
+    objects = [_decode_plan(plan.subplans, child) for child in element]
+    if mode == 'nodes_objects':
+        return objects
+    return objects.pop()
+
+
+def _decode_value(extractor: ValueExtractor, element: etree._Element) -> Optional[str]:
+    """
+    Finish a value the same way ValueExtractor.extract does
+    """
+    if extractor.attribs is not None:
+        output = None
+        for marker in element:
+            value = marker.text or '' if marker.tag == 'a' else None
+            if extractor.filter is not None:
+                output = extractor.filter(value)
+            else:
+                output = normalize_whitespace(value if value else '')
+            if output:
+                return output
+        return output
+    if extractor.filter is not None:
+        if extractor.filter_name in XQUERY_FILTERS:
+            return element.text or ''
+        return extractor.filter(wrap_element(element[0]))
+    return normalize_whitespace(element.text or '')
@@ -0,0 +1,153 @@
+"""
+Reverse index from the entries of registers to the entities referring to
+them, such as the letters sent by, sent to or mentioning a person.
+
+The references of an entity are configured in the manifest, by the entity
+referred to and the role of the reference, each with the extracted
+properties holding the keys, given as dotted paths like in the fields
+parameter:
+
+    references:
+      persons:
+        sent: ['sender']
+        received: ['recipient']
+        mentioned: ['mentioned.persons']
+      places:
+        sent: ['place.sent']
+
+A ReferenceIndex is built once from the EntityMeta list of a generation.
+When the UpdateWatcher changes some of the entities, the index of the new
+generation is derived from the one before, by extracting the references of
+the changed entities only.
+"""
+
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from models import EntityMeta
+from .filter_service import PropertyFilter
+from .helpers import ExtractionPlan, FieldTree, parse_fields
+
+# Entity referred to, key within it, and role of the reference
+Reference = Tuple[str, str, str]
+
+
+def compile_references(entity_manifest: Dict, plan: ExtractionPlan) -> Dict[str, Dict[str, List[PropertyFilter]]]:
+    """
+    Compile the references configured for an entity
+    :param entity_manifest: Manifest of the entity
+    :param plan: Extraction plan of the entity
+    :return: Properties holding the keys by role, by entity referred to
+    :raises ValueError: If a reference refers to a property missing from the manifest
+    """
+    try:
+        references = entity_manifest['references']
+    except KeyError:
+        return {}
+    return {
+        target: {
+            role: [PropertyFilter(role, {'property': path}, plan) for path in paths]
+            for role, paths in roles.items()
+        }
+        for target, roles in (references or {}).items()
+    }
+
+
+def reference_fields(references: Dict[str, Dict[str, List[PropertyFilter]]]) -> FieldTree:
+    """
+    Get the properties to extract for the references of an entity
+    :param references: References as returned by compile_references
+    :return: Requested properties as returned by helpers.parse_fields
+    """
+    return parse_fields(','.join(
+        key_filter.property for roles in references.values() for filters in roles.values() for key_filter in filters
+    ))
+
+
+class ReferenceIndex:
+    """
+    IDs of the entities referring to each key by role, by entity referred to
+    """
+
+    def __init__(
+            self,
+            references: Dict[str, Dict[str, List[PropertyFilter]]],
+            keys: Optional[Dict[str, Dict[str, Dict[str, Tuple[str, ...]]]]] = None,
+            entities: Optional[Dict[str, FrozenSet[Reference]]] = None
+    ):
+        """
+        Create an empty index, see build for an index of a list of entities
+        :param references: References as returned by compile_references
+        :param keys: Sorted IDs by role, by key, by entity referred to
+        :param entities: References by ID of the referring entity
+        """
+        self.references = references
+        self.keys = keys if keys is not None else {target: {} for target in references}
+        self.entities = entities if entities is not None else {}
+
+    @classmethod
+    def build(cls, references: Dict[str, Dict[str, List[PropertyFilter]]], metas: Iterable[EntityMeta]):
+        """
+        Index the references of a list of entities
+        :param references: References as returned by compile_references
+        :param metas: The referring entities
+        """
+        return cls(references).updated({meta.id: meta for meta in metas})
+
+    def _extract(self, meta: EntityMeta) -> FrozenSet[Reference]:
+        return frozenset(
+            (target, key, role)
+            for target, roles in self.references.items()
+            for role, filters in roles.items()
+            for key_filter in filters
+            for key in key_filter.values(meta.properties)
+        )
+
+    def updated(self, changes: Dict[str, Optional[EntityMeta]]) -> 'ReferenceIndex':
+        """
+        Derive the index after some entities have changed, this index is
+        left as it is. Only the keys whose references changed are copied.
+        :param changes: The changed entities by ID, None for removed ones
+        :return: The new index
+        """
+        entities = dict(self.entities)
+        # Entities added to and removed from the references to each key
+        added: Dict[Tuple[str, str], Dict[str, Set[str]]] = {}
+        removed: Dict[Tuple[str, str], Dict[str, Set[str]]] = {}
+        for entity_id, meta in changes.items():
+            before = entities.pop(entity_id, frozenset())
+            after = self._extract(meta) if meta is not None else frozenset()
+            if after:
+                entities[entity_id] = after
+            for target, key, role in before - after:
+                removed.setdefault((target, key), {}).setdefault(role, set()).add(entity_id)
+            for target, key, role in after - before:
+                added.setdefault((target, key), {}).setdefault(role, set()).add(entity_id)
+
+        keys = {target: dict(by_key) for target, by_key in self.keys.items()}
+        for target, key in added.keys() | removed.keys():
+            roles = {role: set(ids) for role, ids in keys[target].get(key, {}).items()}
+            for role, ids in removed.get((target, key), {}).items():
+                roles[role] -= ids
+            for role, ids in added.get((target, key), {}).items():
+                roles.setdefault(role, set()).update(ids)
+            roles = {role: tuple(sorted(ids)) for role, ids in roles.items() if ids}
+            if roles:
+                keys[target][key] = roles
+            else:
+                keys[target].pop(key, None)
+        return ReferenceIndex(self.references, keys, entities)
+
+    def __contains__(self, reference: Tuple[str, str]) -> bool:
+        target, key = reference
+        return key in self.keys.get(target, {})
+
+    def lookup(self, target: str, key: str) -> Dict[str, List[str]]:
+        """
+        Find the entities referring to a key
+        :param target: Name of the entity referred to
+        :param key: ID of the entity referred to
+        :return: Sorted IDs of the referring entities by role, with every
+                 configured role
+        """
+        found = self.keys[target].get(key, {})
+        return {role: list(found.get(role, ())) for role in self.references[target]}
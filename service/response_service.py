@@ -0,0 +1,303 @@
+"""
+Responses encoded once and served from the cache as they are.
+
+The endpoints cache the encoded body of a response rather than the values
+it is built from, so that a cached response is sent without validating and
+encoding its content again.
+
+Every encoded body has a strong ETag, a digest of its content, so that it
+changes exactly when the data of the response changes, whether by a new
+deployment or by changes pulled from the database. Clients revalidate their
+copies with If-None-Match and get a 304 Not Modified response while the
+data is unchanged.
+
+Larger bodies stored in the response cache are compressed once as well,
+with gzip and brotli at high levels, see precompress. Bodies built for a
+single response are compressed with gzip at a low level when they are
+sent, if the client accepts it. The variant sent is negotiated from the
+Accept-Encoding header of the request.
+"""
+
+import gzip
+import hashlib
+from xml.sax.saxutils import escape
+from typing import Any, Dict, Iterable, Iterator, Optional, Sequence
+
+import brotli
+import pydantic_core
+from starlette.requests import Request
+from starlette.responses import Response
+
+JSON_MEDIA_TYPE = 'application/json'
+XML_MEDIA_TYPE = 'application/xml'
+TEXT_MEDIA_TYPE = 'text/plain; charset=utf-8'
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+# Clients and proxies may store responses, but have to revalidate them
+CACHE_CONTROL = 'public, no-cache'
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESSED_SIZE = 1024
+GZIP_LEVEL = 9
+# Level of bodies compressed for a single response, which pay it on each request
+GZIP_FAST_LEVEL = 1
+# The highest quality 11 takes about 50 times longer for a few percent less
+BROTLI_QUALITY = 9
+# Content codings in order of preference, if the client accepts both equally
+ENCODINGS = ('br', 'gzip')
+
+
+class EncodedResponse:
+    """
+    The encoded body of a response along with its media type and, once it
+    is cached, its compressed variants
+    """
+
+    def __init__(self, body: bytes, media_type: str):
+        """
+        :param body: Response body as sent
+        :param media_type: Value of the Content-Type header
+        """
+        self.body = body
+        self.media_type = media_type
+        self.etag = make_etag(body)
+        # Compressed bodies by content coding, see precompress
+        self.variants: Dict[str, bytes] = {}
+        self.precompressed = False
+
+    def precompress(self):
+        """
+        Compress the body with each content coding at a high level, once,
+        for a response that is cached and sent many times
+        """
+        if not self.precompressed:
+            self.variants = compress(self.body)
+            self.precompressed = True
+
+    def variant_etag(self, encoding: Optional[str]) -> str:
+        """
+        Get the ETag of a variant, which differs from that of the body
+        :param encoding: Content coding of the variant, None for the body
+        """
+        if encoding is None:
+            return self.etag
+        return f'{self.etag[:-1]}-{encoding}"'
+
+
+def compress(body: bytes) -> Dict[str, bytes]:
+    """
+    Compress a body with each of the available content codings
+    :param body: Response body
+    :return: Compressed bodies by content coding, the ones not smaller than
+             the body left out
+    """
+    if len(body) < MIN_COMPRESSED_SIZE:
+        return {}
+    variants = {
+        'gzip': gzip.compress(body, GZIP_LEVEL, mtime=0),
+        'br': brotli.compress(body, quality=BROTLI_QUALITY),
+    }
+    return {encoding: variant for encoding, variant in variants.items() if len(variant) < len(body)}
+
+
+def precompress(value: Any):
+    """
+    Compress the encoded responses within a value about to be cached
+    :param value: Value to cache, an EncodedResponse or a tuple holding some
+    """
+    if isinstance(value, EncodedResponse):
+        value.precompress()
+    elif isinstance(value, tuple):
+        for item in value:
+            precompress(item)
+
+
+def choose_encoding(accept_encoding: Optional[str], available: Sequence[str]) -> Optional[str]:
+    """
+    Choose the content coding of a response
+    :param accept_encoding: Accept-Encoding header of the request
+    :param available: Content codings of the available variants
+    :return: The preferred content coding the client accepts, None for the
+             uncompressed body
+    """
+    if not accept_encoding or not available:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, *parameters = item.strip().split(';')
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    chosen, chosen_quality = None, 0.0
+    for encoding in ENCODINGS:
+        if encoding not in available:
+            continue
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > chosen_quality:
+            chosen, chosen_quality = encoding, quality
+    return chosen
+
+
+def make_etag(*parts: Any) -> str:
+    """
+    Compute a strong ETag
+    :param parts: Content or other values which identify the content,
+                  converted to bytes through their string representation
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return f'"{digest.hexdigest()}"'
+
+
+def is_not_modified(request: Optional[Request], etag: str) -> bool:
+    """
+    Check whether the client has a current copy of a response
+    :param request: The request, if any
+    :param etag: ETag of the current response
+    :return: True if the If-None-Match header of the request matches the ETag
+    """
+    if request is None:
+        return False
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # Weak comparison, as required for If-None-Match
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+def not_modified(etag: str, headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    Create a 304 Not Modified response
+    :param etag: ETag of the current response
+    :param headers: Headers of the current response, ETag and Cache-Control by default
+    """
+    return Response(status_code=304, headers=headers or {'ETag': etag, 'Cache-Control': CACHE_CONTROL})
+
+
+def encode_json(value: Any) -> EncodedResponse:
+    """
+    Encode a value as JSON. The serializer of pydantic encodes models like
+    EntityMeta and plain values alike, and several times faster than the
+    json module.
+    :param value: Value to encode
+    """
+    return EncodedResponse(pydantic_core.to_json(value), JSON_MEDIA_TYPE)
+
+
+def encode_xml(document: str) -> EncodedResponse:
+    """
+    Encode an XML document
+    :param document: Serialized XML
+    """
+    return EncodedResponse(document.encode('utf-8'), XML_MEDIA_TYPE)
+
+
+def encode_text(text: str) -> EncodedResponse:
+    """
+    Encode plain text
+    :param text: Text to encode
+    """
+    return EncodedResponse(text.encode('utf-8'), TEXT_MEDIA_TYPE)
+
+
+def encode_batch(items: Dict[str, Optional[EncodedResponse]], media_type: str) -> EncodedResponse:
+    """
+    Encode several items in one body, assembled from their encoded bodies
+    without parsing or serializing them again, along with the IDs of the
+    items not found. As JSON, the items are an object by ID:
+
+        {"items": {"P1": {...}, "P2": {...}}, "missing": ["P3"]}
+
+    and as XML, the items are the children of a batch element:
+
+        <batch><person xml:id="P1">...</person>...<missing><id>P3</id></missing></batch>
+
+    :param items: Encoded items by ID, in the order requested, None for
+                  the items not found
+    :param media_type: Media type of the items, JSON or XML
+    """
+    missing = [item_id for item_id, item in items.items() if item is None]
+    found = [(item_id, item) for item_id, item in items.items() if item is not None]
+    if media_type == JSON_MEDIA_TYPE:
+        body = b''.join((
+            b'{"items":{',
+            b','.join(pydantic_core.to_json(item_id) + b':' + item.body for item_id, item in found),
+            b'},"missing":',
+            pydantic_core.to_json(missing),
+            b'}',
+        ))
+    else:
+        body = b''.join((
+            b'<batch>',
+            *(item.body for _, item in found),
+            b'<missing>',
+            *(f'<id>{escape(item_id)}</id>'.encode('utf-8') for item_id in missing),
+            b'</missing></batch>',
+        ))
+    return EncodedResponse(body, media_type)
+
+
+def encode_ndjson(values: Iterable[Any]) -> Iterator[bytes]:
+    """
+    Encode values as newline delimited JSON, one line at a time
+    :param values: Values to encode, consumed as the lines are sent
+    """
+    for value in values:
+        yield pydantic_core.to_json(value) + b'\n'
+
+
+def send(
+        encoded: EncodedResponse,
+        request: Optional[Request] = None,
+        status_code: int = 200,
+        vary: Sequence[str] = ()
+) -> Response:
+    """
+    Create the response of an endpoint from an encoded body. FastAPI sends
+    responses returned by endpoints as they are, without validation against
+    the response model of the endpoint.
+    :param encoded: Encoded body. Unless it has been precompressed, it is
+                    compressed with gzip at a low level if it is large
+                    enough and the client accepts gzip.
+    :param request: The request, to choose a compressed variant and to
+                    answer with 304 Not Modified if the client has a
+                    current copy
+    :param status_code: HTTP status code. Other responses than 200 OK are
+                        sent uncompressed and without ETag.
+    :param vary: Other request headers the response depends on
+    """
+    if status_code != 200:
+        return Response(content=encoded.body, status_code=status_code, media_type=encoded.media_type)
+    if encoded.precompressed:
+        available = list(encoded.variants)
+    else:
+        available = ['gzip'] if len(encoded.body) >= MIN_COMPRESSED_SIZE else []
+    encoding = None
+    if request is not None:
+        encoding = choose_encoding(request.headers.get('accept-encoding'), available)
+    etag = encoded.variant_etag(encoding)
+    headers = {'ETag': etag, 'Cache-Control': CACHE_CONTROL}
+    if available:
+        vary = (*vary, 'Accept-Encoding')
+    if vary:
+        headers['Vary'] = ', '.join(vary)
+    if is_not_modified(request, etag):
+        return not_modified(etag, headers)
+    if encoding is None:
+        return Response(content=encoded.body, media_type=encoded.media_type, headers=headers)
+    headers['Content-Encoding'] = encoding
+    if encoded.precompressed:
+        body = encoded.variants[encoding]
+    else:
+        body = gzip.compress(encoded.body, GZIP_FAST_LEVEL, mtime=0)
+    return Response(content=body, media_type=encoded.media_type, headers=headers)
@@ -0,0 +1,167 @@
+"""
+Documents served stale while they are regenerated.
+
+Some responses take long to compute, like the CMIF document generated from
+all letters and registers. Evicting them on every change would make the
+next requests wait for the rebuild. A RevalidatedEntry is stored without
+dependency records instead, so the last good document stays cached. When
+its dependencies change, it is marked stale and regenerated in the
+background, and replaced once the new one is complete. A failed rebuild
+leaves the last good document in place.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, NamedTuple, Optional, Set
+
+from diskcache import Lock
+
+from .cache_service import LOCK_EXPIRE, LOCK_PREFIX, Entry, ResponseCache, changed_dependencies
+
+logger = logging.getLogger(__name__)
+
+
+class Generated(NamedTuple):
+    """
+    A cached value along with the time its computation started
+    """
+    value: Any
+    generated_at: float
+
+
+def _isoformat(timestamp: Optional[float]) -> Optional[str]:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp).isoformat(timespec="seconds")
+
+
+class RevalidatedEntry:
+    """
+    A cache entry which is served stale while it is regenerated
+    """
+
+    def __init__(self, cache: ResponseCache, entry: Entry):
+        """
+        :param cache: Cache the entry is stored in
+        :param entry: Key, computation and dependencies of the entry
+        """
+        self.cache = cache
+        self.key = entry.key
+        self.compute = entry.compute
+        self.depends_on = set(entry.depends_on)
+        self.error = None
+        self.failed_at = None
+        # Time the dependencies changed, None while the entry is current
+        self._stale_since = None
+        self._thread: Optional[threading.Thread] = None
+        self._rerun = False
+        self._lock = threading.Lock()
+
+    @property
+    def entry(self) -> Entry:
+        """The entry as stored, e. g. for the warm-up"""
+        return Entry(self.key, self.generate)
+
+    def generate(self) -> Generated:
+        """
+        Compute the value, in the calling thread
+        """
+        generated_at = time.time()
+        return Generated(self.compute(), generated_at)
+
+    def get(self) -> Generated:
+        """
+        Get the cached value, even if it is stale. Only if there is none, it
+        is computed in the calling thread.
+        :return: The value along with the time it was generated
+        """
+        return self.cache.get_or_set(self.key, self.generate)
+
+    def refresh(self):
+        """
+        Mark the value as stale and regenerate it in a new thread. If it is
+        being regenerated already, it is regenerated once more afterwards.
+        """
+        with self._lock:
+            if self._stale_since is None:
+                self._stale_since = time.time()
+            if self._thread is not None:
+                self._rerun = True
+                return
+            self._thread = threading.Thread(target=self._regenerate_until_current, name=f'regenerate {self.key}')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def invalidate_changes(self, changed_ids: Dict[str, Set[str]]):
+        """
+        Regenerate the value after changes to its dependencies, to be
+        registered as update listener of the Service
+        :param changed_ids: IDs of the added, changed and removed items by entity name
+        """
+        if self.depends_on.intersection(changed_dependencies(changed_ids)):
+            self.refresh()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the regeneration in progress, if any
+        :param timeout: Seconds to wait at most
+        :return: Whether the value is not being regenerated anymore
+        """
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        with self._lock:
+            return self._thread is None
+
+    def _regenerate_until_current(self):
+        while True:
+            self._regenerate()
+            with self._lock:
+                if not self._rerun:
+                    self._thread = None
+                    return
+                self._rerun = False
+
+    def _regenerate(self):
+        with self._lock:
+            stale_since = self._stale_since
+        # Other processes regenerate the value after the same changes
+        with Lock(self.cache.records, LOCK_PREFIX + self.key, expire=LOCK_EXPIRE):
+            # The copy in memory is not replaced by other processes
+            self.cache.memory.pop(self.key)
+            stored = self.cache.get(self.key)
+            if stored is not None and stale_since is not None and stored.generated_at >= stale_since:
+                generated = stored
+            else:
+                try:
+                    generated = self.generate()
+                except Exception as error:
+                    logger.exception('Regenerating %s failed, serving the last good value', self.key)
+                    with self._lock:
+                        self.error = str(error) or type(error).__name__
+                        self.failed_at = time.time()
+                    return
+                self.cache.set(self.key, generated)
+        with self._lock:
+            self.error = None
+            self.failed_at = None
+            if self._stale_since is not None and self._stale_since <= generated.generated_at:
+                self._stale_since = None
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Get the time the cached value was generated, whether it is stale or
+        being regenerated, and the error of the last failed regeneration
+        """
+        stored = self.cache.get(self.key)
+        with self._lock:
+            return {
+                'generated_at': _isoformat(stored.generated_at if stored is not None else None),
+                'stale': self._stale_since is not None,
+                'regenerating': self._thread is not None,
+                'error': self.error,
+                'failed_at': _isoformat(self.failed_at),
+            }
@@ -0,0 +1,136 @@
+"""
+Warm-start snapshots of the entities loaded by the Service.
+
+Loading every letter and register entry from eXist takes a while, and it
+happens again whenever a worker restarts. A snapshot stores the loaded
+resources and their EntityMeta lists on disk, keyed by the version hash of
+the deployed data, so that a restart on unchanged data comes up without
+touching the database. The resources of entities extracted in the database
+are stored without their nodes, as they were loaded.
+"""
+
+import logging
+import os
+import pickle
+import tempfile
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from delb import Document
+from snakesist.exist_client import NodeResource as Resource, QueryResultItem
+
+from models import EntityMeta
+from .pushdown_service import LazyResource
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the layout of the stored data changes
+SNAPSHOT_FORMAT = 2
+
+
+class Snapshot(NamedTuple):
+    created: str
+    entities: Dict[str, List[Resource]]
+    metas: Dict[str, List[EntityMeta]]
+
+
+def snapshot_path(directory: str, version: str) -> Path:
+    """
+    Get the path of the snapshot file for a data version
+    :param directory: Directory holding the snapshots
+    :param version: Version hash of the data
+    :return: Path of the snapshot file
+    """
+    return Path(directory) / f'entities-{version}.pickle'
+
+
+def save_snapshot(
+        directory: str,
+        version: str,
+        manifest: Dict,
+        created: str,
+        entities: Dict[str, List[Resource]],
+        metas: Dict[str, List[EntityMeta]]
+):
+    """
+    Write a snapshot of the loaded entities and remove those of other versions
+    :param directory: Directory holding the snapshots
+    :param version: Version hash of the data
+    :param manifest: Entity manifest the EntityMeta lists were extracted with,
+                     along with the names of the entities extracted in the database
+    :param created: ISO timestamp of the time the entities were loaded
+    :param entities: Resources by entity name
+    :param metas: EntityMeta lists by entity name
+    """
+    data = {
+        'format': SNAPSHOT_FORMAT,
+        'version': version,
+        'manifest': manifest,
+        'created': created,
+        'entities': {
+            name: [
+                (
+                    resource.abs_resource_id, resource.node_id, resource.document_path,
+                    None if isinstance(resource, LazyResource) else str(resource.node),
+                    resource.entity_id if isinstance(resource, LazyResource) else None
+                )
+                for resource in resources
+            ]
+            for name, resources in entities.items()
+        },
+        'metas': metas,
+    }
+    path = snapshot_path(directory, version)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Other workers might read the snapshot while it is written, so it is
+    # written to a temporary file first and then moved in place
+    with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as snapshot_file:
+        pickle.dump(data, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(snapshot_file.name, path)
+
+    for stale in path.parent.glob('entities-*.pickle'):
+        if stale != path:
+            stale.unlink(missing_ok=True)
+    logger.info('Wrote snapshot of data version %s to %s', version, path)
+
+
+def load_snapshot(directory: str, version: str, manifest: Dict, db) -> Optional[Snapshot]:
+    """
+    Read the snapshot of a data version
+    :param directory: Directory holding the snapshots
+    :param version: Version hash of the data
+    :param manifest: Entity manifest of the Service, as passed to save_snapshot,
+                     a snapshot taken with a different manifest is not used
+    :param db: Database client the restored resources are coupled to
+    :return: The snapshot, or None if there is no usable one
+    """
+    path = snapshot_path(directory, version)
+    try:
+        with path.open('rb') as snapshot_file:
+            data = pickle.load(snapshot_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as error:
+        logger.warning('Ignoring unreadable snapshot %s: %s', path, error)
+        return None
+
+    if (
+        data.get('format') != SNAPSHOT_FORMAT
+        or data.get('version') != version
+        or data.get('manifest') != manifest
+    ):
+        return None
+
+    entities = {
+        name: [
+            LazyResource(db, QueryResultItem(abs_resource_id, node_id, document_path, None), entity_id)
+            if xml is None else
+            Resource(db, QueryResultItem(abs_resource_id, node_id, document_path, Document(xml).root))
+            for abs_resource_id, node_id, document_path, xml, entity_id in resources
+        ]
+        for name, resources in data['entities'].items()
+    }
+    logger.info('Read snapshot of data version %s from %s', version, path)
+    return Snapshot(created=data['created'], entities=entities, metas=data['metas'])
+
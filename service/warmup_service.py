@@ -0,0 +1,158 @@
+"""
+Warm-up of the response cache.
+
+After a deployment, the first requests to each endpoint would have to wait
+for the collections to be extracted and the derived documents to be
+generated. The warm-up computes the cached responses in the background
+instead, once at startup and again whenever the UpdateWatcher evicted some
+of them. Entries which are cached already are skipped, so a warm-up after
+a change only computes the evicted ones.
+"""
+
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+from .cache_service import Entry, ResponseCache
+
+logger = logging.getLogger(__name__)
+
+
+class WarmUp:
+    """
+    Computes the entries of a response cache in a background thread
+    """
+
+    def __init__(self, cache: ResponseCache, entries: Callable[[], Iterable[Entry]]):
+        """
+        :param cache: The response cache to fill
+        :param entries: Function listing the entries to compute, called
+                        anew for every run, most important entries first
+        """
+        self.cache = cache
+        self.entries = entries
+        self.runs = 0
+        self.total = 0
+        self.done = 0
+        self.computed = 0
+        self.failed = 0
+        self.started_at = None
+        self.finished_at = None
+        self._thread: Optional[threading.Thread] = None
+        self._rerun = False
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        """Whether the cache has been warmed up once"""
+        return self.runs > 0
+
+    @property
+    def running(self) -> bool:
+        """Whether a warm-up is in progress"""
+        with self._lock:
+            return self._thread is not None
+
+    def start(self):
+        """
+        Start a warm-up in a new thread. If one is in progress, another one
+        follows it, so that entries evicted in the meantime are computed.
+        """
+        with self._lock:
+            if self._thread is not None:
+                self._rerun = True
+                return
+            self._thread = threading.Thread(target=self._run_until_done, name='cache-warm-up')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def warm_up_changes(self, changed_ids: Dict[str, Set[str]]):
+        """
+        Start a warm-up after changes to entities, to be registered as update
+        listener of the Service after ResponseCache.invalidate_changes
+        :param changed_ids: IDs of the added, changed and removed items by entity name
+        """
+        self.start()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the warm-up in progress, if any
+        :param timeout: Seconds to wait at most
+        :return: Whether no warm-up is in progress anymore
+        """
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        return not self.running
+
+    def _run_until_done(self):
+        while True:
+            try:
+                self.run()
+            except Exception:
+                logger.exception('Cache warm-up failed')
+            with self._lock:
+                if not self._rerun:
+                    self._thread = None
+                    return
+                self._rerun = False
+
+    def run(self):
+        """
+        Compute the entries which are not cached, in the calling thread. An
+        entry failing to compute is logged and skipped. Only the entries
+        computed by this run are counted, not those another thread or process
+        stored while this one waited for them.
+        """
+        entries = list(self.entries())
+        with self._lock:
+            self.total = len(entries)
+            self.done = self.computed = self.failed = 0
+            self.started_at = datetime.now().isoformat(timespec="seconds")
+            self.finished_at = None
+        for key, compute, depends_on in entries:
+            computed = failed = False
+            if key not in self.cache:
+                calls = []
+
+                def counted_compute(compute=compute):
+                    calls.append(1)
+                    return compute()
+
+                try:
+                    self.cache.get_or_set(key, counted_compute, depends_on)
+                    computed = bool(calls)
+                except Exception:
+                    logger.exception('Warming up %s failed', key)
+                    failed = True
+            with self._lock:
+                self.computed += computed
+                self.failed += failed
+                self.done += 1
+        with self._lock:
+            self.runs += 1
+            self.finished_at = datetime.now().isoformat(timespec="seconds")
+            computed, failed = self.computed, self.failed
+        logger.info(
+            'Warmed up the response cache: %s of %s entries computed, %s failed',
+            computed, len(entries), failed
+        )
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Get the progress of the current or last warm-up
+        """
+        with self._lock:
+            return {
+                'ready': self.runs > 0,
+                'running': self._thread is not None,
+                'runs': self.runs,
+                'total': self.total,
+                'done': self.done,
+                'computed': self.computed,
+                'failed': self.failed,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
@@ -0,0 +1,119 @@
+"""
+Stand-ins for eXist-db, so that the Service can be tested without a database,
+and the connection to a database holding the edition for the tests which
+need one
+"""
+
+import os
+
+import pytest
+from delb import Document
+from lxml import etree
+from snakesist.exist_client import XML_NAMESPACE, ExistClient, NodeResource, QueryResultItem
+
+import yaml
+
+# Shared with the benchmarks
+from fixtures.tei import letter_xml, person_xml  # noqa: F401
+
+with open('config.yml', 'r') as config_file:
+    CFG = yaml.load(config_file, Loader=yaml.FullLoader)
+
+LETTERS_XPATH = CFG['entities']['letters']['xpath']
+PERSONS_XPATH = CFG['entities']['persons']['xpath']
+PLACES_XPATH = CFG['entities']['places']['xpath']
+WORKS_XPATH = CFG['entities']['works']['xpath']
+COMMENTS_XPATH = CFG['entities']['comments']['xpath']
+
+EMPTY_RESPONSE = '<exist:result xmlns:exist="http://exist.sourceforge.net/NS/exist"/>'
+
+
+# Marks tests which run against the data of the edition, e. g.
+# EXIST_HOST=localhost EXIST_PORT=8071 python -m pytest -k edition
+needs_exist = pytest.mark.skipif(
+    'EXIST_HOST' not in os.environ, reason='Needs an eXist-db with the data, given by EXIST_HOST'
+)
+
+
+def connect_exist() -> ExistClient:
+    """Connect to the database given by the EXIST_* environment variables"""
+    db = ExistClient(
+        host=os.environ['EXIST_HOST'],
+        port=int(os.environ.get('EXIST_PORT', 8080)),
+        user=os.environ.get('EXIST_USER', 'admin'),
+        password=os.environ.get('EXIST_PASSWORD', ''),
+        parser=etree.XMLParser(recover=True),
+    )
+    db.root_collection = CFG['collection']
+    return db
+
+
+def make_resource(xml: str, abs_resource_id: str = '1', node_id: str = '1', client=None) -> NodeResource:
+    """Wrap an XML string into a resource as returned by ExistClient.xpath"""
+    return NodeResource(
+        client,
+        QueryResultItem(abs_resource_id, node_id, f'/db/test/{abs_resource_id}.xml', Document(xml).root)
+    )
+
+
+class FakeExistClient:
+    """
+    Answers the XPath queries of the Service with prepared resources
+    """
+
+    root_collection = '/db/test'
+
+    def __init__(self, results=None, query_results=None):
+        self.results = results or {}
+        # Responses to XQuery expressions, by expression for those which the
+        # Service might send concurrently, else in the order of the queries
+        self.query_results = query_results or {}
+        self.responses = []
+        self.queries = []
+
+    def xpath(self, expression: str):
+        self.queries.append(expression)
+        return list(self.results.get(expression, []))
+
+    def query(self, expression: str):
+        self.queries.append(expression)
+        try:
+            return self.query_results[expression]
+        except KeyError:
+            pass
+        if self.responses:
+            return self.responses.pop(0)
+        return etree.fromstring(EMPTY_RESPONSE)
+
+
+def changes_response(modified=(), count=0, resources=None):
+    """
+    Build the response of eXist to the query of the UpdateWatcher for changes
+    :param modified: IDs of the modified documents
+    :param count: Number of documents in the collection
+    :param resources: (abs_resource_id, XML) pairs by entity name
+    """
+    results = ''.join(
+        f'<snakesist:result entity="{name}" nodeid="1" absid="{abs_resource_id}" path="/db/test/{abs_resource_id}.xml">'
+        f'{xml}</snakesist:result>'
+        for name, entity_resources in (resources or {}).items()
+        for abs_resource_id, xml in entity_resources
+    )
+    return etree.fromstring(
+        f'<exist:result xmlns:exist="http://exist.sourceforge.net/NS/exist" xmlns:snakesist="{XML_NAMESPACE}">'
+        f'<snakesist:modified>{" ".join(modified)}</snakesist:modified>'
+        f'<snakesist:count>{count}</snakesist:count>'
+        f'{results}</exist:result>'
+    )
+
+
+def documents_response(existing=()):
+    """
+    Build the response of eXist to the query of the UpdateWatcher for all documents
+    :param existing: IDs of all documents
+    """
+    return etree.fromstring(
+        f'<exist:result xmlns:exist="http://exist.sourceforge.net/NS/exist" xmlns:snakesist="{XML_NAMESPACE}">'
+        f'<snakesist:existing>{" ".join(existing)}</snakesist:existing>'
+        f'</exist:result>'
+    )
@@ -0,0 +1,72 @@
+from models import EntityMeta
+from service.aggregate_service import (
+    AggregateQuery, Correspondence, correspondence_from_meta, correspondences_from_letter_index, count_network,
+    count_places, count_timeline, select
+)
+
+LETTERS = [
+    Correspondence(('P1',), ('P2',), 'L1', 'L2', '1860'),
+    Correspondence(('P1',), ('P2', 'P3'), 'L1', None, '1861'),
+    Correspondence(('P2',), ('P1',), 'L2', 'L1', '1861'),
+    Correspondence(('P3',), ('P1',), None, 'L1', None),
+]
+
+
+def test_correspondence_from_meta():
+    meta = EntityMeta(id='B1', entity='letters', properties={
+        'sender': ['P1'], 'recipient': ['P2', 'P3'], 'place': {'sent': 'L1', 'received': None}, 'date': '1860-12-16',
+    })
+
+    assert correspondence_from_meta(meta) == Correspondence(('P1',), ('P2', 'P3'), 'L1', None, '1860')
+    assert correspondence_from_meta(EntityMeta(id='B2', entity='letters', properties={})) == Correspondence(
+        (), (), None, None, None
+    )
+
+
+def test_correspondences_from_letter_index():
+    def person(name, gnd_name=''):
+        return {'name': name, 'gnd_name': gnd_name, 'gnd': None, 'birth': None, 'death': None}
+
+    letter_index = {'letters': [
+        {
+            'senders': [person('Gregorovius', 'Gregorovius, Ferdinand')], 'recipients': [person('Thile')],
+            'placename_sent': 'Rom', 'placename_received': '', 'date_index': '1860-12-16',
+        },
+        {
+            'senders': [person('Thile')], 'recipients': [person('Gregorovius', 'Gregorovius, Ferdinand')],
+            'placename_sent': '', 'placename_received': 'Rom', 'date_index': '9999-99-99',
+        },
+    ]}
+
+    assert correspondences_from_letter_index(letter_index) == [
+        Correspondence(('Gregorovius, Ferdinand',), ('Thile',), 'Rom', None, '1860'),
+        Correspondence(('Thile',), ('Gregorovius, Ferdinand',), None, 'Rom', None),
+    ]
+
+
+def test_select():
+    assert select(LETTERS, AggregateQuery()) == LETTERS
+    assert select(LETTERS, AggregateQuery(year_from='1861')) == LETTERS[1:3]
+    assert select(LETTERS, AggregateQuery(year_to='1860')) == LETTERS[:1]
+    assert select(LETTERS, AggregateQuery(person='P3')) == [LETTERS[1], LETTERS[3]]
+    assert select(LETTERS, AggregateQuery(year_from='1861', person='P3')) == [LETTERS[1]]
+
+
+def test_count_aggregates():
+    assert count_network(LETTERS) == {
+        'total': 4,
+        'nodes': [
+            {'id': 'P1', 'sent': 2, 'received': 2},
+            {'id': 'P2', 'sent': 1, 'received': 2},
+            {'id': 'P3', 'sent': 1, 'received': 1},
+        ],
+        'edges': [
+            {'source': 'P1', 'target': 'P2', 'count': 2},
+            {'source': 'P1', 'target': 'P3', 'count': 1},
+            {'source': 'P2', 'target': 'P1', 'count': 1},
+            {'source': 'P3', 'target': 'P1', 'count': 1},
+        ],
+    }
+    assert count_timeline(LETTERS) == {'total': 4, 'years': {'1860': 1, '1861': 2}, 'undated': 1}
+    assert count_places(LETTERS) == {'total': 4, 'sent': {'L1': 2, 'L2': 1}, 'received': {'L1': 2, 'L2': 1}}
+    assert list(count_places(LETTERS)['received']) == ['L1', 'L2']
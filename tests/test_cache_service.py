@@ -0,0 +1,341 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from diskcache import Cache
+
+from service import cache_service
+
+from service import Service
+from service.cache_service import (
+    ResponseCache, cache_namespace, changed_dependencies, entity_dependency, item_dependency, key_prefix,
+    open_response_cache, reclaim_namespaces
+)
+from tests.fakes import CFG, FakeExistClient, LETTERS_XPATH, PERSONS_XPATH, letter_xml, make_resource, person_xml
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with Cache(str(tmp_path)) as disk_cache:
+        yield ResponseCache(disk_cache)
+
+
+def fill(cache):
+    cache.set('/letters', ['B1', 'B2'], depends_on=[entity_dependency('letters')])
+    cache.set('/letters?fields=title', ['B1', 'B2'], depends_on=[entity_dependency('letters')])
+    cache.set('/letters/B1?format=json', {'B1': 1}, depends_on=[item_dependency('letters', 'B1')])
+    cache.set('/letters/B2?format=json', {'B2': 2}, depends_on=[item_dependency('letters', 'B2')])
+    cache.set('/persons', ['P1'], depends_on=[entity_dependency('persons')])
+    cache.set(
+        '/cmif', '<TEI/>',
+        depends_on=[entity_dependency(name) for name in ('letters', 'persons', 'places')]
+    )
+    cache.set('/facsimiles', {})
+
+
+def test_changed_dependencies():
+    assert changed_dependencies({'letters': {'B2', 'B1'}, 'persons': set()}) == [
+        'letters', 'letters/B1', 'letters/B2', 'persons'
+    ]
+
+
+def test_invalidate_evicts_dependent_entries_only(cache):
+    fill(cache)
+
+    evicted = cache.invalidate([item_dependency('letters', 'B2'), entity_dependency('letters')])
+
+    assert evicted == ['/cmif', '/letters', '/letters/B2?format=json', '/letters?fields=title']
+    assert cache.get('/letters/B1?format=json') == {'B1': 1}
+    assert cache.get('/persons') == ['P1']
+    assert cache.get('/facsimiles') == {}
+    assert cache.invalidate([entity_dependency('letters')]) == []
+
+
+def test_get_or_set_computes_missing_entries_once(cache):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {'B9': 9}
+
+    assert cache.get_or_set('/letters/B9?format=json', compute, [item_dependency('letters', 'B9')]) == {'B9': 9}
+    assert cache.get_or_set('/letters/B9?format=json', compute, [item_dependency('letters', 'B9')]) == {'B9': 9}
+    assert len(calls) == 1
+
+
+def test_unknown_items_are_not_cached(cache):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return None
+
+    for _ in range(2):
+        assert cache.get_or_set('/letters/spam?format=json', compute, [item_dependency('letters', 'spam')]) is None
+
+    assert len(calls) == 2
+    assert '/letters/spam?format=json' not in cache
+    assert cache.records.get(cache_service.DEPENDENCY_PREFIX + item_dependency('letters', 'spam')) is None
+
+
+def test_dependency_records_are_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_service, 'RECORD_PRUNE_SIZE', 10)
+    cache = ResponseCache(Cache(str(tmp_path)))
+    record_key = cache_service.DEPENDENCY_PREFIX + entity_dependency('letters')
+
+    for offset in range(25):
+        cache.set(f'/letters?offset={offset}', [], [entity_dependency('letters')])
+        # Evicted for size, without invalidation
+        if offset < 15:
+            cache.cache.delete(f'/letters?offset={offset}')
+
+    assert cache.records[record_key] == {f'/letters?offset={offset}' for offset in range(15, 25)}
+    assert cache.invalidate([entity_dependency('letters')]) == [
+        f'/letters?offset={offset}' for offset in sorted(range(15, 25), key=str)
+    ]
+
+
+def test_get_or_set_discards_values_invalidated_while_computing(cache):
+    def compute():
+        cache.invalidate([entity_dependency('letters')])
+        return ['stale']
+
+    assert cache.get_or_set('/letters', compute, [entity_dependency('letters')]) == ['stale']
+    assert cache.get('/letters') is None
+    assert cache.get_or_set('/letters', lambda: ['fresh'], [entity_dependency('letters')]) == ['fresh']
+    assert cache.get('/letters') == ['fresh']
+
+
+def test_service_updates_invalidate_cached_responses(cache):
+    db = FakeExistClient({
+        LETTERS_XPATH: [make_resource(letter_xml('B1'), '1'), make_resource(letter_xml('B2'), '2')],
+        PERSONS_XPATH: [make_resource(person_xml('P1'), '3')],
+    })
+    service = Service(db, CFG, update_listeners=[cache.invalidate_changes])
+    fill(cache)
+    letters = service.entities['letters']
+
+    service.update_entities({'letters': [letters[0], make_resource(letter_xml('B2'), '2')]})
+
+    assert cache.get('/letters') is None
+    assert cache.get('/cmif') is None
+    assert cache.get('/letters/B2?format=json') is None
+    assert cache.get('/letters/B1?format=json') == {'B1': 1}
+    assert cache.get('/persons') == ['P1']
+
+
+def test_key_prefix():
+    assert key_prefix('/letters') == '/letters'
+    assert key_prefix('/letters?fields=title') == '/letters'
+    assert key_prefix('/letters/B1?format=json') == '/letters'
+    assert key_prefix('/cmif') == '/cmif'
+
+
+def test_workers_share_the_configured_cache(tmp_path):
+    manifest = {'cache_dir': str(tmp_path), 'cache_size_limit': 2 ** 20}
+    worker_cache, other_worker_cache = open_response_cache(manifest), open_response_cache(manifest)
+
+    worker_cache.set('/letters', ['B1'], depends_on=[entity_dependency('letters')])
+
+    assert other_worker_cache.get('/letters') == ['B1']
+    assert other_worker_cache.invalidate([entity_dependency('letters')]) == ['/letters']
+    assert other_worker_cache.get('/letters') is None
+    assert worker_cache.cache.size_limit == 2 ** 20
+
+
+def test_memory_is_invalidated_after_other_workers(tmp_path):
+    manifest = {'cache_dir': str(tmp_path)}
+    worker_cache, other_worker_cache = open_response_cache(manifest), open_response_cache(manifest)
+    worker_cache.set('/letters', ['B1'], depends_on=[entity_dependency('letters')])
+    other_worker_cache.invalidate([entity_dependency('letters')])
+
+    # Until its own Service pulls the change, the worker serves its generation
+    assert worker_cache.get('/letters') == ['B1']
+    assert worker_cache.invalidate([entity_dependency('letters')]) == ['/letters']
+    assert worker_cache.get('/letters') is None
+
+
+def test_memory_is_purged_by_other_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_service, 'PURGE_CHECK_INTERVAL', 0)
+    manifest = {'cache_dir': str(tmp_path)}
+    worker_cache, other_worker_cache = open_response_cache(manifest), open_response_cache(manifest)
+    worker_cache.set('/letters', ['B1'], depends_on=[entity_dependency('letters')])
+
+    other_worker_cache.purge('/letters')
+
+    assert worker_cache.get('/letters') is None
+
+
+def test_memory_serves_hot_entries(tmp_path):
+    cache = ResponseCache(Cache(str(tmp_path)), memory_entries=2)
+    cache.set('/letters', ['B1'], depends_on=[entity_dependency('letters')])
+    cache.set('/persons', ['P1'], depends_on=[entity_dependency('persons')])
+    cache.get('/letters')
+    cache.set('/places', ['L1'], depends_on=[entity_dependency('places')])
+
+    assert cache.get('/letters') is cache.get('/letters')
+    assert cache.memory.stats() == {'entries': 2, 'max_entries': 2, 'hits': 3, 'misses': 0, 'hit_rate': 1.0}
+    # The least recently used entry was dropped from memory, but is still on disk
+    assert cache.get('/persons') == ['P1']
+    assert cache.memory.stats()['misses'] == 1
+    assert cache.stats()['/persons'] == {'hits': 1, 'memory_hits': 0, 'misses': 0, 'entries': 1}
+    assert cache.invalidate([entity_dependency('letters')]) == ['/letters']
+    assert cache.get('/letters') is None
+
+
+def test_dependency_records_are_not_evicted(tmp_path):
+    cache = open_response_cache({'cache_dir': str(tmp_path), 'cache_size_limit': 0}, 'abc')
+
+    for number in range(20):
+        cache.set(f'/letters/B{number}?format=json', 'x' * 1000, [item_dependency('letters', f'B{number}')])
+    cache.cache.cull()
+
+    assert len(cache.records) == 20
+
+
+def test_stats_by_prefix(cache):
+    fill(cache)
+    cache.get('/letters')
+    cache.get('/letters/B9?format=json')
+    cache.get_or_set('/persons', list)
+
+    stats = cache.stats()
+
+    assert set(stats) == {'/cmif', '/facsimiles', '/letters', '/persons'}
+    assert stats['/letters']['hits'] == 1
+    assert stats['/letters']['misses'] == 1
+    assert stats['/letters']['entries'] == 4
+    assert stats['/persons'] == {'hits': 1, 'memory_hits': 0, 'misses': 0, 'entries': 1}
+    assert cache.volume() > 0
+
+
+def test_purge_by_prefix(cache):
+    fill(cache)
+
+    assert cache.purge('/letters/') == ['/letters/B1?format=json', '/letters/B2?format=json']
+    assert cache.get('/letters') == ['B1', 'B2']
+    assert cache.purge('/') == ['/cmif', '/facsimiles', '/letters', '/letters?fields=title', '/persons']
+    assert cache.invalidate([entity_dependency('letters')]) == []
+
+
+def slow_computation(calls, result=('B1', 'B2')):
+    def compute():
+        calls.append(threading.current_thread().name)
+        time.sleep(0.2)
+        return list(result)
+    return compute
+
+
+def test_concurrent_misses_compute_once(cache):
+    calls = []
+    compute = slow_computation(calls)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [
+            executor.submit(cache.get_or_set, '/letters', compute, [entity_dependency('letters')])
+            for _ in range(8)
+        ]
+        results = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert results == [['B1', 'B2']] * 8
+    assert cache.get('/letters') == ['B1', 'B2']
+
+
+def test_concurrent_misses_of_workers_compute_once(tmp_path):
+    manifest = {'cache_dir': str(tmp_path)}
+    worker_caches = [open_response_cache(manifest) for _ in range(4)]
+    calls = []
+    compute = slow_computation(calls)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [
+            executor.submit(worker_cache.get_or_set, '/letters', compute, [entity_dependency('letters')])
+            for worker_cache in worker_caches
+            for _ in range(2)
+        ]
+        results = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert results == [['B1', 'B2']] * 8
+
+
+def test_concurrent_misses_share_errors(cache):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        raise ValueError('Unknown properties: bogus')
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(cache.get_or_set, '/letters?fields=bogus', compute) for _ in range(4)]
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result()
+
+    assert len(calls) == 1
+    assert cache.get_or_set('/letters?fields=bogus', lambda: ['B1']) == ['B1']
+
+
+def test_cache_namespace():
+    assert cache_namespace(CFG, 'abc') == cache_namespace(dict(CFG), 'abc')
+    assert cache_namespace(CFG, 'abc') != cache_namespace(CFG, 'abd')
+    assert cache_namespace(CFG, 'abc') != cache_namespace(dict(CFG, pushdown=True), 'abc')
+
+
+def test_restart_on_the_same_version_reuses_the_cache(tmp_path):
+    manifest = {'cache_dir': str(tmp_path)}
+    open_response_cache(manifest, 'abc').set('/letters', ['B1'], depends_on=[entity_dependency('letters')])
+
+    restarted = open_response_cache(manifest, 'abc')
+
+    assert restarted.get('/letters') == ['B1']
+    assert restarted.invalidate([entity_dependency('letters')]) == ['/letters']
+
+
+def test_restart_without_version_discards_the_cache(tmp_path):
+    manifest = {'cache_dir': str(tmp_path)}
+    open_response_cache(manifest).set('/letters', ['B1'])
+
+    assert open_response_cache(manifest).get('/letters') is None
+
+
+def test_workers_of_a_start_without_version_discard_the_cache_once(tmp_path):
+    manifest = {'cache_dir': str(tmp_path)}
+    open_response_cache(manifest, start_id='1').set('/letters', ['B1'])
+
+    worker = open_response_cache(manifest, start_id='2')
+    worker.set('/letters', ['B2'])
+    late_worker = open_response_cache(manifest, start_id='2')
+
+    assert late_worker.get('/letters') == ['B2']
+    assert open_response_cache(manifest, start_id='3').get('/letters') is None
+
+
+def test_new_version_switches_namespace(tmp_path):
+    manifest = {'cache_dir': str(tmp_path)}
+    old = open_response_cache(manifest, 'abc')
+    old.set('/letters', ['B1'])
+
+    new = open_response_cache(manifest, 'abd')
+
+    assert new.get('/letters') is None
+    assert (tmp_path / 'current').read_text() == new.namespace
+    # The old namespace is removed in the background
+    for _ in range(50):
+        if not (tmp_path / old.namespace).exists():
+            break
+        time.sleep(0.1)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['current', new.namespace]
+
+
+def test_reclaim_keeps_namespaces_after_a_newer_switch(tmp_path):
+    manifest = {'cache_dir': str(tmp_path)}
+    old = open_response_cache(manifest, 'abc')
+    new = open_response_cache(manifest, 'abd')
+    (tmp_path / old.namespace).mkdir(exist_ok=True)
+
+    assert reclaim_namespaces(str(tmp_path), old.namespace) == []
+    assert reclaim_namespaces(str(tmp_path), new.namespace) == [old.namespace]
@@ -0,0 +1,79 @@
+import asyncio
+import importlib
+import sys
+import time
+
+import pytest
+import yaml
+from snakesist import exist_client
+
+from tests.test_executor_service import SLOW_CALL, get, measure_lag
+from tests.fakes import CFG, FakeExistClient, LETTERS_XPATH, PERSONS_XPATH, letter_xml, make_resource, person_xml
+
+
+@pytest.fixture(scope='module')
+def controller(tmp_path_factory):
+    """
+    The app, serving a fake database, with its cache and snapshots in a
+    temporary directory
+    """
+    directory = tmp_path_factory.mktemp('app')
+    with open(directory / 'config.yml', 'w') as config_file:
+        yaml.dump(
+            dict(CFG, cache_dir=str(directory / 'responses'), snapshot_dir=str(directory / 'snapshots')),
+            config_file
+        )
+    db = FakeExistClient({
+        LETTERS_XPATH: [make_resource(letter_xml(f'B{number}'), str(number)) for number in range(20)],
+        PERSONS_XPATH: [make_resource(person_xml('P1'), '100')],
+    })
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(exist_client, 'ExistClient', lambda *args, **kwargs: db)
+        # The configuration is read from the working directory on import
+        monkeypatch.chdir(directory)
+        controller = importlib.import_module('app.controller')
+    controller.service.watcher.stop()
+    yield controller
+    for name in ('app', 'app.config', 'app.controller'):
+        sys.modules.pop(name, None)
+
+
+def test_slow_collection_keeps_the_event_loop_responsive(controller, monkeypatch):
+    get_entities = controller.service.get_entities
+
+    def slow_get_entities(*args, **kwargs):
+        time.sleep(SLOW_CALL)
+        return get_entities(*args, **kwargs)
+
+    monkeypatch.setattr(controller.service, 'get_entities', slow_get_entities)
+    controller.cache.purge('/letters')
+
+    statuses, lag, elapsed = asyncio.run(measure_lag(controller.app, 4, '/letters'))
+
+    assert statuses == [200] * 4
+    assert elapsed > SLOW_CALL * 0.9
+    assert lag < SLOW_CALL / 4
+
+
+def test_slow_stream_keeps_the_event_loop_responsive(controller, monkeypatch):
+    iter_entities = controller.service.iter_entities
+
+    def slow_iter_entities(*args, **kwargs):
+        for meta in iter_entities(*args, **kwargs):
+            time.sleep(SLOW_CALL / 10)
+            yield meta
+
+    monkeypatch.setattr(controller.service, 'iter_entities', slow_iter_entities)
+
+    statuses, lag, elapsed = asyncio.run(
+        measure_lag(controller.app, 4, '/letters?limit=10', [('accept', 'application/x-ndjson')])
+    )
+
+    assert statuses == [200] * 4
+    assert elapsed > SLOW_CALL * 0.9
+    assert lag < SLOW_CALL / 4
+
+
+def test_unknown_collection_parameters_are_rejected(controller):
+    assert asyncio.run(get(controller.app, '/letters?sendr=P1')) == 400
+    assert asyncio.run(get(controller.app, '/letters?sender=P1&fields=title&limit=5')) == 200
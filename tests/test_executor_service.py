@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import time
+
+from fastapi import FastAPI
+
+from service.executor_service import BlockingExecutor, open_blocking_executor
+
+# Duration of a slow call, e. g. a search in eXist
+SLOW_CALL = 0.2
+TICK = 0.005
+
+
+def slow_app(executor=None):
+    app = FastAPI()
+
+    @app.get('/search')
+    async def search():
+        if executor is None:
+            time.sleep(SLOW_CALL)
+        else:
+            await executor.run(time.sleep, SLOW_CALL)
+        return {}
+
+    return app
+
+
+async def get(app, path, headers=()):
+    messages = []
+    path, _, query_string = path.partition('?')
+
+    requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        # Streamed responses listen for a disconnect until they are sent
+        await asyncio.Future()
+
+    async def send(message):
+        messages.append(message)
+
+    await app({
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query_string.encode(),
+        'root_path': '',
+        'headers': [(name.encode(), value.encode()) for name, value in headers],
+        'server': ('testserver', 80),
+        'client': ('testclient', 50000),
+    }, receive, send)
+    return messages[0]['status']
+
+
+async def measure_lag(app, concurrent_requests, path='/search', headers=()):
+    """
+    Send concurrent requests and measure how late a timer on the same event
+    loop fires meanwhile
+    :param path: Path of the requests, with query string
+    :param headers: Header name and value pairs of the requests
+    :return: The status codes, the maximal lag and the total time in seconds
+    """
+    lags = []
+    finished = asyncio.Event()
+
+    async def tick():
+        while not finished.is_set():
+            scheduled = time.perf_counter() + TICK
+            await asyncio.sleep(TICK)
+            lags.append(time.perf_counter() - scheduled)
+
+    ticker = asyncio.create_task(tick())
+    await asyncio.sleep(TICK)
+    started = time.perf_counter()
+    statuses = await asyncio.gather(*(get(app, path, headers) for _ in range(concurrent_requests)))
+    elapsed = time.perf_counter() - started
+    finished.set()
+    await ticker
+    return statuses, max(lags), elapsed
+
+
+def test_blocking_calls_stall_the_event_loop():
+    statuses, lag, elapsed = asyncio.run(measure_lag(slow_app(), 4))
+
+    assert statuses == [200] * 4
+    # The requests are served one after the other, and the timer waits for each
+    assert lag > SLOW_CALL * 0.9
+    assert elapsed > SLOW_CALL * 4 * 0.9
+
+
+def test_executor_keeps_the_event_loop_responsive():
+    executor = BlockingExecutor(max_workers=8)
+
+    statuses, lag, elapsed = asyncio.run(measure_lag(slow_app(executor), 8))
+
+    assert statuses == [200] * 8
+    assert lag < SLOW_CALL / 4
+    assert elapsed < SLOW_CALL * 2
+
+
+def test_executor_bounds_concurrent_calls():
+    executor = BlockingExecutor(max_workers=2)
+
+    statuses, lag, elapsed = asyncio.run(measure_lag(slow_app(executor), 4))
+
+    assert statuses == [200] * 4
+    assert lag < SLOW_CALL / 4
+    assert elapsed > SLOW_CALL * 2 * 0.9
+
+
+def test_executor_size_is_configured():
+    assert open_blocking_executor({'blocking_workers': 3}).max_workers == 3
+    assert open_blocking_executor({}).max_workers == 16
+
+
+def test_iterate_pulls_chunks_in_the_thread_pool():
+    executor = BlockingExecutor(max_workers=1)
+    threads = []
+
+    def extract():
+        for number in range(5):
+            threads.append(threading.current_thread().name)
+            yield number
+
+    async def consume():
+        return [chunk async for chunk in executor.iterate(extract(), chunk_size=2)]
+
+    assert asyncio.run(consume()) == [[0, 1], [2, 3], [4]]
+    assert all(name.startswith('blocking') for name in threads)
@@ -0,0 +1,122 @@
+import random
+
+import pytest
+
+from models import EntityMeta
+from service import Service
+from service.filter_service import FilterIndex, FilterQuery, compile_filters, format_filter_query, parse_filter_query
+from service.helpers import ExtractionPlan, parse_fields
+from tests.fakes import CFG, FakeExistClient, LETTERS_XPATH, letter_xml, make_resource
+
+LETTER_PROPERTIES = CFG['entities']['letters']['properties']
+LETTER_FILTERS = {
+    'filters': {
+        'sender': {'property': 'sender'},
+        'recipient': {'property': 'recipient'},
+        'place_sent': {'property': 'place.sent'},
+        'date': {'property': 'date', 'range': True},
+    }
+}
+
+
+def letter_filters():
+    return compile_filters(LETTER_FILTERS, ExtractionPlan(LETTER_PROPERTIES))
+
+
+def letter_meta(number, sender, recipients, place, date):
+    return EntityMeta(id=f'B{number}', entity='letters', properties={
+        'sender': [sender], 'recipient': recipients, 'place': {'sent': place, 'received': None}, 'date': date,
+    })
+
+
+def test_compile_filters_rejects_unknown_properties():
+    assert compile_filters({}, ExtractionPlan(LETTER_PROPERTIES)) == {}
+    with pytest.raises(ValueError):
+        compile_filters({'filters': {'spam': {'property': 'place.spam'}}}, ExtractionPlan(LETTER_PROPERTIES))
+
+
+def test_parse_filter_query():
+    query = parse_filter_query(letter_filters(), [
+        ('sender', 'P1, P2'), ('sender', 'P3'), ('date_from', '1860'), ('date_to', '1865'),
+        ('fields', 'title'), ('place_sent', ''),
+    ], known=['fields'])
+
+    assert query == FilterQuery({'sender': {'P1', 'P2', 'P3'}}, {'date': ('1860', '1865')})
+    assert format_filter_query(query) == 'date_from=1860&date_to=1865&sender=P1,P2,P3'
+    assert parse_filter_query(letter_filters(), [('fields', 'title'), ('offset', '10')], ['fields', 'offset']) is None
+    assert parse_filter_query(letter_filters(), [('date_to', '1865')]).ranges == {'date': (None, '1865')}
+
+
+def test_parse_filter_query_rejects_unknown_parameters():
+    with pytest.raises(ValueError, match='sendr'):
+        parse_filter_query(letter_filters(), [('sendr', 'P1'), ('fields', 'title')], ['fields'])
+    # Range filters only take bounds, other filters none
+    with pytest.raises(ValueError, match='date, recipient_from, sender_to$'):
+        parse_filter_query(letter_filters(), [('recipient_from', 'P1'), ('sender_to', 'P1'), ('date', '1860')])
+
+
+def test_index_matches_a_scan():
+    randomizer = random.Random(7)
+    persons = [f'P{number}' for number in range(20)]
+    places = ['L1', 'L2', 'L3', None]
+    metas = [
+        letter_meta(
+            number,
+            randomizer.choice(persons),
+            randomizer.sample(persons, randomizer.randint(0, 2)),
+            randomizer.choice(places),
+            randomizer.choice([None, f'18{randomizer.randint(50, 80)}', f'18{randomizer.randint(50, 80)}-03-01']),
+        )
+        for number in range(500)
+    ]
+    filters = letter_filters()
+    index = FilterIndex(filters, metas)
+
+    def scan(query):
+        return [
+            meta for meta in metas
+            if all(set(filters[name].values(meta.properties)) & values for name, values in query.values.items())
+            and all(
+                any(
+                    (lower is None or value >= lower) and (upper is None or value[:len(upper)] <= upper)
+                    for value in filters[name].values(meta.properties)
+                )
+                for name, (lower, upper) in query.ranges.items()
+            )
+        ]
+
+    queries = [
+        FilterQuery({'sender': {'P1'}}, {}),
+        FilterQuery({'sender': {'P1', 'P2'}, 'recipient': {'P3'}}, {}),
+        FilterQuery({'place_sent': {'L2'}}, {'date': ('1860', '1865')}),
+        FilterQuery({}, {'date': ('1860-03', '1865')}),
+        FilterQuery({}, {'date': (None, '1855')}),
+        FilterQuery({}, {'date': ('1879', None)}),
+        FilterQuery({'sender': {'nobody'}}, {'date': (None, None)}),
+    ]
+    for query in queries:
+        assert index.query(query) == scan(query)
+    assert index.query(FilterQuery({}, {'date': ('1865', '1865')})) == [
+        meta for meta in metas if (meta.properties['date'] or '').startswith('1865')
+    ]
+
+
+def test_service_filters_entities_of_the_current_generation():
+    manifest = dict(CFG, entities=dict(CFG['entities'], letters=dict(CFG['entities']['letters'], **LETTER_FILTERS)))
+    letters = [
+        make_resource(letter_xml('B1', sender='P1', date='1860-12-16')),
+        make_resource(letter_xml('B2', sender='P2', date='1863-01-02')),
+        make_resource(letter_xml('B3', sender='P1', date='1866-05-01')),
+    ]
+    service = Service(FakeExistClient({LETTERS_XPATH: letters}), manifest)
+    query = parse_filter_query(service.filters['letters'], [('sender', 'P1'), ('date_to', '1865')])
+
+    matches = service.filter_entities('letters', query, parse_fields('date'))
+
+    assert [(meta.id, meta.properties) for meta in matches] == [('B1', {'date': '1860-12-16'})]
+    with pytest.raises(ValueError):
+        service.filter_entities('letters', query, parse_fields('spam'))
+
+    service.update_entities({'letters': [make_resource(letter_xml('B4', sender='P1', date='1861-01-01'))]})
+
+    assert [meta.id for meta in service.filter_entities('letters', query)] == ['B4']
@@ -0,0 +1,69 @@
+import random
+
+import pytest
+import xmltodict
+from delb import Document
+
+from service.json_service import entity_to_dict, node_to_dict
+from tests.fakes import CFG, connect_exist, letter_xml, needs_exist, person_xml
+
+# Number of entities of each entity compared in the database of the edition
+EDITION_SAMPLE_SIZE = 200
+
+NAMESPACED_DOCUMENTS = [
+    # namespaces declared outside the subtree, in the order they are used
+    '<TEI xmlns="t" xmlns:a="A" xmlns:b="B"><h><x b:q="1"/><y a:q="2"/></h></TEI>',
+    '<TEI xmlns="t"><h><bar xmlns:a="A" a:d="4"/></h></TEI>',
+    '<TEI xmlns="t" xmlns:a="A"><h xmlns:a="A2"><x a:q="1"/></h></TEI>',
+    '<TEI xmlns="t" xmlns:a="A"><h><x xmlns:a="A2" a:q="1"/><y a:q="1"/></h></TEI>',
+    '<r xmlns:a="A"><h><a:x/><a:y xmlns:a="A"/></h></r>',
+    '<r xmlns="t"><h xmlns=""><x/></h></r>',
+    '<r xmlns="t"><h xmlns:z="Z" xmlns="t"><x/></h></r>',
+    '<r xmlns="t" xmlns:z="Z"><h><x><y xmlns:z="Z" z:a="1"/></x><w z:b="2"/></h></r>',
+    '<r xmlns="t" xmlns:z="Z"><h><x><y xmlns:z="Z" z:a="1"/></x><x><y xmlns:z="Z" z:a="1"/></x></h></r>',
+    '<r xmlns="t"><h xmlns="u"><x><p xmlns="t"/></x></h></r>',
+    # text around comments and processing instructions
+    '<r><h a="1">x<!-- c -->y<?pi z?>z<b/>  tail <b>2</b><c>  </c><d/></h></r>',
+    '<r xmlns="t"><h><x>a &amp; b</x><x>  </x><x><y/>t</x></h></r>',
+]
+
+
+def all_nodes(xml):
+    root = Document(xml).root
+    return [root] + [node for node in root.iterate_descendants() if hasattr(node, 'local_name')]
+
+
+@pytest.mark.parametrize("xml", [letter_xml(), person_xml()] + NAMESPACED_DOCUMENTS)
+def test_node_to_dict_matches_xmltodict(xml):
+    for node in all_nodes(xml):
+        expected = xmltodict.parse(str(node))
+        # The key order becomes the member order of the JSON objects
+        assert repr(node_to_dict(node)) == repr(expected), str(node)
+
+
+def test_entity_to_dict_converts_header_of_letters():
+    letter = Document(letter_xml()).root
+    result = entity_to_dict(letter)
+    assert list(result) == ['teiHeader']
+    assert result == xmltodict.parse(str(letter.css_select('teiHeader').first))
+
+
+def test_entity_to_dict_converts_register_entries():
+    person = Document(person_xml()).root
+    assert entity_to_dict(person) == xmltodict.parse(str(person))
+
+
+@needs_exist
+def test_entity_to_dict_matches_xmltodict_for_the_edition():
+    """
+    Compare the conversion with the former one through xmltodict for a
+    sample of the letters and register entries of the edition
+    """
+    db = connect_exist()
+    randomizer = random.Random(6)
+    for entity_name, entity in CFG['entities'].items():
+        resources = db.xpath(entity['xpath'])
+        for resource in randomizer.sample(resources, min(EDITION_SAMPLE_SIZE, len(resources))):
+            header = resource.node.css_select('teiHeader').first
+            expected = xmltodict.parse(str(resource.node if header is None else header))
+            assert repr(entity_to_dict(resource.node)) == repr(expected), (entity_name, resource.abs_resource_id)
@@ -0,0 +1,202 @@
+from lxml import etree
+
+from service.json_service import entity_to_dict
+
+from service import Service
+from service.helpers import ExtractionPlan, xml_to_entitymeta
+from service.pushdown_service import DISTINCT_FUNCTION, LazyResource, PushdownQuery, UnsupportedExpression
+from tests.fakes import (
+    CFG, FakeExistClient, LETTERS_XPATH, PERSONS_XPATH, connect_exist, letter_xml, make_resource, needs_exist, person_xml
+)
+from tests.test_service import UnreachableExistClient
+
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+
+ORG_XML = (
+    '<org xmlns="http://www.tei-c.org/ns/1.0" xml:id="O1" role=" x ">'
+    '<orgName>Gesandtschaft</orgName>'
+    '</org>'
+)
+
+# Response of eXist to the pushdown query of the persons, for person_xml('P1') and ORG_XML
+PERSONS_RESPONSE = (
+    '<exist:result xmlns:exist="http://exist.sourceforge.net/NS/exist">'
+    '<e id="P1" absid="1" nodeid="1" path="/db/test/1.xml">'
+    '<p><v>person</v></p>'
+    '<p><v>http://d-nb.info/gnd/118541951</v></p>'
+    '<p><v><m/></v></p>'
+    '<p><v>1821</v></p>'
+    '<p><v>1891</v></p>'
+    '<p><p><v>Gregorovius</v></p><p><v>Ferdinand</v></p><p/><p/><p/>'
+    '<p><v><persName xmlns="http://www.tei-c.org/ns/1.0" type="reg">'
+    '<surname>Gregorovius</surname> <forename>Ferdinand</forename></persName></v></p>'
+    '<p/><p/><p/><p/></p>'
+    '</e>'
+    '<e id="O1" absid="2" nodeid="1" path="/db/test/2.xml">'
+    '<p><v>org</v></p>'
+    '<p/>'
+    '<p><v><a> x </a></v></p>'
+    '<p/>'
+    '<p/>'
+    '<p><p/><p/><p/><p/><p><v>Gesandtschaft</v></p><p/><p/><p/><p/><p/></p>'
+    '</e>'
+    '</exist:result>'
+)
+
+# Query for the node of P1, as sent by LazyResource.pull
+PULL_P1_QUERY = "util:node-by-id(util:get-resource-by-absolute-id(1), '1')"
+
+
+def persons_query():
+    return PushdownQuery(PERSONS_XPATH, ExtractionPlan(CFG['entities']['persons']['properties']), XML_ID)
+
+
+def persons_client(results=None):
+    return FakeExistClient(results, {persons_query().query: etree.fromstring(PERSONS_RESPONSE)})
+
+
+def test_query_translates_steps_in_delb_order():
+    plan = ExtractionPlan({
+        'name': {'xpath': ['./persName[@type="reg"]']},
+        'keys': {'xpath': ['.//body//persName'], 'attrib': ['key'], 'multiple': True},
+    })
+
+    query = PushdownQuery('//*:person', plan, XML_ID).query
+
+    assert query.startswith(DISTINCT_FUNCTION)
+    assert "$n0/*[local-name() = 'persName'][$ns0 = '' or namespace-uri() = $ns0][@type=\"reg\"]" in query
+    assert 'for $x3 in $n0/descendant-or-self::* return $x3/' in query
+    assert 'local:distinct(for $x4 in ' in query
+    assert 'return attribute id {string($id)}' in query
+    assert '$n0/@xml:id' in query
+
+
+def test_query_rejects_untranslatable_expressions():
+    plan = ExtractionPlan({'name': {'xpath': ['persName']}})
+    try:
+        PushdownQuery('//*:person', plan, XML_ID)
+    except UnsupportedExpression:
+        pass
+    else:
+        raise AssertionError('Expected UnsupportedExpression')
+
+
+def test_decode_matches_python_extraction():
+    query = persons_query()
+    expected = [
+        xml_to_entitymeta(query.plan, 'persons', make_resource(xml), XML_ID)
+        for xml in (person_xml('P1'), ORG_XML)
+    ]
+
+    metas = query.decode('persons', etree.fromstring(PERSONS_RESPONSE))
+
+    assert metas == expected
+    assert metas[0].properties['name']['fullName'] == 'Gregorovius, Ferdinand'
+    assert metas[1].properties['role'] == 'x'
+
+
+def test_locate_matches_decode():
+    resources = PushdownQuery.locate(None, etree.fromstring(PERSONS_RESPONSE))
+
+    assert [resource.entity_id for resource in resources] == ['P1', 'O1']
+    assert [(resource.abs_resource_id, resource.node_id) for resource in resources] == [('1', '1'), ('2', '1')]
+    assert resources[1].document_path == '/db/test/2.xml'
+    assert all(resource.node is None for resource in resources)
+
+
+def test_service_extracts_properties_in_the_database():
+    db = persons_client({
+        LETTERS_XPATH: [make_resource(letter_xml('B1'))],
+        PERSONS_XPATH: [make_resource(person_xml('P1')), make_resource(ORG_XML)],
+    })
+    service = Service(db, dict(CFG, pushdown=True))
+
+    projected = service.get_entities('persons', {'type': None})
+    metas = service.get_entities('persons')
+
+    assert [meta.properties for meta in projected] == [{'type': 'person'}, {'type': 'org'}]
+    assert [meta.id for meta in metas] == ['P1', 'O1']
+    assert persons_query().query in db.queries
+    # The entities are located along with their properties, not loaded
+    assert PERSONS_XPATH not in db.queries
+    assert len(db.queries) == len(CFG['entities'])
+    assert list(service.index['persons']) == ['P1', 'O1']
+
+
+def test_service_queries_the_node_of_a_requested_item():
+    db = persons_client()
+    service = Service(db, dict(CFG, pushdown=True))
+    db.query_results[PULL_P1_QUERY] = etree.fromstring(
+        f'<exist:result xmlns:exist="http://exist.sourceforge.net/NS/exist">{person_xml("P1")}</exist:result>'
+    )
+    queries = len(db.queries)
+
+    item = service.get_entity('persons', 'P1', 'json')
+
+    assert item == entity_to_dict(make_resource(person_xml('P1')).node)
+    assert db.queries[queries:] == [PULL_P1_QUERY]
+    assert isinstance(service.find_resource('persons', 'P1'), LazyResource)
+    assert service.get_entity('persons', 'O2', 'json') is None
+
+
+def test_service_loads_full_resources_once_per_generation():
+    db = persons_client({PERSONS_XPATH: [make_resource(person_xml('P1')), make_resource(ORG_XML)]})
+    service = Service(db, dict(CFG, pushdown=True))
+
+    resources = service.get_resources('persons')
+    again = service.get_resources('persons')
+
+    assert [str(resource.node[XML_ID]) for resource in resources] == ['P1', 'O1']
+    assert again is resources
+    assert db.queries.count(PERSONS_XPATH) == 1
+
+
+def test_service_restores_lazy_resources_from_snapshot(tmp_path):
+    manifest = dict(CFG, pushdown=True, snapshot_dir=str(tmp_path))
+    cold = Service(persons_client(), manifest, version='abc')
+
+    warm = Service(UnreachableExistClient(), manifest, version='abc')
+
+    assert warm.get_entities('persons') == cold.get_entities('persons')
+    resource = warm.find_resource('persons', 'O1')
+    assert isinstance(resource, LazyResource)
+    assert (resource.abs_resource_id, resource.node_id) == ('2', '1')
+
+
+def test_snapshot_is_not_shared_between_modes(tmp_path):
+    Service(persons_client(), dict(CFG, pushdown=True, snapshot_dir=str(tmp_path)), version='abc')
+
+    db = FakeExistClient({PERSONS_XPATH: [make_resource(person_xml('P1'))]})
+    service = Service(db, dict(CFG, snapshot_dir=str(tmp_path)), version='abc')
+
+    assert PERSONS_XPATH in db.queries
+    assert service.find_resource('persons', 'P1').node is not None
+
+
+def test_service_extracts_untranslatable_entities_in_python():
+    manifest = dict(CFG, pushdown=True)
+    manifest['entities'] = dict(
+        CFG['entities'],
+        persons=dict(CFG['entities']['persons'], properties={'name': {'xpath': ['persName']}})
+    )
+    db = FakeExistClient({PERSONS_XPATH: [make_resource(person_xml('P1'))]})
+    service = Service(db, manifest)
+
+    assert 'persons' not in service.pushdown_queries
+    assert 'letters' in service.pushdown_queries
+    assert service.get_entities('persons')[0].id == 'P1'
+    assert len(db.queries) == len(CFG['entities'])
+
+
+@needs_exist
+def test_pushdown_matches_python_extraction_for_the_edition():
+    """
+    Test the generated queries against a database holding the edition
+    """
+    db = connect_exist()
+    in_python = Service(db, CFG)
+    in_database = Service(db, dict(CFG, pushdown=True))
+
+    assert in_database.pushdown_queries
+    for entity_name in in_database.pushdown_queries:
+        assert in_database.get_entities(entity_name) == in_python.get_entities(entity_name), entity_name
@@ -0,0 +1,103 @@
+import random
+
+import pytest
+
+from models import EntityMeta
+from service import Service
+from service.helpers import ExtractionPlan
+from service.reference_service import ReferenceIndex, compile_references
+from tests.fakes import CFG, FakeExistClient, LETTERS_XPATH, PERSONS_XPATH, letter_xml, make_resource, person_xml
+
+LETTER_PROPERTIES = CFG['entities']['letters']['properties']
+LETTER_REFERENCES = {
+    'references': {
+        'persons': {'sent': ['sender'], 'received': ['recipient'], 'mentioned': ['mentioned.persons']},
+        'places': {'sent': ['place.sent']},
+    }
+}
+
+
+def letter_references():
+    return compile_references(LETTER_REFERENCES, ExtractionPlan(LETTER_PROPERTIES))
+
+
+def letter_meta(letter_id, sender, recipients, mentioned, place):
+    return EntityMeta(id=letter_id, entity='letters', properties={
+        'sender': [sender], 'recipient': recipients, 'mentioned': {'persons': mentioned}, 'place': {'sent': place},
+    })
+
+
+def scan(metas, target, key):
+    references = letter_references()[target]
+    return {
+        role: sorted(
+            meta.id for meta in metas
+            if any(key in key_filter.values(meta.properties) for key_filter in filters)
+        )
+        for role, filters in references.items()
+    }
+
+
+def random_meta(randomizer, letter_id):
+    persons = [f'P{number}' for number in range(10)]
+    return letter_meta(
+        letter_id,
+        randomizer.choice(persons),
+        randomizer.sample(persons, randomizer.randint(0, 2)),
+        randomizer.sample(persons, randomizer.randint(0, 4)),
+        randomizer.choice(['L1', 'L2', None]),
+    )
+
+
+def test_compile_references_rejects_unknown_properties():
+    assert compile_references({}, ExtractionPlan(LETTER_PROPERTIES)) == {}
+    with pytest.raises(ValueError):
+        compile_references(
+            {'references': {'persons': {'sent': ['sender.spam']}}}, ExtractionPlan(LETTER_PROPERTIES)
+        )
+
+
+def test_index_matches_a_scan_and_is_updated():
+    randomizer = random.Random(11)
+    metas = {f'B{number}': random_meta(randomizer, f'B{number}') for number in range(200)}
+    index = ReferenceIndex.build(letter_references(), metas.values())
+    before = {key: index.lookup('persons', key) for key in ('P1', 'P2')}
+
+    for key in ('P1', 'P2', 'nobody'):
+        assert index.lookup('persons', key) == scan(metas.values(), 'persons', key)
+    assert index.lookup('places', 'L1') == scan(metas.values(), 'places', 'L1')
+
+    changes = {f'B{number}': random_meta(randomizer, f'B{number}') for number in range(0, 200, 7)}
+    changes.update({'B1': None, 'B3': None, 'B500': random_meta(randomizer, 'B500')})
+    updated = index.updated(changes)
+    metas.update(changes)
+    metas = {letter_id: meta for letter_id, meta in metas.items() if meta is not None}
+
+    for key in ('P1', 'P2', 'P9'):
+        assert updated.lookup('persons', key) == scan(metas.values(), 'persons', key)
+    assert updated.lookup('places', 'L2') == scan(metas.values(), 'places', 'L2')
+    assert updated.entities.keys() == {meta.id for meta in metas.values() if index._extract(meta)}
+    # The index before the changes is left as it is
+    assert {key: index.lookup('persons', key) for key in ('P1', 'P2')} == before
+
+
+def test_service_keeps_references_up_to_date():
+    manifest = dict(CFG, entities=dict(CFG['entities'], letters=dict(CFG['entities']['letters'], **LETTER_REFERENCES)))
+    letters = [
+        make_resource(letter_xml('B1', sender='P1', recipient='P2')),
+        make_resource(letter_xml('B2', sender='P2', recipient='P1', mentioned_person='P1')),
+    ]
+    persons = [make_resource(person_xml('P1')), make_resource(person_xml('P5'))]
+    service = Service(FakeExistClient({LETTERS_XPATH: letters, PERSONS_XPATH: persons}), manifest)
+
+    assert service.find_references('letters', 'persons', 'P1') == {
+        'sent': ['B1'], 'received': ['B2'], 'mentioned': ['B2'],
+    }
+    assert service.find_references('letters', 'persons', 'P5') == {'sent': [], 'received': [], 'mentioned': []}
+    assert service.find_references('letters', 'persons', 'P9') is None
+
+    service.update_entities({'letters': [letters[0], make_resource(letter_xml('B3', sender='P9'))]})
+
+    assert service.find_references('letters', 'persons', 'P1') == {'sent': ['B1'], 'received': [], 'mentioned': []}
+    assert service.find_references('letters', 'persons', 'P9') == {'sent': ['B3'], 'received': [], 'mentioned': []}
+    assert service.find_references('letters', 'places', 'L1') == {'sent': ['B1', 'B3']}
@@ -0,0 +1,205 @@
+import gzip
+import json
+
+import brotli
+import pytest
+from lxml import etree
+from fastapi.encoders import jsonable_encoder
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from models import EntityMeta
+from service import response_service
+from service.response_service import (
+    CACHE_CONTROL, JSON_MEDIA_TYPE, XML_MEDIA_TYPE, choose_encoding, encode_batch, encode_json, encode_ndjson, encode_text, encode_xml, send
+)
+
+
+def test_encode_json_matches_fastapi():
+    metas = [
+        EntityMeta(id='B1', entity='letters', properties={'title': 'Gregorovius an Thile', 'date': None}),
+        EntityMeta(id='B2', entity='letters', properties={'mentioned': {'persons': ['P1', 'P2']}}),
+    ]
+
+    encoded = encode_json(metas)
+
+    assert encoded.body == JSONResponse(jsonable_encoder(metas)).body
+    assert encoded.media_type == JSON_MEDIA_TYPE
+
+
+def test_encode_ndjson_encodes_one_value_per_line():
+    metas = (EntityMeta(id=f'B{number}', entity='letters', properties={'title': 'Brief'}) for number in (1, 2))
+
+    lines = encode_ndjson(metas)
+
+    assert next(lines) == b'{"id":"B1","entity":"letters","properties":{"title":"Brief"}}\n'
+    assert next(lines).startswith(b'{"id":"B2"')
+    assert list(lines) == []
+
+
+def test_encode_batch_assembles_encoded_items():
+    items = {'P1': encode_json({'name': 'Thile'}), 'P<2>': None, 'P3': encode_json({'name': 'Grüße'})}
+
+    encoded = encode_batch(items, JSON_MEDIA_TYPE)
+
+    assert json.loads(encoded.body) == {'items': {'P1': {'name': 'Thile'}, 'P3': {'name': 'Grüße'}}, 'missing': ['P<2>']}
+    assert encoded.media_type == JSON_MEDIA_TYPE
+
+    items = {
+        'P1': encode_xml('<person xmlns="http://www.tei-c.org/ns/1.0" xml:id="P1"/>'),
+        'P<2>': None,
+        'P3': encode_xml('<person xmlns="http://www.tei-c.org/ns/1.0" xml:id="P3">Grüße</person>'),
+    }
+
+    batch = etree.fromstring(encode_batch(items, XML_MEDIA_TYPE).body)
+
+    assert [child.get('{http://www.w3.org/XML/1998/namespace}id') for child in batch[:-1]] == ['P1', 'P3']
+    assert batch[1].text == 'Grüße'
+    assert [element.text for element in batch.find('missing')] == ['P<2>']
+    assert json.loads(encode_batch({}, JSON_MEDIA_TYPE).body) == {'items': {}, 'missing': []}
+
+
+def test_send_encoded_response():
+    response = send(encode_xml('<TEI>Grüße</TEI>'), status_code=404)
+
+    assert response.body == '<TEI>Grüße</TEI>'.encode('utf-8')
+    assert response.status_code == 404
+    assert response.headers['content-type'] == 'application/xml'
+
+
+def make_request(**headers):
+    return Request({
+        'type': 'http',
+        'headers': [(name.replace('_', '-').encode(), value.encode()) for name, value in headers.items()],
+    })
+
+
+def test_send_with_etag():
+    encoded = encode_json({'version': 'abc'})
+
+    response = send(encoded, make_request())
+
+    assert response.status_code == 200
+    assert response.headers['etag'] == encoded.etag
+    assert response.headers['cache-control'] == CACHE_CONTROL
+    assert encode_json({'version': 'abc'}).etag == encoded.etag
+    assert encode_json({'version': 'abd'}).etag != encoded.etag
+
+
+@pytest.mark.parametrize('if_none_match', ['{etag}', 'W/{etag}', '"other", {etag}', '*'])
+def test_send_not_modified(if_none_match):
+    encoded = encode_json({'version': 'abc'})
+
+    response = send(encoded, make_request(if_none_match=if_none_match.format(etag=encoded.etag)))
+
+    assert response.status_code == 304
+    assert response.body == b''
+    assert response.headers['etag'] == encoded.etag
+
+
+def test_send_modified():
+    encoded = encode_json({'version': 'abc'})
+
+    response = send(encoded, make_request(if_none_match=encode_json({'version': 'abd'}).etag))
+
+    assert response.status_code == 200
+    assert response.body == encoded.body
+
+
+LARGE_TEXT = 'Gregorovius an Thile. ' * 200
+
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    (None, None),
+    ('', None),
+    ('gzip', 'gzip'),
+    ('gzip, br', 'br'),
+    ('br;q=0.5, gzip', 'gzip'),
+    ('*', 'br'),
+    ('*;q=0.5, br;q=0', 'gzip'),
+    ('gzip;q=0, identity', None),
+    ('deflate', None),
+])
+def test_choose_encoding(accept_encoding, expected):
+    assert choose_encoding(accept_encoding, ['gzip', 'br']) == expected
+
+
+def test_small_bodies_are_not_compressed():
+    encoded = encode_json({'version': 'abc'})
+
+    response = send(encoded, make_request(accept_encoding='gzip'))
+
+    assert encoded.variants == {}
+    assert 'content-encoding' not in response.headers
+    assert 'vary' not in response.headers
+
+
+def test_send_precompressed_variant():
+    encoded = encode_text(LARGE_TEXT)
+    encoded.precompress()
+
+    response = send(encoded, make_request(accept_encoding='gzip, deflate'), vary=['Accept'])
+    identity = send(encoded, make_request())
+
+    assert sorted(encoded.variants) == ['br', 'gzip']
+    assert response.body == encoded.variants['gzip']
+    assert response.headers['content-encoding'] == 'gzip'
+    assert response.headers['vary'] == 'Accept, Accept-Encoding'
+    assert gzip.decompress(response.body) == encoded.body
+    assert identity.body == encoded.body
+    assert identity.headers['vary'] == 'Accept-Encoding'
+    assert response.headers['etag'] != identity.headers['etag'] == encoded.etag
+
+
+def test_send_brotli_variant():
+    encoded = encode_text(LARGE_TEXT)
+    encoded.precompress()
+
+    response = send(encoded, make_request(accept_encoding='gzip, br'))
+
+    assert response.headers['content-encoding'] == 'br'
+    assert brotli.decompress(response.body) == encoded.body
+
+
+def test_send_compresses_uncached_body_on_demand(monkeypatch):
+    encoded = encode_text(LARGE_TEXT)
+
+    response = send(encoded, make_request(accept_encoding='gzip, br'))
+    identity = send(encoded, make_request(accept_encoding='br'))
+
+    assert encoded.variants == {}
+    assert response.headers['content-encoding'] == 'gzip'
+    assert gzip.decompress(response.body) == encoded.body
+    assert response.headers['etag'] == encoded.variant_etag('gzip')
+    assert identity.body == encoded.body
+    assert identity.headers['vary'] == 'Accept-Encoding'
+
+    def compress(*args, **kwargs):
+        raise AssertionError('A client with a current copy gets no body')
+
+    monkeypatch.setattr(response_service.gzip, 'compress', compress)
+    not_modified = send(encoded, make_request(accept_encoding='gzip', if_none_match=encoded.variant_etag('gzip')))
+
+    assert not_modified.status_code == 304
+
+
+def test_precompress_values_to_cache():
+    encoded = encode_text(LARGE_TEXT)
+
+    response_service.precompress((encoded, 1.0))
+
+    assert encoded.precompressed
+    assert brotli.decompress(encoded.variants['br']) == encoded.body
+
+
+def test_send_compressed_variant_not_modified():
+    encoded = encode_text(LARGE_TEXT)
+    etag = encoded.variant_etag('gzip')
+
+    response = send(encoded, make_request(accept_encoding='gzip', if_none_match=etag))
+    identity = send(encoded, make_request(if_none_match=etag))
+
+    assert response.status_code == 304
+    assert response.headers['etag'] == etag
+    assert response.headers['vary'] == 'Accept-Encoding'
+    assert identity.status_code == 200
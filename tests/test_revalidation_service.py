@@ -0,0 +1,104 @@
+import threading
+
+import pytest
+from diskcache import Cache, Lock
+
+from service.cache_service import LOCK_PREFIX, Entry, ResponseCache, entity_dependency, open_response_cache
+from service.revalidation_service import RevalidatedEntry
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with Cache(str(tmp_path)) as disk_cache:
+        yield ResponseCache(disk_cache, memory_entries=8)
+
+
+class Generator:
+    def __init__(self):
+        self.documents = iter(['<TEI n="1"/>', '<TEI n="2"/>', '<TEI n="3"/>'])
+        self.calls = 0
+        self.fail = False
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self):
+        self.calls += 1
+        self.release.wait(5)
+        if self.fail:
+            raise OSError('Database unavailable')
+        return next(self.documents)
+
+
+def cmif(cache, generator):
+    return RevalidatedEntry(
+        cache, Entry('/cmif', generator, [entity_dependency(name) for name in ('letters', 'persons', 'places')])
+    )
+
+
+def test_serves_the_last_document_while_regenerating(cache):
+    generator = Generator()
+    entry = cmif(cache, generator)
+    first = entry.get()
+    generator.release.clear()
+
+    entry.invalidate_changes({'letters': {'B1'}})
+
+    assert entry.get() == first
+    assert entry.status()['stale'] and entry.status()['regenerating']
+    generator.release.set()
+    assert entry.wait(5)
+    assert entry.get().value == '<TEI n="2"/>'
+    assert entry.get().generated_at >= first.generated_at
+    assert not entry.status()['stale']
+
+
+def test_other_changes_do_not_regenerate(cache):
+    generator = Generator()
+    entry = cmif(cache, generator)
+    entry.get()
+
+    entry.invalidate_changes({'works': {'W1'}})
+
+    assert entry.wait(5)
+    assert generator.calls == 1
+    assert cache.invalidate([entity_dependency('letters')]) == []
+
+
+def test_failed_regeneration_keeps_the_document(cache):
+    generator = Generator()
+    entry = cmif(cache, generator)
+    entry.get()
+    generator.fail = True
+
+    entry.refresh()
+
+    assert entry.wait(5)
+    assert entry.get().value == '<TEI n="1"/>'
+    status = entry.status()
+    assert status['stale']
+    assert status['error'] == 'Database unavailable'
+    assert status['failed_at'] is not None
+
+    generator.fail = False
+    entry.refresh()
+    assert entry.wait(5)
+    assert entry.get().value == '<TEI n="2"/>'
+    assert entry.status()['error'] is None
+
+
+def test_workers_adopt_a_regenerated_document(tmp_path):
+    manifest = {'cache_dir': str(tmp_path)}
+    generator = Generator()
+    worker, other_worker = (cmif(open_response_cache(manifest, 'abc'), generator) for _ in range(2))
+    worker.get()
+    other_worker.get()
+
+    # Both workers pull the change while a third one holds the lock
+    with Lock(worker.cache.records, LOCK_PREFIX + '/cmif'):
+        worker.invalidate_changes({'letters': {'B1'}})
+        other_worker.invalidate_changes({'letters': {'B1'}})
+    assert worker.wait(5) and other_worker.wait(5)
+
+    assert generator.calls == 2
+    assert worker.get().value == other_worker.get().value == '<TEI n="2"/>'
+    assert not other_worker.status()['stale']
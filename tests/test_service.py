@@ -1,6 +1,27 @@
-from service.helpers import process_properties
+import threading
+import time
+
+from service import Service
+from service.main import UpdateWatcher
+import pytest
+
+from service.helpers import (
+    CompiledPath,
+    ExtractionPlan,
+    format_fields,
+    parse_fields,
+    process_properties,
+    split_location_path,
+    unwrap_node,
+    wrap_element,
+)
 from delb import Document
 
+from tests.fakes import (
+    CFG, FakeExistClient, LETTERS_XPATH, PERSONS_XPATH, changes_response, documents_response, letter_xml,
+    make_resource, person_xml
+)
+
 
 def test_process_properties_single():
     """
@@ -220,3 +241,402 @@ def test_process_properties_multiple_nested_prop_objects():
     }
     assert process_properties(manifest, node) == properties
 
+
+NESTED_DOCUMENTS = [
+    Document(letter_xml()).root,
+    Document(
+        '<text xmlns="http://www.tei-c.org/ns/1.0"><body>'
+        '<p>a <persName key="A">A</persName> <hi><persName key="B">B</persName></hi>'
+        '<persName key="C"><persName key="D">D</persName></persName></p>'
+        '<div><p>first</p><p>second <seg><p>nested</p></seg></p></div>'
+        '</body></text>'
+    ).root,
+    Document(
+        '<root><spam>x<ham>1</ham></spam><bar><spam><ham>2</ham></spam></bar>'
+        '<spam type="t"><ham>3</ham><ham>4</ham></spam></root>'
+    ).root,
+]
+
+
+@pytest.mark.parametrize("expression", [
+    './/persName',
+    './/body//persName',
+    './/body//p[1]',
+    './/p[1]',
+    './/correspAction[@type="sent"]/persName',
+    './/titleStmt//persName/surname',
+    './/seg/note',
+    './/spam/ham',
+    './/spam[@type="t"]/ham[2]',
+    './/*',
+    './bar/spam',
+])
+def test_compiled_path_matches_delb(expression):
+    """
+    Test that compiled paths select the same nodes in the same order as delb
+    """
+    path = CompiledPath(expression)
+    assert path.steps is not None
+    for node in NESTED_DOCUMENTS:
+        assert path.select(node, {}) == list(node.xpath(expression))
+
+
+def test_wrap_element_matches_delb():
+    """
+    Test that elements are wrapped in the nodes delb uses for them, which
+    relies on an internal cache of delb
+    """
+    node = Document(letter_xml()).root
+    for descendant in node.xpath('.//persName'):
+        assert wrap_element(unwrap_node(descendant)) is descendant
+    assert wrap_element(unwrap_node(node)) is node
+
+
+def test_split_location_path_rejects_unsupported_expressions():
+    assert split_location_path('.//a[b]') is None
+    assert split_location_path('.//tei:a') is None
+    assert split_location_path('..//a') is None
+    assert split_location_path('.//a//') is None
+    assert split_location_path('./a | ./b') is None
+    assert split_location_path('.//a[@b="c/d"]/e') == [('descendant', 'a[@b="c/d"]'), ('child', 'e')]
+
+
+def test_extraction_plan_shares_steps():
+    """
+    Test that a step used by several properties is evaluated once per node
+    """
+    plan = ExtractionPlan(CFG['entities']['letters']['properties'])
+    memo = {}
+    plan.extract(Document(letter_xml()).root, memo)
+    sent = (('descendant', 'correspAction[@type="sent"]'),)
+    assert len([key for key in memo if key[1] == sent]) == 1
+
+
+def test_extraction_plan_rejects_undefined_filter():
+    with pytest.raises(ValueError):
+        ExtractionPlan({"spam": {"xpath": ["."], "filter": "undefined"}})
+
+
+def make_service():
+    db = FakeExistClient({
+        LETTERS_XPATH: [make_resource(letter_xml('B1'), '1'), make_resource(letter_xml('B2'), '2')],
+        PERSONS_XPATH: [make_resource(person_xml('P1'), '3'), make_resource(person_xml('P2', 'Thile'), '3')],
+    })
+    return Service(db, CFG)
+
+
+def test_service_indexes_entities_by_id():
+    service = make_service()
+    assert list(service.index['letters']) == ['B1', 'B2']
+    assert service.find_resource('persons', 'P2') is service.entities['persons'][1]
+    assert service.find_resource('persons', 'nope') is None
+
+
+def test_get_entity_uses_index():
+    service = make_service()
+    assert 'xml:id="B2"' in service.get_entity('letters', 'B2', output_format='xml')
+    assert service.get_entity('letters', 'nope', output_format='xml') is None
+
+
+def test_get_entity_as_json():
+    service = make_service()
+    header = service.get_entity('letters', 'B1', output_format='json')['teiHeader']
+    assert header['@xmlns'] == 'http://www.tei-c.org/ns/1.0'
+    assert header['profileDesc']['correspDesc']['correspAction'][0]['persName'] == {
+        '@key': 'P1', '#text': 'Gregorovius, Ferdinand'
+    }
+    person = service.get_entity('persons', 'P2', output_format='json')['person']
+    assert person['persName']['surname'] == 'Thile'
+
+
+def test_update_entities_publishes_new_generation():
+    service = make_service()
+    current = service.generation
+    metas = service.get_entities('letters')
+
+    updated = service.update_entities({'letters': [make_resource(letter_xml('B3'), '3')]})
+
+    assert service.generation is updated
+    assert updated.number == current.number + 1
+    assert list(updated.index['letters']) == ['B3']
+    assert 'letters' not in updated.metas
+    assert updated.index['persons'] is current.index['persons']
+    # Readers still holding the previous generation are not affected
+    assert list(current.index['letters']) == ['B1', 'B2']
+    assert current.metas['letters'] is metas
+
+
+def make_watched_service():
+    db = FakeExistClient({
+        LETTERS_XPATH: [make_resource(letter_xml('B1'), '1'), make_resource(letter_xml('B2'), '2')],
+        PERSONS_XPATH: [make_resource(person_xml('P1'), '3'), make_resource(person_xml('P2', 'Thile'), '3')],
+    })
+    service = Service(db, CFG)
+    watcher = UpdateWatcher(db, service)
+    # As known from an earlier check
+    watcher.documents = {'1', '2', '3'}
+    return db, service, watcher
+
+
+def test_update_watcher_fetches_changes_in_one_query():
+    db, service, watcher = make_watched_service()
+    current = service.generation
+    db.responses.append(changes_response(
+        modified=['2', '4'],
+        count=4,
+        resources={'letters': [('2', letter_xml('B2', date='1861-01-01')), ('4', letter_xml('B4'))]}
+    ))
+
+    updated = watcher.check_for_updates()
+
+    assert len(db.queries) == len(CFG['entities']) + 1
+    assert "xmldb:find-last-modified-since" in db.queries[-1]
+    assert updated is service.generation
+    assert list(updated.index['letters']) == ['B1', 'B2', 'B4']
+    assert updated.entities['letters'][0] is current.entities['letters'][0]
+    assert updated.index['persons'] is current.index['persons']
+    assert service.get_entities('letters')[1].properties['date'] == '1861-01-01'
+    # The previous generation is left untouched
+    assert 'date when="1860-12-16"' in str(current.entities['letters'][1].node)
+
+
+def test_update_watcher_drops_deleted_documents():
+    db, service, watcher = make_watched_service()
+    db.responses.extend([changes_response(count=1), documents_response(['2'])])
+
+    updated = watcher.check_for_updates()
+
+    assert 'count(' in db.queries[-2]
+    assert list(updated.index['letters']) == ['B2']
+    assert updated.entities['persons'] == ()
+
+
+def test_update_watcher_drops_entities_gone_from_modified_documents():
+    db, service, watcher = make_watched_service()
+    db.responses.append(changes_response(
+        modified=['3'], count=3, resources={'persons': [('3', person_xml('P1'))]}
+    ))
+
+    updated = watcher.check_for_updates()
+
+    assert list(updated.index['persons']) == ['P1']
+    assert updated.index['letters'] is service.generation.index['letters']
+
+
+def test_update_watcher_ignores_unchanged_database():
+    db, service, watcher = make_watched_service()
+    current = service.generation
+    db.responses.append(changes_response(count=3))
+
+    assert watcher.check_for_updates() is None
+    assert service.generation is current
+    # Without removed documents, their IDs are not queried
+    assert not db.responses
+    assert len(db.queries) == len(CFG['entities']) + 1
+
+
+def test_update_watcher_queries_documents_on_first_check_and_removal():
+    db, service, watcher = make_watched_service()
+    watcher.documents = None
+    db.responses.extend([changes_response(count=4), documents_response(['1', '2', '3', 'other'])])
+
+    assert watcher.check_for_updates() is None
+    assert watcher.documents == {'1', '2', '3', 'other'}
+
+    # A document removed while another one was added leaves the count as it was
+    db.responses.extend([
+        changes_response(modified=['5'], count=4, resources={'letters': [('5', letter_xml('B5'))]}),
+        documents_response(['2', '3', '5', 'other']),
+    ])
+
+    updated = watcher.check_for_updates()
+
+    assert not db.responses
+    assert list(updated.index['letters']) == ['B2', 'B5']
+    assert watcher.documents == {'2', '3', '5', 'other'}
+
+
+def test_update_watcher_polls_less_often_without_changes():
+    db, service, watcher = make_watched_service()
+    watcher.min_interval, watcher.max_interval = 0.001, 0.004
+    outcomes = [None, None, None, None, service.generation, ValueError('database unreachable'), None]
+    intervals = []
+
+    def check_for_updates():
+        intervals.append(watcher.interval)
+        if len(intervals) == len(outcomes):
+            watcher.stop()
+        outcome = outcomes[len(intervals) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    watcher.interval = watcher.min_interval
+    watcher.check_for_updates = check_for_updates
+    watcher.update_resources()
+
+    assert intervals == [0.001, 0.002, 0.004, 0.004, 0.004, 0.001, 0.002]
+
+
+def stamped_letters(year: int, count: int = 20):
+    return [
+        make_resource(letter_xml(f'B{number}', date=f'{year}-01-01'), str(number))
+        for number in range(count)
+    ]
+
+
+def test_readers_see_consistent_generations_during_updates():
+    service = Service(FakeExistClient({LETTERS_XPATH: stamped_letters(1860)}), CFG)
+    updates = [stamped_letters(year) for year in range(1861, 1891)]
+    done = threading.Event()
+    errors = []
+
+    def read():
+        while not done.is_set():
+            try:
+                dates = {meta.properties['date'] for meta in service.get_entities('letters')}
+                assert len(dates) == 1, dates
+                generation = service.generation
+                for resource in generation.entities['letters']:
+                    entity_id = resource.node['{http://www.w3.org/XML/1998/namespace}id']
+                    assert service.find_resource('letters', entity_id, generation) is resource
+                header = service.get_entity('letters', 'B7', output_format='json')['teiHeader']
+                assert header['profileDesc']['correspDesc']['correspAction'][0]['date']['@when']
+            except Exception as error:
+                errors.append(error)
+                return
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for resources in updates:
+        service.update_entities({'letters': resources})
+        time.sleep(0.005)
+    done.set()
+    for reader in readers:
+        reader.join()
+
+    assert errors == []
+    assert service.generation.number == len(updates)
+    assert {meta.properties['date'] for meta in service.get_entities('letters')} == {'1890-01-01'}
+
+
+def test_concurrent_updates_are_not_lost():
+    service = make_service()
+    letters = [make_resource(letter_xml('B3'), '3')]
+    persons = [make_resource(person_xml('P3'), '4')]
+    threads = [
+        threading.Thread(target=service.update_entities, args=({'letters': letters},)),
+        threading.Thread(target=service.update_entities, args=({'persons': persons},)),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert service.generation.number == 2
+    assert list(service.index['letters']) == ['B3']
+    assert list(service.index['persons']) == ['P3']
+
+
+class SlowExistClient(FakeExistClient):
+    def xpath(self, expression: str):
+        time.sleep(0.2)
+        return super().xpath(expression)
+
+
+def test_service_loads_entities_concurrently():
+    started = time.perf_counter()
+    service = Service(SlowExistClient(), dict(CFG, load_workers=5))
+    elapsed = time.perf_counter() - started
+
+    assert set(service.load_times) == set(CFG['entities'])
+    assert all(load_time >= 0.2 for load_time in service.load_times.values())
+    assert elapsed < 0.2 * len(CFG['entities'])
+
+
+class UnreachableExistClient(FakeExistClient):
+    def xpath(self, expression: str):
+        raise AssertionError('The database must not be queried')
+
+
+def test_service_restores_entities_from_snapshot(tmp_path):
+    manifest = dict(CFG, snapshot_dir=str(tmp_path))
+    db = FakeExistClient({
+        LETTERS_XPATH: [make_resource(letter_xml('B1'), '1'), make_resource(letter_xml('B2'), '2')],
+    })
+    cold = Service(db, manifest, version='abc')
+
+    warm = Service(UnreachableExistClient(), manifest, version='abc')
+
+    assert warm.get_entities('letters') == cold.get_entities('letters')
+    assert warm.get_entity('letters', 'B2', 'xml') == cold.get_entity('letters', 'B2', 'xml')
+    assert warm.find_resource('letters', 'B1').abs_resource_id == '1'
+
+
+def test_service_ignores_snapshot_of_other_version(tmp_path):
+    manifest = dict(CFG, snapshot_dir=str(tmp_path))
+    Service(FakeExistClient({LETTERS_XPATH: [make_resource(letter_xml('B1'))]}), manifest, version='abc')
+
+    db = FakeExistClient({LETTERS_XPATH: [make_resource(letter_xml('B2'))]})
+    service = Service(db, manifest, version='def')
+
+    assert LETTERS_XPATH in db.queries
+    assert list(service.index['letters']) == ['B2']
+    assert [path.name for path in tmp_path.iterdir()] == ['entities-def.pickle']
+
+
+def test_parse_fields():
+    assert parse_fields('title, place.sent,date') == {'title': None, 'place': {'sent': None}, 'date': None}
+    assert parse_fields('place,place.sent') == {'place': None}
+    assert format_fields(parse_fields('place.sent,date,mentioned.works,mentioned.persons')) == (
+        'date,mentioned.persons,mentioned.works,place.sent'
+    )
+
+
+def test_get_entities_extracts_requested_fields_only():
+    service = make_service()
+    fields = parse_fields('title,place.sent')
+
+    projected = service.get_entities('letters', fields=fields)
+
+    assert 'letters' not in service.metas
+    assert projected[0].properties == {
+        'title': 'Gregorovius an Thile. Rom, 1860-12-16',
+        'place': {'sent': 'L1'},
+    }
+    full = service.get_entities('letters')
+    assert service.get_entities('letters', fields=fields) == projected
+    assert full[0].properties['place'] == {'sent': 'L1', 'received': 'L2'}
+
+
+def test_get_entities_rejects_unknown_fields():
+    service = make_service()
+    with pytest.raises(ValueError):
+        service.get_entities('letters', fields=parse_fields('title,spam'))
+    with pytest.raises(ValueError):
+        service.get_entities('letters', fields=parse_fields('title.spam'))
+
+
+def test_iter_entities_extracts_a_page_lazily():
+    db = FakeExistClient({LETTERS_XPATH: [make_resource(letter_xml(f'B{number}')) for number in range(5)]})
+    service = Service(db, CFG)
+
+    page = service.iter_entities('letters', parse_fields('title'), offset=1, limit=2)
+
+    assert 'letters' not in service.metas
+    assert next(page).id == 'B1'
+    assert [meta.id for meta in page] == ['B2']
+    assert service.count_entities('letters') == 5
+    full = service.get_entities('letters')
+    assert list(service.iter_entities('letters', offset=3)) == full[3:]
+    assert [meta.properties for meta in service.iter_entities('letters', parse_fields('title'), limit=1)] == [
+        {'title': full[0].properties['title']}
+    ]
+    assert list(service.iter_entities('letters', offset=5)) == []
+
+
+def test_iter_entities_rejects_unknown_fields():
+    service = make_service()
+    with pytest.raises(ValueError):
+        service.iter_entities('letters', fields=parse_fields('spam'))
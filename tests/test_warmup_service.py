@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+from diskcache import Cache
+
+from service.cache_service import Entry, ResponseCache, entity_dependency, item_dependency
+from service.warmup_service import WarmUp
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with Cache(str(tmp_path)) as disk_cache:
+        yield ResponseCache(disk_cache)
+
+
+def counting_entries(calls):
+    def compute(key):
+        def inner():
+            calls.append(key)
+            if key == '/cmif':
+                raise OSError('Database unavailable')
+            return key.upper()
+        return inner
+
+    def entries():
+        yield Entry('/letters', compute('/letters'), [entity_dependency('letters')])
+        yield Entry('/cmif', compute('/cmif'), [entity_dependency('letters')])
+        yield Entry('/letters/B1?format=json', compute('/letters/B1?format=json'), [item_dependency('letters', 'B1')])
+        yield Entry('/letters/B2?format=json', compute('/letters/B2?format=json'), [item_dependency('letters', 'B2')])
+    return entries
+
+
+def test_run_computes_missing_entries(cache):
+    calls = []
+    warm_up = WarmUp(cache, counting_entries(calls))
+    cache.set('/letters/B2?format=json', 'cached', [item_dependency('letters', 'B2')])
+
+    assert not warm_up.ready
+    warm_up.run()
+
+    assert calls == ['/letters', '/cmif', '/letters/B1?format=json']
+    assert cache.get('/letters/B1?format=json') == '/LETTERS/B1?FORMAT=JSON'
+    assert cache.get('/letters/B2?format=json') == 'cached'
+    status = warm_up.status()
+    assert status['ready'] and not status['running']
+    assert (status['total'], status['done'], status['computed'], status['failed']) == (4, 4, 2, 1)
+
+
+def test_warm_up_after_changes_computes_evicted_entries(cache):
+    calls = []
+    warm_up = WarmUp(cache, counting_entries(calls))
+    warm_up.run()
+    calls.clear()
+
+    cache.invalidate_changes({'letters': {'B1'}})
+    warm_up.warm_up_changes({'letters': {'B1'}})
+
+    assert warm_up.wait(5)
+    assert calls == ['/letters', '/cmif', '/letters/B1?format=json']
+    assert warm_up.status()['runs'] == 2
+
+
+def test_start_during_warm_up_runs_again(cache):
+    started, proceed = threading.Event(), threading.Event()
+    runs = []
+
+    def entries():
+        runs.append(1)
+        if len(runs) == 1:
+            started.set()
+            proceed.wait(5)
+        return []
+
+    warm_up = WarmUp(cache, entries)
+    warm_up.start()
+    started.wait(5)
+    warm_up.start()
+    warm_up.start()
+    assert warm_up.running
+    proceed.set()
+
+    assert warm_up.wait(5)
+    assert len(runs) == 2
+    assert warm_up.runs == 2
+
+
+def test_run_counts_only_entries_it_computed(cache, monkeypatch):
+    calls = []
+    warm_up = WarmUp(cache, counting_entries(calls))
+    cache.set('/letters/B2?format=json', 'cached', [item_dependency('letters', 'B2')])
+    # As if another worker stored the entry between the check and the lookup
+    monkeypatch.setattr(ResponseCache, '__contains__', lambda self, key: False)
+
+    warm_up.run()
+
+    assert calls == ['/letters', '/cmif', '/letters/B1?format=json']
+    assert (warm_up.status()['done'], warm_up.status()['computed']) == (4, 2)